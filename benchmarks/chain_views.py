@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+
+from iris_validation.graphics import Panel
+from iris_validation.metrics import load_raw_data, metrics_model_series_from_files
+
+
+# Run from the repository root as 'python -m benchmarks.chain_views [raw_data_path]'
+INPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example_input')
+
+PDB_ID = '2a0x'
+ROOT_PATH = str(os.path.join(INPUT_DIR, PDB_ID)) + '{suffix}'
+
+NUM_REPEATS = 5
+
+
+def load_model_series_data():
+    # Raw data written with save_raw_data can be given as an argument; otherwise the example input is analysed
+    if len(sys.argv) > 1:
+        return load_raw_data(sys.argv[1])
+    model_series = metrics_model_series_from_files((ROOT_PATH.format(suffix='_0cyc.pdb'), ROOT_PATH.format(suffix='_final.pdb')),
+                                                   (ROOT_PATH.format(suffix='_0cyc.mtz'), ROOT_PATH.format(suffix='_final.mtz')),
+                                                   (ROOT_PATH.format(suffix='.fasta'), ROOT_PATH.format(suffix='.fasta')),
+                                                   (ROOT_PATH.format(suffix='.npz'), ROOT_PATH.format(suffix='.npz')),
+                                                   multiprocessing=False)
+    return model_series.get_raw_data()
+
+
+def time_panels(chain_view_backend, model_series_data):
+    # Best of several runs of the whole panel, including serialisation, as chain view markup is only useful once
+    # it has been written into the report
+    best_time = None
+    for _ in range(NUM_REPEATS):
+        t0 = time.perf_counter()
+        Panel(model_series_data, chain_view_backend=chain_view_backend).dwg.tostring()
+        elapsed = time.perf_counter() - t0
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    return best_time
+
+
+if __name__ == '__main__':
+    model_series_data = load_model_series_data()
+    num_segments = sum(chain_data['aligned_length'] for chain_data in model_series_data)
+    print('Chains:', len(model_series_data), '| Segments:', num_segments, '| Versions:', model_series_data[0]['num_versions'])
+
+    svgwrite_time = time_panels('svgwrite', model_series_data)
+    string_time = time_panels('string', model_series_data)
+    print('svgwrite backend:', round(svgwrite_time, 3), 's')
+    print('string backend:', round(string_time, 3), 's')
+    print('Speed-up:', round(svgwrite_time / string_time, 1), 'x')
+    print()
@@ -1,7 +1,11 @@
 import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 from iris_validation.graphics import Panel
-from iris_validation.metrics import metrics_model_series_from_files
+from iris_validation.metrics import iter_chain_data_from_files, load_raw_data, metrics_model_series_from_files
+from iris_validation.metrics.serialization import encode_chain_data
+from iris_validation.metrics.ramachandran import build_ramachandran_cache
 
 
 def generate_report(latest_model_path,
@@ -16,22 +20,121 @@ def generate_report(latest_model_path,
                     run_molprobity=False,
                     multiprocessing=True,
                     wrap_in_html=True,
-                    output_dir=None):
+                    output_dir=None,
+                    *,
+                    executor=None,
+                    executor_type='process',
+                    max_workers=None,
+                    analysis_timeout=None,
+                    columnar=False,
+                    streaming=False,
+                    use_cache=False,
+                    previous_snapshot=None,
+                    reuse_models=False,
+                    ramachandran_grids=False,
+                    lazy_chain_views=False,
+                    chain_view_backend='svgwrite'):
+    # Options added since the original positional arguments are keyword-only, so existing positional calls still work.
+    # Chains are only scored in parallel with columnar; otherwise only the external analyses and chain alignment run in the pool.
+    # use_cache stores analysis results in ~/.cache/iris_validation, or $IRIS_VALIDATION_CACHE_DIR if set; it is
+    # emptied with iris_validation.metrics.clear_results().
 
     model_paths = (previous_model_path, latest_model_path)
     reflections_paths = (previous_reflections_path, latest_reflections_path)
     sequence_paths = (previous_sequence_path, latest_sequence_path)
     distpred_paths = (previous_distpred_path, latest_distpred_path)
-    
-    model_series = metrics_model_series_from_files(model_paths,
-                                                   reflections_paths,
-                                                   sequence_paths,
-                                                   distpred_paths,
-                                                   run_covariance,
-                                                   run_molprobity,
-                                                   multiprocessing)
-    model_series_data = model_series.get_raw_data()
-    panel = Panel(model_series_data)
+    snapshots = None if previous_snapshot is None else (previous_snapshot, None)
+    if previous_model_path is None:
+        if previous_snapshot is not None:
+            raise ValueError('A previous model snapshot was given without a previous model path')
+        model_paths, reflections_paths, sequence_paths, distpred_paths = \
+            [ paths[1:] for paths in (model_paths, reflections_paths, sequence_paths, distpred_paths) ]
+
+    return generate_series_report(model_paths,
+                                  reflections_paths,
+                                  sequence_paths,
+                                  distpred_paths,
+                                  run_covariance,
+                                  run_molprobity,
+                                  multiprocessing,
+                                  wrap_in_html,
+                                  output_dir,
+                                  executor=executor,
+                                  executor_type=executor_type,
+                                  max_workers=max_workers,
+                                  analysis_timeout=analysis_timeout,
+                                  columnar=columnar,
+                                  streaming=streaming,
+                                  use_cache=use_cache,
+                                  snapshots=snapshots,
+                                  reuse_models=reuse_models,
+                                  ramachandran_grids=ramachandran_grids,
+                                  lazy_chain_views=lazy_chain_views,
+                                  chain_view_backend=chain_view_backend)
+
+
+def generate_series_report(model_paths,
+                           reflections_paths=None,
+                           sequence_paths=None,
+                           distpred_paths=None,
+                           run_covariance=False,
+                           run_molprobity=False,
+                           multiprocessing=True,
+                           wrap_in_html=True,
+                           output_dir=None,
+                           *,
+                           executor=None,
+                           executor_type='process',
+                           max_workers=None,
+                           analysis_timeout=None,
+                           columnar=False,
+                           streaming=False,
+                           use_cache=False,
+                           snapshots=None,
+                           reuse_models=False,
+                           ramachandran_grids=False,
+                           lazy_chain_views=False,
+                           chain_view_backend='svgwrite'):
+    # Path iterables are ordered from the earliest model version to the latest. Chains are only scored in parallel
+    # with columnar; otherwise only the external analyses and chain alignment run in the pool.
+    series_args = (model_paths,
+                   reflections_paths,
+                   sequence_paths,
+                   distpred_paths,
+                   run_covariance,
+                   run_molprobity,
+                   multiprocessing,
+                   executor,
+                   executor_type,
+                   max_workers,
+                   analysis_timeout,
+                   columnar,
+                   use_cache)
+    if streaming:
+        if snapshots is not None or reuse_models:
+            raise ValueError('Model snapshots cannot be used with streaming reports')
+        # Only one chain's metrics are held in memory at a time, and each chain's raw data is encoded as compact
+        # typed arrays as soon as it is produced. The panel decodes one chain at a time to draw its view, but the
+        # encoded data for every chain and the finished report are still held in memory together.
+        model_series_data = [ encode_chain_data(chain_data) for chain_data in iter_chain_data_from_files(*series_args, ramachandran_grids=ramachandran_grids) ]
+    else:
+        model_series = metrics_model_series_from_files(*series_args,
+                                                       snapshots=snapshots,
+                                                       reuse_models=reuse_models,
+                                                       ramachandran_grids=ramachandran_grids)
+        model_series_data = model_series.get_raw_data()
+    return _render_report(model_series_data, wrap_in_html, output_dir, lazy_chain_views, chain_view_backend)
+
+
+def generate_report_from_raw_data(raw_data_path, wrap_in_html=True, output_dir=None, *, lazy_chain_views=False, chain_view_backend='svgwrite'):
+    # Renders raw data written with save_raw_data, e.g. on a machine without the analysis dependencies
+    return _render_report(load_raw_data(raw_data_path), wrap_in_html, output_dir, lazy_chain_views, chain_view_backend)
+
+
+def _render_report(model_series_data, wrap_in_html=True, output_dir=None, lazy_chain_views=False, chain_view_backend='svgwrite'):
+    # Lazy reports only render the first chain view up front; the rest are drawn in the browser on selection.
+    # The 'string' chain view backend writes chain view markup directly, skipping svgwrite's per-element overhead
+    panel = Panel(model_series_data, lazy_chain_views=lazy_chain_views, chain_view_backend=chain_view_backend)
     panel_string = panel.dwg.tostring()
 
     if wrap_in_html:
@@ -46,3 +149,78 @@ def generate_report(latest_model_path,
     extension = 'html' if wrap_in_html else 'svg'
     with open(os.path.join(output_dir, f'report.{extension}'), 'w', encoding='utf8') as outfile:
         outfile.write(panel_string)
+
+
+def _get_job_names(jobs):
+    job_names = [ ]
+    for job_id, job in enumerate(jobs):
+        job_name = job.get('name')
+        if job_name is None:
+            job_name = os.path.splitext(os.path.basename(job['latest_model_path']))[0]
+        if job_name in job_names:
+            job_name = f'{job_name}_{job_id}'
+        job_names.append(job_name)
+    return job_names
+
+
+def _run_report_job(job, job_output_dir):
+    t0 = time.monotonic()
+    report_kwargs = { key : value for key, value in job.items() if key != 'name' }
+    # Jobs already run in parallel, so each one runs its analyses serially by default
+    report_kwargs.setdefault('multiprocessing', False)
+    report_kwargs['output_dir'] = job_output_dir
+    extension = 'html' if report_kwargs.get('wrap_in_html', True) else 'svg'
+    job_summary = { 'status' : 'success',
+                    'error' : None,
+                    'output_path' : os.path.join(job_output_dir, f'report.{extension}') }
+    try:
+        generate_report(**report_kwargs)
+    except Exception as exception:
+        job_summary['status'] = 'failed'
+        job_summary['error'] = f'{type(exception).__name__}: {exception}'
+        job_summary['output_path'] = None
+    job_summary['time'] = time.monotonic() - t0
+    return job_summary
+
+
+def generate_reports(jobs, output_dir, workers=None, max_pending=None, ramachandran_grids=False):
+    # Each job is a dict of generate_report keyword arguments, plus an optional 'name'. With ramachandran_grids, the
+    # Ramachandran grid cache is built once up front and jobs score from it unless they set the option themselves
+    jobs = list(jobs)
+    job_names = _get_job_names(jobs)
+    if max_pending is None:
+        max_pending = 2 * (workers or os.cpu_count() or 1)
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if ramachandran_grids:
+        build_ramachandran_cache()
+        jobs = [ { 'ramachandran_grids' : True, **job } for job in jobs ]
+
+    summaries = [ None for _ in jobs ]
+    job_queue = iter(enumerate(zip(job_names, jobs)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = { }
+        while True:
+            # Keep a bounded number of jobs in flight so long job lists are streamed
+            for job_id, (job_name, job) in job_queue:
+                future = executor.submit(_run_report_job, job, os.path.join(output_dir, job_name))
+                futures[future] = (job_id, job_name, time.monotonic())
+                if len(futures) >= max_pending:
+                    break
+            if len(futures) == 0:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                job_id, job_name, submission_time = futures.pop(future)
+                try:
+                    job_summary = future.result()
+                except Exception as exception:
+                    job_summary = { 'status' : 'failed',
+                                    'error' : f'{type(exception).__name__}: {exception}',
+                                    'output_path' : None,
+                                    'time' : time.monotonic() - submission_time }
+                job_summary['name'] = job_name
+                summaries[job_id] = job_summary
+
+    return summaries
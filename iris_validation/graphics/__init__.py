@@ -1,3 +1,4 @@
 from iris_validation.graphics.panel import Panel
 from iris_validation.graphics.chain import ChainView
+from iris_validation.graphics.fast_chain import FastChainView
 from iris_validation.graphics.residue import ResidueView
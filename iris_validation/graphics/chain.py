@@ -8,15 +8,16 @@ from iris_validation._defs import COLORS, CHAIN_VIEW_RINGS, CHAIN_VIEW_GAP_ANGLE
 
 
 class ChainView():
-    def __init__(self, data, chain_index, canvas_size=(1000, 1000), hidden=False):
+    def __init__(self, data, chain_index, canvas_size=(1000, 1000), hidden=False, rings=None):
         self.data = data
         self.chain_index = chain_index
         self.canvas_size = canvas_size
         self.hidden = hidden
+        self.rings = CHAIN_VIEW_RINGS if rings is None else rings
 
         self.dwg = None
         self.cfa_cache = { }
-        self.num_rings = len(CHAIN_VIEW_RINGS)
+        self.num_rings = len(self.rings)
         self.num_versions = self.data['num_versions']
         self.num_segments = self.data['aligned_length']
         self.center = (self.canvas_size[0] // 2, self.canvas_size[1] // 2)
@@ -58,7 +59,7 @@ class ChainView():
 
 
         # Draw data rings
-        for ring_id, ring_metric in enumerate(CHAIN_VIEW_RINGS):
+        for ring_id, ring_metric in enumerate(self.rings):
             self._add_ring(ring_id, ring_metric)
 
         # Draw missing-data shade
@@ -207,83 +208,12 @@ class ChainView():
                 self.dwg.add(segment_group)
 
         elif metric['type'] == 'continuous':
-            # Get mean metric value
-            all_valid_values = [ ]
-            for version_datapoints in datapoints:
-                for datapoint in version_datapoints:
-                    if datapoint is None:
-                        continue
-                    value = datapoint * metric['polarity']
-                    all_valid_values.append(value)
-            ring_avg = 0
-            if len(all_valid_values) == 0:
+            line_points = self._get_line_points(metric, datapoints, ring_base_radius)
+            if line_points is None:
                 return
-            ring_avg = sum(all_valid_values) / len(all_valid_values)
-
-            # Calculate deltas from the ring average
-            deltas = [ ]
-            for version_datapoints in datapoints:
-                version_deltas = [ ]
-                for datapoint in version_datapoints:
-                    delta = None
-                    if datapoint is not None:
-                        value = datapoint * metric['polarity']
-                        delta = value - ring_avg
-                    version_deltas.append(delta)
-                deltas.append(version_deltas)
-
-            # Calculate average negative delta in the latest dataset
-            latest_negative_deltas = [ x for x in deltas[-1] if x is not None and x < 0 ]
-            avg_negative_delta = 0
-            if len(latest_negative_deltas) > 0:
-                avg_negative_delta = sum(latest_negative_deltas) / len(latest_negative_deltas)
-
-            # Subtract the average negative delta from all deltas to calculate 'magnitudes'
-            magnitudes = [ ]
-            all_valid_magnitudes = [ ]
-            for version_deltas in deltas:
-                version_magnitudes = [ x - avg_negative_delta if x is not None else None for x in version_deltas ]
-                all_valid_magnitudes += [ x for x in version_magnitudes if x is not None ]
-                magnitudes.append(version_magnitudes)
-            magnitude_min, magnitude_max = (min(all_valid_magnitudes), max(all_valid_magnitudes))
-
-            # Calculate plot magnitudes
-            plot_magnitudes = [ ]
-            for version_magnitudes in magnitudes:
-                version_plot_magnitudes = [ ]
-                for magnitude in version_magnitudes:
-                    if magnitude is None:
-                        version_plot_magnitudes.append(None)
-                        continue
-                    plot_magnitude = 0
-                    if magnitude > 0 and magnitude_max != 0:
-                        plot_magnitude = magnitude / magnitude_max * +0.25
-                    elif magnitude < 0 and magnitude_min != 0:
-                        plot_magnitude = magnitude / magnitude_min * -0.7
-                    version_plot_magnitudes.append(plot_magnitude)
-                plot_magnitudes.append(version_plot_magnitudes)
-
-            # Calculate plot point coordinates
-            line_points = [ ]
-            for version_plot_magnitudes in plot_magnitudes:
-                version_line_points = [ ]
-                zero_point = self._coords_from_angle(self.angle_delta*0.5, ring_base_radius)
-                version_line_points.append(zero_point)
-                for segment_id, plot_magnitude in enumerate(version_plot_magnitudes):
-                    angle = self.angle_delta * (segment_id + 0.5)
-                    plot_radius = ring_base_radius
-                    if plot_magnitude is not None:
-                        plot_radius += self.division_size * plot_magnitude
-                    point = self._coords_from_angle(angle, plot_radius)
-                    version_line_points.append(point)
-                line_points.append(version_line_points)
 
             # Draw line
-            baseline_circle_points = [ ]
-            baseline_point_resolution = 200
-            for point_id in range(baseline_point_resolution + 1):
-                point_angle = (baseline_point_resolution - point_id) * (2*pi - CHAIN_VIEW_GAP_ANGLE) / baseline_point_resolution
-                baseline_circle_points.append(self._coords_from_angle(point_angle, ring_base_radius))
+            baseline_circle_points = self._get_baseline_points(ring_base_radius)
             plot_points = line_points[-1] + baseline_circle_points
             ring_line = self.dwg.polyline(plot_points,
                                           stroke=metric['ring_color'],
@@ -303,3 +233,84 @@ class ChainView():
                                     id=f'{self.svg_id}-animation-{version_id}-{ring_id}')
                 ring_line.add(animation)
             self.dwg.add(ring_line)
+
+    def _get_line_points(self, metric, datapoints, ring_base_radius):
+        # Get mean metric value
+        all_valid_values = [ ]
+        for version_datapoints in datapoints:
+            for datapoint in version_datapoints:
+                if datapoint is None:
+                    continue
+                value = datapoint * metric['polarity']
+                all_valid_values.append(value)
+        ring_avg = 0
+        if len(all_valid_values) == 0:
+            return None
+        ring_avg = sum(all_valid_values) / len(all_valid_values)
+
+        # Calculate deltas from the ring average
+        deltas = [ ]
+        for version_datapoints in datapoints:
+            version_deltas = [ ]
+            for datapoint in version_datapoints:
+                delta = None
+                if datapoint is not None:
+                    value = datapoint * metric['polarity']
+                    delta = value - ring_avg
+                version_deltas.append(delta)
+            deltas.append(version_deltas)
+
+        # Calculate average negative delta in the latest dataset
+        latest_negative_deltas = [ x for x in deltas[-1] if x is not None and x < 0 ]
+        avg_negative_delta = 0
+        if len(latest_negative_deltas) > 0:
+            avg_negative_delta = sum(latest_negative_deltas) / len(latest_negative_deltas)
+
+        # Subtract the average negative delta from all deltas to calculate 'magnitudes'
+        magnitudes = [ ]
+        all_valid_magnitudes = [ ]
+        for version_deltas in deltas:
+            version_magnitudes = [ x - avg_negative_delta if x is not None else None for x in version_deltas ]
+            all_valid_magnitudes += [ x for x in version_magnitudes if x is not None ]
+            magnitudes.append(version_magnitudes)
+        magnitude_min, magnitude_max = (min(all_valid_magnitudes), max(all_valid_magnitudes))
+
+        # Calculate plot magnitudes
+        plot_magnitudes = [ ]
+        for version_magnitudes in magnitudes:
+            version_plot_magnitudes = [ ]
+            for magnitude in version_magnitudes:
+                if magnitude is None:
+                    version_plot_magnitudes.append(None)
+                    continue
+                plot_magnitude = 0
+                if magnitude > 0 and magnitude_max != 0:
+                    plot_magnitude = magnitude / magnitude_max * +0.25
+                elif magnitude < 0 and magnitude_min != 0:
+                    plot_magnitude = magnitude / magnitude_min * -0.7
+                version_plot_magnitudes.append(plot_magnitude)
+            plot_magnitudes.append(version_plot_magnitudes)
+
+        # Calculate plot point coordinates
+        line_points = [ ]
+        for version_plot_magnitudes in plot_magnitudes:
+            version_line_points = [ ]
+            zero_point = self._coords_from_angle(self.angle_delta*0.5, ring_base_radius)
+            version_line_points.append(zero_point)
+            for segment_id, plot_magnitude in enumerate(version_plot_magnitudes):
+                angle = self.angle_delta * (segment_id + 0.5)
+                plot_radius = ring_base_radius
+                if plot_magnitude is not None:
+                    plot_radius += self.division_size * plot_magnitude
+                point = self._coords_from_angle(angle, plot_radius)
+                version_line_points.append(point)
+            line_points.append(version_line_points)
+        return line_points
+
+    def _get_baseline_points(self, ring_base_radius):
+        baseline_circle_points = [ ]
+        baseline_point_resolution = 200
+        for point_id in range(baseline_point_resolution + 1):
+            point_angle = (baseline_point_resolution - point_id) * (2*pi - CHAIN_VIEW_GAP_ANGLE) / baseline_point_resolution
+            baseline_circle_points.append(self._coords_from_angle(point_angle, ring_base_radius))
+        return baseline_circle_points
@@ -0,0 +1,256 @@
+import re
+from math import sin, cos
+from xml.etree import ElementTree as etree
+from xml.sax.saxutils import escape, quoteattr
+
+import svgwrite
+
+from iris_validation.graphics.chain import ChainView
+from iris_validation._defs import COLORS, CHAIN_VIEW_GAP_ANGLE
+
+
+SVG_NAMESPACE_ATTRIBS = { 'xmlns' : 'http://www.w3.org/2000/svg',
+                          'xmlns:ev' : 'http://www.w3.org/2001/xml-events',
+                          'xmlns:xlink' : 'http://www.w3.org/1999/xlink' }
+
+FRAGMENT_PLACEHOLDER_TAG = 'iris-svg-fragment'
+FRAGMENT_PLACEHOLDER_PATTERN = re.compile(f'<{FRAGMENT_PLACEHOLDER_TAG} index="(\\d+)" />')
+
+
+def _attribute_string(attribs):
+    return ''.join(f' {name}={quoteattr(str(value))}' for name, value in attribs.items())
+
+
+def _element(tag, attribs, content=None):
+    if content is None:
+        return f'<{tag}{_attribute_string(attribs)} />'
+    return f'<{tag}{_attribute_string(attribs)}>{content}</{tag}>'
+
+
+def _points_string(points):
+    return ' '.join(f'{x},{y}' for x, y in points)
+
+
+# Pre-rendered SVG markup that can be added to an svgwrite drawing in place of a Drawing
+class SVGFragment():
+    elementname = 'svg'
+
+    def __init__(self, content, attribs=None):
+        self.content = content
+        self.attribs = { } if attribs is None else attribs
+
+    def tostring(self):
+        attribs = dict(sorted(self.attribs.items()))
+        attribs.update(SVG_NAMESPACE_ATTRIBS)
+        return _element(self.elementname, attribs, self.content)
+
+    def get_xml(self):
+        xml = etree.fromstring(f'<{self.elementname}>{self.content}</{self.elementname}>')
+        for attribute, value in sorted(self.attribs.items()):
+            if value is not None and str(value):
+                xml.set(attribute, str(value))
+        return xml
+
+
+class _FragmentPlaceholder():
+    def __init__(self, index):
+        self.index = index
+
+    def get_xml(self):
+        return etree.Element(FRAGMENT_PLACEHOLDER_TAG, index=str(self.index))
+
+
+# svgwrite Drawing that splices the markup of SVGFragments added to it into its output as text. Fragments are
+# serialised as placeholders first, so their markup is never parsed back into elements.
+class FragmentDrawing(svgwrite.Drawing):
+    def tostring(self):
+        elements, fragments = self.elements, [ ]
+        self.elements = [ ]
+        for element in elements:
+            if isinstance(element, SVGFragment):
+                self.elements.append(_FragmentPlaceholder(len(fragments)))
+                fragments.append(element)
+            else:
+                self.elements.append(element)
+        try:
+            xml_string = super().tostring()
+        finally:
+            self.elements = elements
+        # Split parts alternate between surrounding markup and placeholder indices
+        parts = FRAGMENT_PLACEHOLDER_PATTERN.split(xml_string)
+        parts[1::2] = [ fragments[int(index)].tostring() for index in parts[1::2] ]
+        return ''.join(parts)
+
+
+# Drop-in replacement for ChainView that writes markup directly instead of building svgwrite elements. Segments that
+# share a fill are merged into one path per group, so the output is visually equivalent rather than element-identical
+class FastChainView(ChainView):
+    def __init__(self, data, chain_index, canvas_size=(1000, 1000), hidden=False, rings=None):
+        self.parts = None
+        self.boundary_cache = { }
+        super().__init__(data, chain_index, canvas_size, hidden, rings)
+
+    def _boundary_coords(self, radius):
+        # Coordinates of every segment boundary on a circle, shared by all rings and versions at that radius
+        if radius not in self.boundary_cache:
+            center_x, center_y = self.center
+            half_gap = CHAIN_VIEW_GAP_ANGLE / 2
+            boundary_coords = [ ]
+            for i in range(self.num_segments+1):
+                angle = self.angle_delta * i + half_gap
+                boundary_coords.append(f'{round(center_x + radius * sin(angle), 1)},{round(center_y - radius * cos(angle), 1)}')
+            self.boundary_cache[radius] = boundary_coords
+        return self.boundary_cache[radius]
+
+    def _wedge_path(self, segment_ids, radius):
+        outer_coords = self._boundary_coords(radius)
+        center = f'{self.center[0]},{self.center[1]}'
+        return ''.join(f'M{center}L{outer_coords[segment_id]}L{outer_coords[segment_id+1]}Z' for segment_id in segment_ids)
+
+    def _draw(self):
+        self.parts = [ ]
+        attribs = { 'baseProfile' : 'full',
+                    'height' : '100%',
+                    'id' : self.svg_id,
+                    'version' : '1.1',
+                    'viewBox' : '0 0 ' + ' '.join([ str(x) for x in self.canvas_size ]),
+                    'width' : '100%' }
+        if self.hidden:
+            attribs['style'] = 'display: none;'
+        center_attribs = { 'cx' : self.center[0], 'cy' : self.center[1] }
+
+        # Draw background
+        self.parts.append(_element('circle', { **center_attribs, 'fill' : COLORS['WHITE'], 'fill-opacity' : 1, 'r' : self.full_radius, 'stroke-opacity' : 0 }))
+
+        # Draw data rings
+        for ring_id, ring_metric in enumerate(self.rings):
+            self._add_ring(ring_id, ring_metric)
+
+        # Draw missing-data shade
+        for version_id, residue_validities in enumerate(self.data['residue_validities']):
+            group_opacity = 1 if version_id == self.num_versions-1 else 0
+            invalid_segment_ids = [ segment_id for segment_id, residue_valid in enumerate(residue_validities) if not residue_valid ]
+            shade_path = ''
+            if len(invalid_segment_ids) > 0:
+                shade_path = _element('path', { 'd' : self._wedge_path(invalid_segment_ids, self.full_radius+5),
+                                                'fill' : COLORS['L_PINK'],
+                                                'fill-opacity' : 1,
+                                                'stroke-opacity' : 0 })
+            self.parts.append(_element('g', { 'id' : f'{self.svg_id}-shade-{version_id}', 'opacity' : group_opacity }, shade_path))
+
+        # Draw outer rings
+        for radius in (self.full_radius-24, self.full_radius-8):
+            self.parts.append(_element('circle', { **center_attribs,
+                                                   'fill-opacity' : 0,
+                                                   'r' : radius,
+                                                   'stroke' : COLORS['BLACK'],
+                                                   'stroke-opacity' : 0.5,
+                                                   'stroke-width' : 1 }))
+        inner_coords, outer_coords = self._boundary_coords(self.full_radius-24), self._boundary_coords(self.full_radius-8)
+        ticks_path = ''.join(f'M{inner_coord}L{outer_coord}' for inner_coord, outer_coord in zip(inner_coords, outer_coords))
+        self.parts.append(_element('path', { 'd' : ticks_path, 'fill-opacity' : 0, 'stroke' : COLORS['BLACK'], 'stroke-opacity' : 0.5, 'stroke-width' : 1 }))
+
+        # Draw segment selector
+        center_point = self.angle_delta*0.5
+        selector_points = (self._coords_from_angle(center_point, self.full_radius-16),
+                           self._coords_from_angle(center_point-0.02, self.full_radius-8),
+                           self._coords_from_angle(center_point-0.02, self.full_radius+8),
+                           self._coords_from_angle(center_point+0.02, self.full_radius+8),
+                           self._coords_from_angle(center_point+0.02, self.full_radius-8))
+        self.parts.append(_element('polygon', { 'fill' : COLORS['GREY'],
+                                                'fill-opacity' : 0.2,
+                                                'id' : f'{self.svg_id}-residue-selector',
+                                                'points' : _points_string(selector_points),
+                                                'stroke' : COLORS['BLACK'],
+                                                'stroke-opacity' : 1,
+                                                'stroke-width' : 2 }))
+
+        # Draw interaction segments; these stay separate elements as interaction.js highlights them one at a time
+        center = f'{self.center[0]},{self.center[1]}'
+        outer_coords = self._boundary_coords(self.full_radius+5)
+        segment_template = (f'<polygon fill="{COLORS["L_GREY"]}" fill-opacity="0" id="{self.svg_id}-interaction-segment-{{0}}" '
+                            'onmousedown="handleSegment(1, {0});" onmouseover="handleSegment(2, {0});" onmouseup="handleSegment(3, {0});" '
+                            f'points="{center} {{1}} {{2}}" stroke="{COLORS["BLACK"]}" stroke-opacity="0" stroke-width="1" />')
+        for segment_id in range(self.num_segments):
+            self.parts.append(segment_template.format(segment_id, outer_coords[segment_id], outer_coords[segment_id+1]))
+        self.parts.append(_element('circle', { **center_attribs, 'fill' : COLORS['WHITE'], 'fill-opacity' : 1, 'r' : 1.5*self.division_size, 'stroke-opacity' : 0 }))
+
+        # Draw center text
+        text_attribs = { 'alignment-baseline' : 'central', 'font-family' : 'Arial', 'text-anchor' : 'middle', 'x' : self.center[0] }
+        self.parts.append(_element('text', { **text_attribs, 'font-size' : 1.5*16, 'font-weight' : 'bold', 'y' : self.center[1]-24 }, 'Iris'))
+        self.parts.append(_element('text', { **text_attribs, 'font-size' : 16, 'y' : self.center[1]+16 }, escape('Chain ' + self.data['chain_id'])))
+        if self.data['has_molprobity']:
+            self.parts.append(_element('text', { **text_attribs, 'fill' : COLORS['L_GREY'], 'font-size' : 16, 'y' : self.center[1]+48 }, 'MolProbity'))
+
+        self.dwg = SVGFragment(''.join(self.parts), attribs)
+        self.parts = None
+
+    def _add_ring(self, ring_id, metric):
+        datapoints = self.data[metric['type'] + '_values'][metric['id']]
+
+        # Draw axes
+        ring_base_radius = (ring_id + 2) * self.division_size
+        self.parts.append(_element('circle', { 'cx' : self.center[0],
+                                               'cy' : self.center[1],
+                                               'fill-opacity' : 0,
+                                               'r' : ring_base_radius,
+                                               'stroke' : metric['ring_color'],
+                                               'stroke-opacity' : 1,
+                                               'stroke-width' : 1 }))
+        axis_points = [ self._coords_from_angle((CHAIN_VIEW_GAP_ANGLE/25)*(i-(20-1)/2), ring_base_radius, gap=False) for i in range(20) ]
+        self.parts.append(_element('polyline', { 'fill-opacity' : 0,
+                                                 'points' : _points_string(axis_points),
+                                                 'stroke' : metric['ring_color'],
+                                                 'stroke-opacity' : 1,
+                                                 'stroke-width' : 3 }))
+        label_x, label_y = self._coords_from_angle(0, ring_base_radius+12, gap=False)
+        self.parts.append(_element('text', { 'alignment-baseline' : 'central',
+                                             'font-family' : 'Arial',
+                                             'font-size' : 16,
+                                             'text-anchor' : 'middle',
+                                             'x' : label_x,
+                                             'y' : label_y }, escape(metric['short_name'])))
+
+        if metric['type'] == 'discrete':
+            segment_length = 10
+            seq_colors = metric['seq_colors']
+            inner_coords = self._boundary_coords(ring_base_radius - segment_length)
+            outer_coords = self._boundary_coords(ring_base_radius + segment_length)
+            segment_paths = [ f'M{inner_coords[i]}L{outer_coords[i]}L{outer_coords[i+1]}L{inner_coords[i+1]}Z' for i in range(self.num_segments) ]
+            for version_id, version_datapoints in enumerate(datapoints):
+                # One path per colour, in order of first appearance
+                color_paths = { }
+                for segment_id, datapoint in enumerate(version_datapoints):
+                    segment_color = seq_colors[-1]
+                    if datapoint is not None and 0 <= datapoint < len(seq_colors):
+                        segment_color = seq_colors[datapoint]
+                    color_paths.setdefault(segment_color, [ ]).append(segment_paths[segment_id])
+                group_opacity = 1 if version_id == self.num_versions-1 else 0
+                group_content = ''.join(_element('path', { 'd' : ''.join(paths),
+                                                           'fill' : segment_color,
+                                                           'fill-opacity' : 0.5 if segment_color == seq_colors[-1] else 1,
+                                                           'stroke-opacity' : 0,
+                                                           'stroke-width' : 0 })
+                                        for segment_color, paths in color_paths.items())
+                self.parts.append(_element('g', { 'id' : f'{self.svg_id}-discrete-{version_id}-{ring_id}', 'opacity' : group_opacity }, group_content))
+
+        elif metric['type'] == 'continuous':
+            line_points = self._get_line_points(metric, datapoints, ring_base_radius)
+            if line_points is None:
+                return
+
+            # Draw line
+            baseline_string = _points_string(self._get_baseline_points(ring_base_radius))
+            animations = ''.join(_element('animate', { 'attributeName' : 'points',
+                                                       'begin' : 'indefinite',
+                                                       'dur' : '250ms',
+                                                       'fill' : 'freeze',
+                                                       'id' : f'{self.svg_id}-animation-{version_id}-{ring_id}',
+                                                       'to' : _points_string(version_line_points) + ' ' + baseline_string })
+                                 for version_id, version_line_points in enumerate(line_points))
+            self.parts.append(_element('polyline', { 'fill' : metric['ring_color'],
+                                                     'fill-opacity' : 0.2,
+                                                     'points' : _points_string(line_points[-1]) + ' ' + baseline_string,
+                                                     'stroke' : metric['ring_color'],
+                                                     'stroke-opacity' : 1,
+                                                     'stroke-width' : 2 }, animations))
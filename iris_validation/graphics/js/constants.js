@@ -1,4 +1,4 @@
-const modelData = {model_data};
+const modelData = decodeModelData({model_data});
 const numChains = {num_chains};
 const boxMetricIDs = {box_metric_ids};
 const barMetricIDs = {bar_metric_ids};
@@ -6,3 +6,6 @@ const boxColors = {box_colors};
 const boxLabels = {box_labels};
 const gapDegrees = {gap_degrees};
 const chainSelectorColors = {chain_selector_colors};
+const chainSelectorLimit = {chain_selector_limit};
+const chainViewRings = {chain_view_rings};
+const chainViewColors = {chain_view_colors};
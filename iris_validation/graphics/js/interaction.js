@@ -1,8 +1,9 @@
-let selectedVersion = 1;
+let selectedVersion = modelData[0]['num_versions'] - 1;
 let selectedChain = 0;
 let selectedResidue = 0;
 
 let residueSummary = null;
+let versionCounter = null;
 let switchMovementAnimations = [ ];
 let switchColorAnimations = [ ];
 
@@ -10,6 +11,8 @@ let chainViews = [ ];
 let residueSelectors = [ ];
 let interactionSegmentSets = [ ];
 let chainSelectors = [ ];
+let chainDropdown = null;
+let chainDropdownSelector = null;
 let shadeGroups = [ ];
 let discreteGroupSets = [ ];
 let lineAnimationSets = [ ];
@@ -86,6 +89,72 @@ function unsetPointer() {
 };
 
 
+//
+// Data decoding
+//
+// These run while the constants are defined, so they must not use any of the top-level variables above
+function decodeTypedArray(encodedArray) {
+  let arrayTypes = { 'int8' : Int8Array,
+                     'uint8' : Uint8Array,
+                     'int16' : Int16Array,
+                     'int32' : Int32Array,
+                     'float32' : Float32Array };
+  let binary = atob(encodedArray['data']);
+  let bytes = new Uint8Array(binary.length);
+  for (var byteID = 0; byteID < binary.length; ++byteID) {
+    bytes[byteID] = binary.charCodeAt(byteID);
+  };
+  return new arrayTypes[encodedArray['dtype']](bytes.buffer);
+};
+
+
+function nestTypedArray(values, shape, decodeValue) {
+  // Splits a flat array into nested arrays of the given shape, decoding each value
+  if (shape.length == 1) {
+    return Array.from(values, decodeValue);
+  };
+  let nested = [ ];
+  let stride = values.length / shape[0];
+  for (var outerID = 0; outerID < shape[0]; ++outerID) {
+    nested.push(nestTypedArray(values.subarray(outerID*stride, (outerID+1)*stride), shape.slice(1), decodeValue));
+  };
+  return nested;
+};
+
+
+function decodeChainData(encodedChainData) {
+  if (!('arrays' in encodedChainData)) {
+    return encodedChainData;
+  };
+  let chainData = { };
+  let arrays = { };
+  for (let key of [ 'chain_id', 'num_versions', 'has_covariance', 'has_molprobity', 'has_reflections', 'aligned_length' ]) {
+    chainData[key] = encodedChainData[key];
+  };
+  let shapes = { };
+  for (let name in encodedChainData['arrays']) {
+    arrays[name] = decodeTypedArray(encodedChainData['arrays'][name]);
+    shapes[name] = encodedChainData['arrays'][name]['shape'];
+  };
+  let codeTable = encodedChainData['code_table'];
+  chainData['residue_validities'] = nestTypedArray(arrays['residue_validities'], shapes['residue_validities'], value => value == 1);
+  chainData['residue_seqnos'] = nestTypedArray(arrays['residue_seqnos'], shapes['residue_seqnos'], value => value);
+  for (var versionID = 0; versionID < chainData['residue_seqnos'].length; ++versionID) {
+    chainData['residue_seqnos'][versionID] = chainData['residue_seqnos'][versionID].map((seqNum, residueID) => chainData['residue_validities'][versionID][residueID] ? seqNum : null);
+  };
+  chainData['residue_codes'] = nestTypedArray(arrays['residue_codes'], shapes['residue_codes'], value => value < 0 ? null : codeTable[value]);
+  chainData['discrete_values'] = nestTypedArray(arrays['discrete_values'], shapes['discrete_values'], value => value < 0 ? null : value);
+  chainData['continuous_values'] = nestTypedArray(arrays['continuous_values'], shapes['continuous_values'], value => isNaN(value) ? null : Math.round(value * 1000) / 1000);
+  chainData['percentile_values'] = nestTypedArray(arrays['percentile_values'], shapes['percentile_values'], value => value < 0 ? null : value);
+  return chainData;
+};
+
+
+function decodeModelData(encodedModelData) {
+  return encodedModelData.map(decodeChainData);
+};
+
+
 //
 // One-off functions
 //
@@ -134,6 +203,190 @@ function getResidueViewData() {
 };
 
 
+//
+// Client-side chain views
+//
+// Mirrors ChainView in chain.py, for panels where only the first chain view is rendered server-side
+function createSVGElement(tagName, attributes, parent) {
+  let element = document.createElementNS('http://www.w3.org/2000/svg', tagName);
+  for (let name in attributes) {
+    element.setAttribute(name, attributes[name]);
+  };
+  if (parent !== undefined) {
+    parent.appendChild(element);
+  };
+  return element;
+};
+
+
+function pointsString(points) {
+  return points.map(point => point.join(',')).join(' ');
+};
+
+
+function drawChainView(chainID) {
+  let chainData = modelData[chainID];
+  let svgID = 'iris-chain-view-' + chainID;
+  let center = [ 500, 500 ];
+  let fullRadius = 490;
+  let divisionSize = Math.round(fullRadius / (chainViewRings.length + 2) * 100) / 100;
+  let gapAngle = gapDegrees * Math.PI / 180;
+  let numSegments = chainData['aligned_length'];
+  let angleDelta = (2*Math.PI - gapAngle) / numSegments;
+  let coords = function(angle, radius, gap=true) {
+    let offset = gap ? gapAngle/2 : 0;
+    return [ Math.round((center[0] + radius * Math.sin(angle + offset)) * 10) / 10,
+             Math.round((center[1] - radius * Math.cos(angle + offset)) * 10) / 10 ];
+  };
+  let segmentPoints = function(segmentID, innerRadius, outerRadius) {
+    return [ coords(angleDelta * segmentID, innerRadius),
+             coords(angleDelta * segmentID, outerRadius),
+             coords(angleDelta * (segmentID+1), outerRadius),
+             coords(angleDelta * (segmentID+1), innerRadius) ];
+  };
+
+  // Copy the placement of the server-rendered view
+  let chainView = createSVGElement('svg', { 'id' : svgID, 'style' : 'display: none;' });
+  for (let attribute of chainViews[0].attributes) {
+    if (attribute.name !== 'id' && attribute.name !== 'style') {
+      chainView.setAttribute(attribute.name, attribute.value);
+    };
+  };
+
+  // Background
+  createSVGElement('circle', { 'cx' : center[0], 'cy' : center[1], 'r' : fullRadius, 'fill' : chainViewColors['WHITE'], 'fill-opacity' : 1, 'stroke-opacity' : 0 }, chainView);
+
+  // Data rings
+  for (var ringID = 0; ringID < chainViewRings.length; ++ringID) {
+    let metric = chainViewRings[ringID];
+    let datapoints = chainData[metric['type'] + '_values'][metric['id']];
+    let ringBaseRadius = (ringID + 2) * divisionSize;
+    createSVGElement('circle', { 'cx' : center[0], 'cy' : center[1], 'r' : ringBaseRadius, 'fill-opacity' : 0, 'stroke' : metric['ring_color'], 'stroke-width' : 1, 'stroke-opacity' : 1 }, chainView);
+    let axisPoints = [ ];
+    for (var i = 0; i < 20; ++i) {
+      axisPoints.push(coords((gapAngle/25)*(i-(20-1)/2), ringBaseRadius, false));
+    };
+    createSVGElement('polyline', { 'points' : pointsString(axisPoints), 'stroke' : metric['ring_color'], 'stroke-width' : 3, 'stroke-opacity' : 1, 'fill-opacity' : 0 }, chainView);
+    let labelPoint = coords(0, ringBaseRadius+12, false);
+    let label = createSVGElement('text', { 'x' : labelPoint[0], 'y' : labelPoint[1], 'font-size' : 16, 'font-family' : 'Arial', 'text-anchor' : 'middle', 'alignment-baseline' : 'central' }, chainView);
+    label.textContent = metric['short_name'];
+
+    if (metric['type'] === 'discrete') {
+      let seqColors = metric['seq_colors'];
+      for (var versionID = 0; versionID < datapoints.length; ++versionID) {
+        let segmentGroup = createSVGElement('g', { 'id' : svgID + '-discrete-' + versionID + '-' + ringID, 'opacity' : versionID === selectedVersion ? 1 : 0 }, chainView);
+        for (var segmentID = 0; segmentID < numSegments; ++segmentID) {
+          let datapoint = datapoints[versionID][segmentID];
+          let segmentColor = seqColors[seqColors.length-1];
+          if (datapoint !== null && 0 <= datapoint && datapoint < seqColors.length) {
+            segmentColor = seqColors[datapoint];
+          };
+          let segmentOpacity = segmentColor === seqColors[seqColors.length-1] ? 0.5 : 1;
+          createSVGElement('polyline', { 'points' : pointsString(segmentPoints(segmentID, ringBaseRadius-10, ringBaseRadius+10)), 'stroke-width' : 0, 'stroke-opacity' : 0, 'fill' : segmentColor, 'fill-opacity' : segmentOpacity }, segmentGroup);
+        };
+      };
+    } else if (metric['type'] === 'continuous') {
+      let validValues = [ ].concat(...datapoints).filter(datapoint => datapoint !== null).map(datapoint => datapoint * metric['polarity']);
+      if (validValues.length === 0) {
+        continue;
+      };
+      let ringAverage = mean(validValues);
+      let deltas = datapoints.map(versionDatapoints => versionDatapoints.map(datapoint => datapoint === null ? null : datapoint * metric['polarity'] - ringAverage));
+      let latestNegativeDeltas = deltas[deltas.length-1].filter(delta => delta !== null && delta < 0);
+      let averageNegativeDelta = latestNegativeDeltas.length > 0 ? mean(latestNegativeDeltas) : 0;
+      let magnitudes = deltas.map(versionDeltas => versionDeltas.map(delta => delta === null ? null : delta - averageNegativeDelta));
+      let validMagnitudes = [ ].concat(...magnitudes).filter(magnitude => magnitude !== null);
+      let magnitudeMin = Math.min(...validMagnitudes);
+      let magnitudeMax = Math.max(...validMagnitudes);
+
+      let linePoints = magnitudes.map(function(versionMagnitudes) {
+        let versionLinePoints = [ coords(angleDelta*0.5, ringBaseRadius) ];
+        for (var segmentID = 0; segmentID < versionMagnitudes.length; ++segmentID) {
+          let magnitude = versionMagnitudes[segmentID];
+          let plotRadius = ringBaseRadius;
+          if (magnitude !== null && magnitude > 0 && magnitudeMax !== 0) {
+            plotRadius += divisionSize * magnitude / magnitudeMax * 0.25;
+          } else if (magnitude !== null && magnitude < 0 && magnitudeMin !== 0) {
+            plotRadius += divisionSize * magnitude / magnitudeMin * -0.7;
+          };
+          versionLinePoints.push(coords(angleDelta * (segmentID + 0.5), plotRadius));
+        };
+        return versionLinePoints;
+      });
+      let baselinePoints = [ ];
+      for (var pointID = 0; pointID <= 200; ++pointID) {
+        baselinePoints.push(coords((200 - pointID) * (2*Math.PI - gapAngle) / 200, ringBaseRadius));
+      };
+      let ringLine = createSVGElement('polyline', { 'points' : pointsString(linePoints[selectedVersion].concat(baselinePoints)), 'stroke' : metric['ring_color'], 'stroke-width' : 2, 'stroke-opacity' : 1, 'fill' : metric['ring_color'], 'fill-opacity' : 0.2 }, chainView);
+      for (var versionID = 0; versionID < linePoints.length; ++versionID) {
+        createSVGElement('animate', { 'dur' : '250ms', 'begin' : 'indefinite', 'fill' : 'freeze', 'attributeName' : 'points', 'to' : pointsString(linePoints[versionID].concat(baselinePoints)), 'id' : svgID + '-animation-' + versionID + '-' + ringID }, ringLine);
+      };
+    };
+  };
+
+  // Missing-data shade
+  for (var versionID = 0; versionID < chainData['num_versions']; ++versionID) {
+    let shadeGroup = createSVGElement('g', { 'id' : svgID + '-shade-' + versionID, 'opacity' : versionID === selectedVersion ? 1 : 0 }, chainView);
+    for (var segmentID = 0; segmentID < numSegments; ++segmentID) {
+      if (!chainData['residue_validities'][versionID][segmentID]) {
+        let points = [ center, coords(angleDelta * segmentID, fullRadius+5), coords(angleDelta * (segmentID+1), fullRadius+5) ];
+        createSVGElement('polygon', { 'points' : pointsString(points), 'stroke-opacity' : 0, 'fill' : chainViewColors['L_PINK'], 'fill-opacity' : 1 }, shadeGroup);
+      };
+    };
+  };
+
+  // Outer rings
+  for (let radius of [ fullRadius-24, fullRadius-8 ]) {
+    createSVGElement('circle', { 'cx' : center[0], 'cy' : center[1], 'r' : radius, 'fill-opacity' : 0, 'stroke' : chainViewColors['BLACK'], 'stroke-width' : 1, 'stroke-opacity' : 0.5 }, chainView);
+  };
+  for (var i = 0; i <= numSegments; ++i) {
+    let start = coords(angleDelta*i, fullRadius-24);
+    let end = coords(angleDelta*i, fullRadius-8);
+    createSVGElement('line', { 'x1' : start[0], 'y1' : start[1], 'x2' : end[0], 'y2' : end[1], 'stroke' : chainViewColors['BLACK'], 'stroke-width' : 1, 'stroke-opacity' : 0.5 }, chainView);
+  };
+
+  // Segment selector
+  let centerPoint = angleDelta*0.5;
+  let selectorPoints = [ coords(centerPoint, fullRadius-16),
+                         coords(centerPoint-0.02, fullRadius-8),
+                         coords(centerPoint-0.02, fullRadius+8),
+                         coords(centerPoint+0.02, fullRadius+8),
+                         coords(centerPoint+0.02, fullRadius-8) ];
+  createSVGElement('polygon', { 'points' : pointsString(selectorPoints), 'stroke' : chainViewColors['BLACK'], 'stroke-width' : 2, 'stroke-opacity' : 1, 'fill' : chainViewColors['GREY'], 'fill-opacity' : 0.2, 'id' : svgID + '-residue-selector' }, chainView);
+
+  // Interaction segments
+  for (var segmentID = 0; segmentID < numSegments; ++segmentID) {
+    let points = [ center, coords(angleDelta * segmentID, fullRadius+5), coords(angleDelta * (segmentID+1), fullRadius+5) ];
+    createSVGElement('polygon', { 'points' : pointsString(points),
+                                  'stroke' : chainViewColors['BLACK'],
+                                  'stroke-width' : 1,
+                                  'stroke-opacity' : 0,
+                                  'fill' : chainViewColors['L_GREY'],
+                                  'fill-opacity' : 0,
+                                  'onmousedown' : 'handleSegment(1, ' + segmentID + ');',
+                                  'onmouseover' : 'handleSegment(2, ' + segmentID + ');',
+                                  'onmouseup' : 'handleSegment(3, ' + segmentID + ');',
+                                  'id' : svgID + '-interaction-segment-' + segmentID }, chainView);
+  };
+  createSVGElement('circle', { 'cx' : center[0], 'cy' : center[1], 'r' : 1.5*divisionSize, 'fill' : chainViewColors['WHITE'], 'fill-opacity' : 1, 'stroke-opacity' : 0 }, chainView);
+
+  // Center text
+  let centerTexts = [ [ 'Iris', -24, { 'font-size' : 1.5*16, 'font-weight' : 'bold' } ],
+                      [ 'Chain ' + chainData['chain_id'], 16, { 'font-size' : 16 } ] ];
+  if (chainData['has_molprobity']) {
+    centerTexts.push([ 'MolProbity', 48, { 'font-size' : 16, 'fill' : chainViewColors['L_GREY'] } ]);
+  };
+  for (let [ text, offsetY, attributes ] of centerTexts) {
+    let textElement = createSVGElement('text', Object.assign({ 'x' : center[0], 'y' : center[1] + offsetY, 'font-family' : 'Arial', 'text-anchor' : 'middle', 'alignment-baseline' : 'central' }, attributes), chainView);
+    textElement.textContent = text;
+  };
+
+  let lastChainView = chainViews.filter(view => view !== null).pop();
+  lastChainView.parentNode.insertBefore(chainView, lastChainView.nextSibling);
+  loadChainView(chainID);
+};
+
+
 //
 // Interaction functions
 //
@@ -141,11 +394,23 @@ function toggleVersion() {
   selectedVersion = (selectedVersion + 1) % modelData[selectedChain]['num_versions'];
   switchMovementAnimations[selectedVersion].beginElement();
   switchColorAnimations[selectedVersion].beginElement();
+  if (versionCounter !== null) {
+    versionCounter.textContent = (selectedVersion + 1) + '/' + modelData[selectedChain]['num_versions'];
+  };
   updateSelectedVersion();
 };
 
 
+function toggleDropdown() {
+  let isHidden = chainDropdown.style.display === 'none';
+  chainDropdown.style.display = isHidden ? '' : 'none';
+};
+
+
 function setChain(chainID) {
+  if (chainDropdown !== null) {
+    chainDropdown.style.display = 'none';
+  };
   selectedChain = chainID;
   selectedResidue = 0;
   residueSelectorDragging = false;
@@ -169,6 +434,9 @@ function handleSegment(actionID, residueID) {
 function updateSelectedVersion() {
   // Chain view
   for (var chainID = 0; chainID < numChains; ++chainID) {
+    if (chainViews[chainID] === null) {
+      continue;
+    };
     for (var versionID = 0; versionID < modelData[selectedChain]['num_versions']; ++versionID) {
       let opacity = versionID === selectedVersion ? 1 : 0;
       shadeGroups[chainID][versionID].setAttribute('opacity', opacity);
@@ -223,14 +491,19 @@ function updateSelectedVersion() {
 
 function updateSelectedChain() {
   // Chain view
+  if (chainViews[selectedChain] === null) {
+    drawChainView(selectedChain);
+  };
   for (var chainID = 0; chainID < modelData.length; ++chainID) {
-    if (chainID === selectedChain) {
-      chainViews[chainID].style.display = '';
-      chainSelectors[chainID].setAttribute('fill', chainSelectorColors[1]);
-    } else {
-      chainViews[chainID].style.display = 'none';
-      chainSelectors[chainID].setAttribute('fill', chainSelectorColors[0]);
+    let isSelected = chainID === selectedChain;
+    if (chainViews[chainID] !== null) {
+      chainViews[chainID].style.display = isSelected ? '' : 'none';
     };
+    chainSelectors[chainID].setAttribute('fill', chainSelectorColors[isSelected ? 1 : 0]);
+  };
+  if (chainDropdownSelector !== null) {
+    let isDropdownChain = selectedChain >= chainSelectorLimit;
+    chainDropdownSelector.setAttribute('fill', chainSelectorColors[isDropdownChain ? 1 : 0]);
   };
 
   updateSelectedResidue();
@@ -296,37 +569,47 @@ function updateSelectedResidue() {
 };
 
 
+function loadChainView(chainID) {
+  let chainViewID = 'iris-chain-view-' + chainID;
+  chainViews[chainID] = document.getElementById(chainViewID);
+  residueSelectors[chainID] = document.getElementById(chainViewID + '-residue-selector');
+  interactionSegmentSets[chainID] = document.querySelectorAll('[id^=' + chainViewID + '-interaction-segment-]');
+  shadeGroups[chainID] = [ ];
+  discreteGroupSets[chainID] = [ ];
+  lineAnimationSets[chainID] = [ ];
+  for (var versionID = 0; versionID < modelData[chainID]['num_versions']; ++versionID) {
+    shadeGroups[chainID].push(document.getElementById(chainViewID + '-shade-' + versionID));
+    discreteGroupSets[chainID].push(document.querySelectorAll('[id^=' + chainViewID + '-discrete-' +  versionID + '-]'));
+    lineAnimationSets[chainID].push(document.querySelectorAll('[id^=' + chainViewID + '-animation-' +  versionID + '-]'));
+  };
+};
+
+
 function loadElements() {
   // Panel
   residueSummary = document.getElementById('iris-panel-residue-summary');
-  switchMovementAnimations = [ document.getElementById('iris-panel-switch-move-animation-0'),
-                               document.getElementById('iris-panel-switch-move-animation-1') ]
-  switchColorAnimations = [ document.getElementById('iris-panel-switch-color-animation-0'),
-                            document.getElementById('iris-panel-switch-color-animation-1') ]
+  versionCounter = document.getElementById('iris-panel-version-counter');
+  for (var versionID = 0; versionID < Math.max(2, modelData[0]['num_versions']); ++versionID) {
+    switchMovementAnimations.push(document.getElementById('iris-panel-switch-move-animation-' + versionID));
+    switchColorAnimations.push(document.getElementById('iris-panel-switch-color-animation-' + versionID));
+  };
   for (var chainID = 0; chainID < modelData.length; ++chainID) {
     let chainSelector = document.getElementById('iris-panel-chain-selector-' + chainID);
     chainSelectors.push(chainSelector);
   };
+  chainDropdown = document.getElementById('iris-panel-chain-dropdown');
+  chainDropdownSelector = document.getElementById('iris-panel-chain-selector-dropdown');
 
-  // Chain view
+  // Chain view; views not rendered server-side are drawn when their chain is first selected
   for (var chainID = 0; chainID < modelData.length; ++chainID) {
-    let chainViewID = 'iris-chain-view-' + chainID;
-    let chainView = document.getElementById(chainViewID);
-    chainViews.push(chainView);
-    let residueSelector = document.getElementById(chainViewID + '-residue-selector');
-    residueSelectors.push(residueSelector);
-    let interactionSegmentSet = document.querySelectorAll('[id^=' + chainViewID + '-interaction-segment-]');
-    interactionSegmentSets.push(interactionSegmentSet);
-    shadeGroups.push([ ]);
-    discreteGroupSets.push([ ]);
-    lineAnimationSets.push([ ]);
-    for (var versionID = 0; versionID < modelData[selectedChain]['num_versions']; ++versionID) {
-      let shadeGroup = document.getElementById(chainViewID + '-shade-' + versionID);
-      shadeGroups[chainID].push(shadeGroup);
-      let discreteGroupSet = document.querySelectorAll('[id^=' + chainViewID + '-discrete-' +  versionID + '-]');
-      discreteGroupSets[chainID].push(discreteGroupSet);
-      let lineAnimationSet = document.querySelectorAll('[id^=' + chainViewID + '-animation-' +  versionID + '-]');
-      lineAnimationSets[chainID].push(lineAnimationSet);
+    chainViews.push(null);
+    residueSelectors.push(null);
+    interactionSegmentSets.push(null);
+    shadeGroups.push(null);
+    discreteGroupSets.push(null);
+    lineAnimationSets.push(null);
+    if (document.getElementById('iris-chain-view-' + chainID) !== null) {
+      loadChainView(chainID);
     };
   };
 
@@ -1,12 +1,14 @@
 import os
 import json
 import math
+from functools import lru_cache
 
-import svgwrite
 from svgwrite.animate import Animate
 
 from iris_validation.graphics.chain import ChainView
+from iris_validation.graphics.fast_chain import FastChainView, FragmentDrawing
 from iris_validation.graphics.residue import ResidueView
+from iris_validation.metrics.serialization import decode_chain_data, encode_raw_data
 from iris_validation._defs import COLORS, CHAIN_VIEW_RINGS, RESIDUE_VIEW_BOXES, RESIDUE_VIEW_BARS, CHAIN_VIEW_GAP_ANGLE
 
 
@@ -14,16 +16,38 @@ JS_PATH = os.path.join(os.path.dirname(__file__), 'js')
 JS_CONSTANTS_PATH = os.path.join(JS_PATH, 'constants.js')
 JS_INTERACTION_PATH = os.path.join(JS_PATH, 'interaction.js')
 
+CHAIN_SELECTOR_LIMIT = 12
+CHAIN_VIEW_RING_KEYS = ('id', 'type', 'short_name', 'ring_color', 'polarity', 'seq_colors')
+CHAIN_VIEW_COLOR_NAMES = ('WHITE', 'L_PINK', 'BLACK', 'GREY', 'L_GREY')
+CHAIN_VIEW_BACKENDS = { 'svgwrite' : ChainView,
+                        'string' : FastChainView }
+
+
+@lru_cache(maxsize=None)
+def _load_js_templates():
+    with open(JS_CONSTANTS_PATH, 'r', encoding='utf8') as infile:
+        js_constants = infile.read()
+    with open(JS_INTERACTION_PATH, 'r', encoding='utf8') as infile:
+        js_interation = infile.read()
+    return js_constants, js_interation
+
 
 class Panel():
-    def __init__(self, data, canvas_size=(1500, 1000)):
+    def __init__(self, data, canvas_size=(1500, 1000), lazy_chain_views=False, chain_view_backend='svgwrite'):
+        if chain_view_backend not in CHAIN_VIEW_BACKENDS:
+            raise ValueError(f'Unknown chain view backend: {chain_view_backend}')
         self.data = data
         self.canvas_size = canvas_size
+        self.lazy_chain_views = lazy_chain_views
+        self.chain_view_backend = chain_view_backend
 
         self.dwg = None
         self.javascript = None
         self.chain_views = None
         self.residue_view = None
+        self.chain_view_rings = None
+        self.residue_view_boxes = None
+        self.residue_view_bars = None
         self.num_models = self.data[0]['num_versions']
         self.chain_ids = [ chain_data['chain_id'] for chain_data in self.data ]
         self.swtich_colors = [ COLORS['VL_GREY'], COLORS['CYAN'] ]
@@ -34,34 +58,42 @@ class Panel():
         self._generate_subviews()
         self._draw()
 
-    # TODO: Make this nicer
     def _verify_chosen_metrics(self):
-        global CHAIN_VIEW_RINGS, RESIDUE_VIEW_BOXES, RESIDUE_VIEW_BARS
+        # Filter copies rather than the lists in _defs, which are shared by every panel in the process
         for metric_list in (CHAIN_VIEW_RINGS, RESIDUE_VIEW_BOXES, RESIDUE_VIEW_BARS):
             if not isinstance(metric_list, list):
                 raise ValueError('Chosen metrics in the _defs.py file must be lists')
-            for metric_index in reversed(range(len(metric_list))):
-                if (metric_list[metric_index]['is_covariance'] and not self.data[0]['has_covariance']):
-                    del metric_list[metric_index]
-                elif (metric_list[metric_index]['is_molprobity'] and not self.data[0]['has_molprobity']):
-                    del metric_list[metric_index]
-                elif (metric_list[metric_index]['is_reflections'] and not self.data[0]['has_reflections']):
-                    del metric_list[metric_index]
+        self.chain_view_rings = self._get_available_metrics(CHAIN_VIEW_RINGS)
+        self.residue_view_boxes = self._get_available_metrics(RESIDUE_VIEW_BOXES)
+        self.residue_view_bars = self._get_available_metrics(RESIDUE_VIEW_BARS)
+
+    def _get_available_metrics(self, metric_list):
+        available_metrics = [ ]
+        for metric in metric_list:
+            if (metric['is_covariance'] and not self.data[0]['has_covariance']):
+                continue
+            if (metric['is_molprobity'] and not self.data[0]['has_molprobity']):
+                continue
+            if (metric['is_reflections'] and not self.data[0]['has_reflections']):
+                continue
+            available_metrics.append(metric)
+        return available_metrics
 
     def _generate_javascript(self):
-        json_data = json.dumps(self.data)
+        # Metric values are embedded as base64 typed arrays, which interaction.js decodes on load
+        json_data = json.dumps(encode_raw_data(self.data), separators=(',', ':'))
         num_chains = len(self.chain_ids)
-        bar_metric_ids = [ metric['id'] for metric in RESIDUE_VIEW_BARS ]
-        box_metric_ids = [ metric['id'] for metric in RESIDUE_VIEW_BOXES ]
-        box_colors = json.dumps([ metric['seq_colors'] for metric in RESIDUE_VIEW_BOXES ])
-        box_labels = json.dumps([ metric['seq_labels'] for metric in RESIDUE_VIEW_BOXES ])
+        bar_metric_ids = [ metric['id'] for metric in self.residue_view_bars ]
+        box_metric_ids = [ metric['id'] for metric in self.residue_view_boxes ]
+        box_colors = json.dumps([ metric['seq_colors'] for metric in self.residue_view_boxes ])
+        box_labels = json.dumps([ metric['seq_labels'] for metric in self.residue_view_boxes ])
         gap_degrees = CHAIN_VIEW_GAP_ANGLE * 180 / math.pi
+        # Ring definitions for chain views drawn in the browser
+        chain_view_rings = json.dumps([ { key : metric[key] for key in CHAIN_VIEW_RING_KEYS if key in metric }
+                                        for metric in self.chain_view_rings ])
+        chain_view_colors = json.dumps({ name : COLORS[name] for name in CHAIN_VIEW_COLOR_NAMES })
 
-        with open(JS_CONSTANTS_PATH, 'r', encoding='utf8') as infile:
-            js_constants = infile.read()
-
-        with open(JS_INTERACTION_PATH, 'r', encoding='utf8') as infile:
-            js_interation = infile.read()
+        js_constants, js_interation = _load_js_templates()
 
         js_constants = js_constants.format(model_data=json_data,
                                            num_chains=num_chains,
@@ -70,16 +102,24 @@ class Panel():
                                            box_colors=box_colors,
                                            box_labels=box_labels,
                                            gap_degrees=gap_degrees,
-                                           chain_selector_colors=self.swtich_colors)
+                                           chain_selector_colors=self.swtich_colors,
+                                           chain_selector_limit=CHAIN_SELECTOR_LIMIT,
+                                           chain_view_rings=chain_view_rings,
+                                           chain_view_colors=chain_view_colors)
 
         self.javascript = js_constants + js_interation
 
     def _generate_subviews(self):
+        # Lazy panels only render the first chain view; interaction.js draws the others when they are first selected
+        chain_view_class = CHAIN_VIEW_BACKENDS[self.chain_view_backend]
         self.chain_views = [ ]
         for chain_index, chain_data in enumerate(self.data):
-            chain_view = ChainView(chain_data, chain_index, hidden=chain_index>0).dwg
+            if self.lazy_chain_views and chain_index > 0:
+                break
+            # Chains may be given already encoded, in which case each is decoded only while its view is drawn
+            chain_view = chain_view_class(decode_chain_data(chain_data), chain_index, hidden=chain_index>0, rings=self.chain_view_rings).dwg
             self.chain_views.append(chain_view)
-        self.residue_view = ResidueView().dwg
+        self.residue_view = ResidueView(boxes=self.residue_view_boxes, bars=self.residue_view_bars).dwg
 
     def _draw(self):
         middle_gap = 30
@@ -98,8 +138,8 @@ class Panel():
                                view_width,
                                view_height)
 
-        # Initialise drawing
-        self.dwg = svgwrite.Drawing(profile='full')
+        # Initialise drawing; chain views from the string backend are written out as they are
+        self.dwg = FragmentDrawing(profile='full')
 
         # Disable text selection
         self.dwg.attribs['style'] = 'user-select: none;'
@@ -143,36 +183,17 @@ class Panel():
                                    stroke_width=2))
 
         # Chain selector buttons
-        for chain_index, chain_id in enumerate(self.chain_ids[:12]):
-            selector_color = self.swtich_colors[1] if chain_index == 0 else self.swtich_colors[0]
-            self.dwg.add(self.dwg.rect(insert=(chain_view_bounds[0] + 75 + 50*chain_index, chain_view_bounds[1]),
-                                       size=(button_width, button_height),
-                                       rx=5,
-                                       stroke_opacity=0,
-                                       fill_opacity=0.5,
-                                       fill=selector_color,
-                                       id=f'{self.svg_id}-chain-selector-{chain_index}'))
-
-            self.dwg.add(self.dwg.text(text=chain_id,
-                                       insert=(chain_view_bounds[0] + 75 + button_width/2 + 50*chain_index, chain_view_bounds[1] + button_height/2),
-                                       font_size=view_title_font,
-                                       font_family='Arial',
-                                       text_anchor='middle',
-                                       alignment_baseline='central'))
-
-            self.dwg.add(self.dwg.rect(insert=(chain_view_bounds[0] + 75 + 50*chain_index, chain_view_bounds[1]),
-                                       size=(button_width, button_height),
-                                       rx=5,
-                                       stroke_opacity=0,
-                                       fill_opacity=0,
-                                       onmouseover='setPointer();',
-                                       onmouseout='unsetPointer();',
-                                       onclick=f'setChain({chain_index});'))
+        for chain_index, chain_id in enumerate(self.chain_ids[:CHAIN_SELECTOR_LIMIT]):
+            self._add_chain_selector(self.dwg,
+                                     chain_index,
+                                     chain_id,
+                                     (chain_view_bounds[0] + 75 + 50*chain_index, chain_view_bounds[1]),
+                                     (button_width, button_height),
+                                     view_title_font)
 
         # Extra chains dropdown
-        # TODO: finish this
-        if len(self.chain_ids) > 12:
-            chain_index = 12
+        if len(self.chain_ids) > CHAIN_SELECTOR_LIMIT:
+            chain_index = CHAIN_SELECTOR_LIMIT
             selector_color = self.swtich_colors[0]
             self.dwg.add(self.dwg.rect(insert=(chain_view_bounds[0] + 75 + 50*chain_index, chain_view_bounds[1]),
                                        size=(38, 32),
@@ -194,7 +215,7 @@ class Panel():
                                        fill_opacity=0,
                                        onmouseover='setPointer();',
                                        onmouseout='unsetPointer();',
-                                       onclick=f'toggleDropdown();'))
+                                       onclick='toggleDropdown();'))
 
         # Version toggle switch
         self.dwg.add(self.dwg.text(text='Previous',
@@ -222,13 +243,14 @@ class Panel():
                                          fill_opacity=1,
                                          fill=self.swtich_colors[1])
 
-        for version_id in range(2):
+        num_switch_positions = max(2, self.num_models)
+        for version_id in range(num_switch_positions):
             animation = Animate(values=None,
                                 dur='250ms',
                                 begin='indefinite',
                                 fill='freeze',
                                 attributeName='fill',
-                                to=self.swtich_colors[version_id],
+                                to=self.swtich_colors[int(version_id == num_switch_positions-1)],
                                 id=f'{self.svg_id}-switch-color-animation-{version_id}')
             switch_rectangle.add(animation)
 
@@ -240,19 +262,31 @@ class Panel():
                                         fill_opacity=1,
                                         fill=COLORS['WHITE'])
 
-        for version_id in range(2):
+        switch_left_x, switch_right_x = chain_view_bounds[2]-125, chain_view_bounds[2]-85
+        for version_id in range(num_switch_positions):
+            switch_x = switch_left_x + (switch_right_x - switch_left_x) * version_id / (num_switch_positions-1)
             animation = Animate(values=None,
                                 dur='250ms',
                                 begin='indefinite',
                                 fill='freeze',
                                 attributeName='cx',
-                                to=(chain_view_bounds[2]-125, chain_view_bounds[2]-85)[version_id],
+                                to=round(switch_x, 2),
                                 id=f'{self.svg_id}-switch-move-animation-{version_id}')
             switch_circle.add(animation)
 
         switch_group.add(switch_circle)
         self.dwg.add(switch_group)
 
+        # Version counter, only needed when there are intermediate versions
+        if self.num_models > 2:
+            self.dwg.add(self.dwg.text(text=f'{self.num_models}/{self.num_models}',
+                                       insert=(chain_view_bounds[2]-105, chain_view_bounds[1]+48),
+                                       font_size=14,
+                                       font_family='Arial',
+                                       text_anchor='middle',
+                                       fill=COLORS['L_GREY'],
+                                       id=f'{self.svg_id}-version-counter'))
+
         # Place sub-views
         canvas_mid_x = self.canvas_size[0] / 2
         # *** Chain view
@@ -280,3 +314,52 @@ class Panel():
         self.residue_view.attribs['x'] = str(view_adj_x)
         self.residue_view.attribs['viewBox'] = f'{width_buffer} {height_buffer} {viewbox_width} {viewbox_height}'
         self.dwg.add(self.residue_view)
+
+        # Extra chains menu, added last so that it is drawn above the views
+        if len(self.chain_ids) > CHAIN_SELECTOR_LIMIT:
+            extra_chain_ids = self.chain_ids[CHAIN_SELECTOR_LIMIT:]
+            num_rows = math.ceil(len(extra_chain_ids) / CHAIN_SELECTOR_LIMIT)
+            menu_x, menu_y = chain_view_bounds[0] + 65, chain_view_bounds[1] + button_height + 8
+            menu_group = self.dwg.g(id=f'{self.svg_id}-chain-dropdown', style='display: none;')
+            menu_group.add(self.dwg.rect(insert=(menu_x, menu_y),
+                                         size=(50*CHAIN_SELECTOR_LIMIT + 8, 40*num_rows + 8),
+                                         rx=5,
+                                         stroke=COLORS['L_GREY'],
+                                         stroke_width=1,
+                                         fill_opacity=1,
+                                         fill=COLORS['WHITE']))
+            for menu_index, chain_id in enumerate(extra_chain_ids):
+                row, column = divmod(menu_index, CHAIN_SELECTOR_LIMIT)
+                self._add_chain_selector(menu_group,
+                                         CHAIN_SELECTOR_LIMIT + menu_index,
+                                         chain_id,
+                                         (menu_x + 10 + 50*column, menu_y + 8 + 40*row),
+                                         (button_width, button_height),
+                                         view_title_font)
+            self.dwg.add(menu_group)
+
+    def _add_chain_selector(self, parent, chain_index, chain_id, insert, size, font_size):
+        selector_color = self.swtich_colors[1] if chain_index == 0 else self.swtich_colors[0]
+        parent.add(self.dwg.rect(insert=insert,
+                                 size=size,
+                                 rx=5,
+                                 stroke_opacity=0,
+                                 fill_opacity=0.5,
+                                 fill=selector_color,
+                                 id=f'{self.svg_id}-chain-selector-{chain_index}'))
+
+        parent.add(self.dwg.text(text=chain_id,
+                                 insert=(insert[0] + size[0]/2, insert[1] + size[1]/2),
+                                 font_size=font_size,
+                                 font_family='Arial',
+                                 text_anchor='middle',
+                                 alignment_baseline='central'))
+
+        parent.add(self.dwg.rect(insert=insert,
+                                 size=size,
+                                 rx=5,
+                                 stroke_opacity=0,
+                                 fill_opacity=0,
+                                 onmouseover='setPointer();',
+                                 onmouseout='unsetPointer();',
+                                 onclick=f'setChain({chain_index});'))
@@ -5,14 +5,16 @@ from iris_validation._defs import COLORS, RESIDUE_VIEW_BOXES, RESIDUE_VIEW_BARS
 
 
 class ResidueView():
-    def __init__(self, canvas_size=(400, 1000)):
+    def __init__(self, canvas_size=(400, 1000), boxes=None, bars=None):
         self.canvas_size = canvas_size
+        self.boxes = RESIDUE_VIEW_BOXES if boxes is None else boxes
+        self.bars = RESIDUE_VIEW_BARS if bars is None else bars
 
         self.dwg = None
         self.svg_id = 'iris-residue-view'
 
-        self.box_names = [ metric['short_name'] for metric in RESIDUE_VIEW_BOXES ]
-        self.bar_names = [ metric['long_name'] for metric in RESIDUE_VIEW_BARS ]
+        self.box_names = [ metric['short_name'] for metric in self.boxes ]
+        self.bar_names = [ metric['long_name'] for metric in self.bars ]
 
         # TODO: allow any number of bars
         self.bar_names = self.bar_names[:2]
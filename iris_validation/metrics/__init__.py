@@ -1,13 +1,21 @@
-from multiprocessing import Process, Queue
+import os
+import time
+import warnings
+from itertools import islice
+from multiprocessing import active_children
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 import clipper
 
 from iris_validation.utils import ONE_LETTER_CODES
+from iris_validation.metrics.atoms import AtomTable
 from iris_validation.metrics.residue import MetricsResidue
 from iris_validation.metrics.chain import MetricsChain
-from iris_validation.metrics.model import MetricsModel
+from iris_validation.metrics.model import MetricsModel, check_snapshot, create_calculators, get_reusable_chains
 from iris_validation.metrics.series import MetricsModelSeries
-from iris_validation.metrics.reflections import ReflectionsHandler
+from iris_validation.metrics.reflections import ReflectionsHandler, can_export_maps
+from iris_validation.metrics.serialization import load_raw_data, save_raw_data
+from iris_validation.metrics.results import clear_results, load_result, read_payload, result_cache_key, store_result, write_payload
 
 
 def _get_minimol_from_path(model_path):
@@ -21,29 +29,25 @@ def _get_minimol_from_path(model_path):
     return minimol
 
 
-def _get_minimol_seq_nums(minimol):
-    seq_nums = { }
-    for chain in minimol:
-        chain_id = str(chain.id()).strip()
-        seq_nums[chain_id] = [ ]
-        for residue in chain:
-            seq_num = int(residue.seqnum())
-            seq_nums[chain_id].append(seq_num)
-    return seq_nums
+def _get_parsed_model(model_path, parsed_models):
+    # parsed_models belongs to a single call, so that a path repeated within a series is only read once
+    # while nothing outlives the call
+    cache_key = os.path.abspath(model_path)
+    if cache_key not in parsed_models:
+        minimol = _get_minimol_from_path(model_path)
+        parsed_models[cache_key] = (minimol, AtomTable(minimol))
+    return parsed_models[cache_key]
 
 
-def _get_reflections_data(model_path, reflections_path, model_id=None, out_queue=None):
-    minimol = _get_minimol_from_path(model_path)
-    reflections_handler = ReflectionsHandler(reflections_path, minimol=minimol)
+def _get_reflections_data(atom_table, reflections_path, interpolation_order=0):
+    reflections_handler = ReflectionsHandler(reflections_path, atom_table=atom_table)
     resolution = reflections_handler.resolution_limit
-    density_scores = reflections_handler.calculate_all_density_scores()
+    density_scores = reflections_handler.calculate_all_density_scores(interpolation_order=interpolation_order)
     reflections_data = (resolution, density_scores)
-    if out_queue is not None:
-        out_queue.put(('reflections', model_id, reflections_data))
     return reflections_data
 
 
-def _get_molprobity_data(model_path, seq_nums, model_id=None, out_queue=None):
+def _get_molprobity_data(model_path, seq_nums):
     try:
         from mmtbx.command_line import load_model_and_data
         from mmtbx.command_line.molprobity import get_master_phil
@@ -127,9 +131,6 @@ def _get_molprobity_data(model_path, seq_nums, model_id=None, out_queue=None):
                 details_line = [ result.chain_id.strip(), result.resid.strip(), result.resname.strip(), score ]
                 molprobity_data['model_wide']['details'][category].append(details_line)
 
-    if out_queue is not None:
-        out_queue.put(('molprobity', model_id, molprobity_data))
-
     return molprobity_data
 
 
@@ -139,9 +140,7 @@ def _get_covariance_data(model_path,
                          seq_nums,
                          distpred_format='rosettanpz',
                          map_align_exe='map_align',
-                         dssp_exe='mkdssp',
-                         model_id=None,
-                         out_queue=None):
+                         dssp_exe='mkdssp'):
     try:
         from Bio.PDB import PDBParser
         from Bio.PDB.DSSP import DSSP
@@ -167,19 +166,82 @@ def _get_covariance_data(model_path,
             alignment = 0 if seq_num in figure.alignment.keys() else 1
             covariance_data[chain_id][seq_num] = (score, alignment)
 
-    if out_queue is not None:
-        out_queue.put(('covariance', model_id, covariance_data))
-
     return covariance_data
 
 
-def metrics_model_series_from_files(model_paths,
-                                    reflections_paths=None,
-                                    sequence_paths=None,
-                                    distpred_paths=None,
-                                    run_covariance=False,
-                                    run_molprobity=False,
-                                    multiprocessing=True):
+TIMEOUT_POLL_INTERVAL = 0.1
+
+# Options passed to each analysis; they also key the on-disk result cache
+COVARIANCE_OPTIONS = { 'distpred_format' : 'rosettanpz',
+                       'map_align_exe' : 'map_align',
+                       'dssp_exe' : 'mkdssp' }
+MOLPROBITY_OPTIONS = { }
+REFLECTIONS_OPTIONS = { 'interpolation_order' : 0 }
+
+
+def get_executor(executor_type='process', max_workers=None):
+    if executor_type == 'process':
+        return ProcessPoolExecutor(max_workers=max_workers)
+    if executor_type == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers)
+    raise ValueError(f'Unrecognised executor type: {executor_type}')
+
+
+def _collect_analysis_results(executor, analysis_tasks, analysis_timeout=None, max_workers=None):
+    # With a timeout, no more analyses are in flight than the pool has workers, so each one starts as it is
+    # submitted and its timeout runs from then, rather than from when it entered the pool's call queue. This
+    # assumes the pool is not busy with other work and has max_workers workers, or one per CPU if not given.
+    max_in_flight = len(analysis_tasks)
+    if analysis_timeout is not None:
+        max_in_flight = max_workers or os.cpu_count() or 1
+    results = { }
+    futures = { }
+    task_queue = iter(analysis_tasks)
+    try:
+        while True:
+            for analysis_name, model_id, function, args, options, _ in islice(task_queue, max_in_flight - len(futures)):
+                future = executor.submit(function, *args, **options)
+                futures[future] = (analysis_name, model_id, time.monotonic())
+            if len(futures) == 0:
+                break
+            wait_timeout = None if analysis_timeout is None else TIMEOUT_POLL_INTERVAL
+            done, _ = wait(futures, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                analysis_name, model_id, _ = futures.pop(future)
+                try:
+                    results[(analysis_name, model_id)] = future.result()
+                except Exception as exception:
+                    raise RuntimeError(f'The {analysis_name} analysis failed for model {model_id}') from exception
+            if analysis_timeout is not None:
+                now = time.monotonic()
+                for analysis_name, model_id, start_time in futures.values():
+                    if now - start_time > analysis_timeout:
+                        raise TimeoutError(f'The {analysis_name} analysis for model {model_id} exceeded the {analysis_timeout} s timeout')
+    finally:
+        for future in futures:
+            future.cancel()
+    return results
+
+
+def _create_owned_executor(executor_type='process', max_workers=None):
+    # The child processes that already exist are recorded, so that the pool's workers can be told apart from them
+    existing_children = set(active_children())
+    return get_executor(executor_type, max_workers), existing_children
+
+
+def _abort_executor(executor, existing_children=()):
+    # Running tasks can't be cancelled, so the worker processes of a process pool (the children started since
+    # existing_children was recorded) are terminated to stop any analysis that has hung; threads can't be
+    # killed, and a thread pool's running tasks are left to finish
+    processes = [ process for process in active_children() if process not in existing_children ]
+    for process in processes:
+        process.terminate()
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.join()
+
+
+def _get_path_lists(model_paths, reflections_paths, sequence_paths, distpred_paths):
     try:
         if isinstance(model_paths, str):
             model_paths = [ model_paths ]
@@ -196,70 +258,294 @@ def metrics_model_series_from_files(model_paths,
         if len(path_lists[i]) != len(model_paths) or \
            path_lists[i].count(None) not in (0, len(path_lists[i])):
             raise ValueError('Path arguments should be equal-length iterables of filenames')
-
-    all_minimol_data = [ ]
-    all_covariance_data = [ ]
-    all_molprobity_data = [ ]
-    all_reflections_data = [ ]
-    num_queued = 0
-    results_queue = Queue()
-    for model_id, file_paths in enumerate(zip(*path_lists)):
+    return path_lists
+
+
+def _run_analyses(path_lists,
+                  atom_tables,
+                  run_covariance=False,
+                  run_molprobity=False,
+                  multiprocessing=True,
+                  executor=None,
+                  executor_type='process',
+                  max_workers=None,
+                  analysis_timeout=None,
+                  use_cache=False):
+    # Each task also lists the files and parameters its result depends on, which key the on-disk result cache
+    analysis_tasks = [ ]
+    for model_id, (file_paths, atom_table) in enumerate(zip(zip(*path_lists), atom_tables)):
         model_path, reflections_path, sequence_path, distpred_path = file_paths
-        minimol = _get_minimol_from_path(model_path)
-        seq_nums = _get_minimol_seq_nums(minimol)
-        covariance_data = None
-        molprobity_data = None
-        reflections_data = None
+        seq_nums = atom_table.seq_nums()
         if run_covariance:
-            if multiprocessing:
-                p = Process(target=_get_covariance_data,
-                            args=(model_path, sequence_path, distpred_path, seq_nums),
-                            kwargs={ 'model_id': model_id,
-                                     'out_queue': results_queue })
-                p.start()
-                num_queued += 1
-            else:
-                covariance_data = _get_covariance_data(model_path, sequence_path, distpred_path)
+            analysis_tasks.append(('covariance', model_id, _get_covariance_data, (model_path, sequence_path, distpred_path, seq_nums),
+                                   COVARIANCE_OPTIONS, (model_path, sequence_path, distpred_path)))
         if run_molprobity:
-            if multiprocessing:
-                p = Process(target=_get_molprobity_data,
-                            args=(model_path, seq_nums),
-                            kwargs={ 'model_id': model_id,
-                                     'out_queue': results_queue })
-                p.start()
-                num_queued += 1
-            else:
-                molprobity_data = _get_molprobity_data(model_path, seq_nums)
+            analysis_tasks.append(('molprobity', model_id, _get_molprobity_data, (model_path, seq_nums), MOLPROBITY_OPTIONS, (model_path, )))
         if reflections_path is not None:
-            if multiprocessing:
-                p = Process(target=_get_reflections_data,
-                            args=(model_path, reflections_path),
-                            kwargs={ 'model_id': model_id,
-                                     'out_queue': results_queue })
-                p.start()
-                num_queued += 1
+            analysis_tasks.append(('reflections', model_id, _get_reflections_data, (atom_table, reflections_path), REFLECTIONS_OPTIONS,
+                                   (model_path, reflections_path)))
+
+    analysis_results = { }
+    cache_keys = { }
+    if use_cache:
+        uncached_tasks = [ ]
+        for analysis_task in analysis_tasks:
+            analysis_name, model_id, _, _, options, input_paths = analysis_task
+            parameters = tuple(sorted(options.items()))
+            if analysis_name == 'reflections':
+                # Maps are sampled differently when this clipper build cannot export them
+                parameters += (('map_export', can_export_maps()), )
+            cache_key = result_cache_key(analysis_name, input_paths, parameters)
+            found, payload = load_result(cache_key)
+            if found:
+                analysis_results[(analysis_name, model_id)] = payload
             else:
-                reflections_data = _get_reflections_data(model_path, reflections_path)
+                cache_keys[(analysis_name, model_id)] = cache_key
+                uncached_tasks.append(analysis_task)
+        analysis_tasks = uncached_tasks
+
+    if multiprocessing or executor is not None:
+        # An executor passed in is never shut down here; after a timeout, the hung analysis keeps running in it
+        owns_executor = executor is None
+        if owns_executor:
+            executor, existing_children = _create_owned_executor(executor_type, max_workers)
+        try:
+            analysis_results.update(_collect_analysis_results(executor, analysis_tasks, analysis_timeout, max_workers))
+        except Exception:
+            if owns_executor:
+                # Don't block on analyses that have failed or timed out
+                _abort_executor(executor, existing_children)
+            raise
+        if owns_executor:
+            executor.shutdown(wait=True)
+    else:
+        for analysis_name, model_id, function, args, options, _ in analysis_tasks:
+            analysis_results[(analysis_name, model_id)] = function(*args, **options)
+
+    # Missing results mean an analysis was unavailable or failed, and are retried on the next run
+    for result_id, cache_key in cache_keys.items():
+        if analysis_results.get(result_id) is not None:
+            store_result(cache_key, analysis_results[result_id])
+
+    num_models = len(atom_tables)
+    all_covariance_data = [ analysis_results.get(('covariance', model_id)) for model_id in range(num_models) ]
+    all_molprobity_data = [ analysis_results.get(('molprobity', model_id)) for model_id in range(num_models) ]
+    all_reflections_data = [ analysis_results.get(('reflections', model_id)) for model_id in range(num_models) ]
+    return all_covariance_data, all_molprobity_data, all_reflections_data
+
+
+def _get_model_snapshots(path_lists, run_covariance=False, run_molprobity=False, use_cache=False, reuse_models=False, snapshots=None, ramachandran_grids=False):
+    # Snapshots passed in take precedence; otherwise, when model reuse is enabled, unchanged models are found
+    # by the hash of their input files. Cached snapshots from another version of the package are ignored.
+    num_models = len(path_lists[0])
+    snapshots = [ None for _ in range(num_models) ] if snapshots is None else list(snapshots)
+    if len(snapshots) != num_models:
+        raise ValueError('Argument \'snapshots\' should have one entry, or None, per model')
+    if any(snapshot is not None and not check_snapshot(snapshot) for snapshot in snapshots):
+        raise ValueError('A model snapshot was written by a different version of iris_validation')
+    if any(snapshot is not None and snapshot['ramachandran_grids'] != ramachandran_grids for snapshot in snapshots):
+        raise ValueError('A model snapshot was scored with a different Ramachandran scoring method')
+    snapshot_keys = [ None for _ in range(num_models) ]
+    if use_cache and reuse_models:
+        for model_id, file_paths in enumerate(zip(*path_lists)):
+            if snapshots[model_id] is None:
+                input_paths = [ path for path in file_paths if path is not None ]
+                snapshot_keys[model_id] = result_cache_key('model_snapshot', input_paths, (run_covariance, run_molprobity, ramachandran_grids))
+                _, snapshot = load_result(snapshot_keys[model_id])
+                if snapshot is not None and check_snapshot(snapshot):
+                    snapshots[model_id] = snapshot
+    return snapshots, snapshot_keys
+
+
+def save_model_snapshot(metrics_model, snapshot_path):
+    write_payload(snapshot_path, metrics_model.get_snapshot())
+
+
+def load_model_snapshot(snapshot_path):
+    snapshot = read_payload(snapshot_path)
+    if not check_snapshot(snapshot):
+        raise ValueError(f'The model snapshot in {snapshot_path} was written by a different version of iris_validation')
+    return snapshot
+
 
+def metrics_model_series_from_files(model_paths,
+                                    reflections_paths=None,
+                                    sequence_paths=None,
+                                    distpred_paths=None,
+                                    run_covariance=False,
+                                    run_molprobity=False,
+                                    multiprocessing=True,
+                                    executor=None,
+                                    executor_type='process',
+                                    max_workers=None,
+                                    analysis_timeout=None,
+                                    columnar=False,
+                                    use_cache=False,
+                                    snapshots=None,
+                                    reuse_models=False,
+                                    ramachandran_grids=False):
+    # With use_cache, analysis results are stored in the on-disk result cache (see results.py for its location;
+    # clear_results() empties it). With reuse_models, unchanged chains are reused between the models of a run
+    # and, with use_cache too, scored models are cached and reused while their input files and the package are
+    # unchanged. Reused models and chains are held as column arrays, so reuse_models and snapshots require
+    # columnar. Chains are only scored in parallel with columnar, as workers return them as column arrays;
+    # without it they are scored serially, while the external analyses and alignment use the executor either
+    # way. A timeout assumes an executor passed in has max_workers workers, or one per CPU if not given. With
+    # ramachandran_grids, Ramachandran probabilities are interpolated from cached grids rather than read from clipper.
+    if not columnar and (reuse_models or snapshots is not None):
+        raise ValueError('Model snapshots and reuse_models require columnar=True')
+    path_lists = _get_path_lists(model_paths, reflections_paths, sequence_paths, distpred_paths)
+    snapshots, snapshot_keys = _get_model_snapshots(path_lists, run_covariance, run_molprobity, use_cache, reuse_models, snapshots, ramachandran_grids)
+    # Only models without a snapshot are analysed and scored
+    changed_model_ids = [ model_id for model_id, snapshot in enumerate(snapshots) if snapshot is None ]
+    # Unchanged chains within the changed models are reused from any available snapshot
+    reusable_chains = None
+    if reuse_models or len(changed_model_ids) < len(snapshots):
+        reusable_chains = get_reusable_chains([ snapshot for snapshot in snapshots if snapshot is not None ])
+
+    all_minimol_data, atom_tables = [ ], [ ]
+    parsed_models = { }
+    for model_path in path_lists[0]:
+        minimol, atom_table = _get_parsed_model(model_path, parsed_models)
         all_minimol_data.append(minimol)
-        all_covariance_data.append(covariance_data)
-        all_molprobity_data.append(molprobity_data)
-        all_reflections_data.append(reflections_data)
-
-    if multiprocessing:
-        for _ in range(num_queued):
-            result_type, model_id, result = results_queue.get()
-            if result_type == 'covariance':
-                all_covariance_data[model_id] = result
-            if result_type == 'molprobity':
-                all_molprobity_data[model_id] = result
-            elif result_type == 'reflections':
-                all_reflections_data[model_id] = result
-
-    metrics_models = [ ]
-    for model_id, model_data in enumerate(zip(all_minimol_data, all_covariance_data, all_molprobity_data, all_reflections_data)):
-        metrics_model = MetricsModel(*model_data)
-        metrics_models.append(metrics_model)
-
-    metrics_model_series = MetricsModelSeries(metrics_models)
+        atom_tables.append(atom_table)
+    del parsed_models
+
+    # The same pool runs the external analyses, then scores and aligns chains in parallel. A pool passed in is
+    # left for the caller to shut down, including any analysis still running after a timeout.
+    owns_executor = executor is None and multiprocessing
+    if owns_executor:
+        executor, existing_children = _create_owned_executor(executor_type, max_workers)
+    try:
+        changed_path_lists = [ [ paths[model_id] for model_id in changed_model_ids ] for paths in path_lists ]
+        changed_analysis_data = _run_analyses(changed_path_lists,
+                                              [ atom_tables[model_id] for model_id in changed_model_ids ],
+                                              run_covariance,
+                                              run_molprobity,
+                                              multiprocessing,
+                                              executor,
+                                              executor_type,
+                                              max_workers,
+                                              analysis_timeout,
+                                              use_cache)
+        all_analysis_data = { model_id : analysis_data for model_id, analysis_data in zip(changed_model_ids, zip(*changed_analysis_data)) }
+
+        metrics_models = [ ]
+        for model_id, minimol in enumerate(all_minimol_data):
+            if snapshots[model_id] is not None:
+                metrics_model = MetricsModel(minimol,
+                                             snapshot=snapshots[model_id],
+                                             columnar=True,
+                                             atom_table=atom_tables[model_id],
+                                             ramachandran_grids=ramachandran_grids)
+                metrics_models.append(metrics_model)
+                continue
+            covariance_data, molprobity_data, reflections_data = all_analysis_data[model_id]
+            metrics_model = MetricsModel(minimol,
+                                         covariance_data,
+                                         molprobity_data,
+                                         reflections_data,
+                                         columnar=columnar,
+                                         executor=executor if columnar else None,
+                                         reusable_chains=reusable_chains,
+                                         atom_table=atom_tables[model_id],
+                                         ramachandran_grids=ramachandran_grids)
+            metrics_models.append(metrics_model)
+            if reusable_chains is None:
+                continue
+            snapshot = metrics_model.get_snapshot()
+            reusable_chains.update(get_reusable_chains([ snapshot ]))
+            # As with analysis results, models missing a requested analysis are rescored on the next run
+            is_complete = not (run_covariance and covariance_data is None) and not (run_molprobity and molprobity_data is None)
+            if snapshot_keys[model_id] is not None and is_complete:
+                store_result(snapshot_keys[model_id], snapshot)
+
+        metrics_model_series = MetricsModelSeries(metrics_models)
+        if executor is not None:
+            metrics_model_series.align_models(executor)
+    except Exception:
+        if owns_executor:
+            # Don't block on analyses that have failed or timed out
+            _abort_executor(executor, existing_children)
+        raise
+    if owns_executor:
+        executor.shutdown(wait=True)
     return metrics_model_series
+
+
+def iter_chain_data_from_files(model_paths,
+                               reflections_paths=None,
+                               sequence_paths=None,
+                               distpred_paths=None,
+                               run_covariance=False,
+                               run_molprobity=False,
+                               multiprocessing=True,
+                               executor=None,
+                               executor_type='process',
+                               max_workers=None,
+                               analysis_timeout=None,
+                               columnar=False,
+                               use_cache=False,
+                               ramachandran_grids=False):
+    # Streaming counterpart to metrics_model_series_from_files(...).get_raw_data(). Models are kept only as
+    # compact atom tables, and each chain is scored from its atom arrays, aligned and serialised across all
+    # versions before the next one is started, so the metrics objects for only one chain are alive at once.
+    # Each full table is released once its common chains have been split off, and each chain once it is scored.
+    path_lists = _get_path_lists(model_paths, reflections_paths, sequence_paths, distpred_paths)
+
+    atom_tables = [ ]
+    parsed_models = { }
+    for model_path in path_lists[0]:
+        atom_tables.append(_get_parsed_model(model_path, parsed_models)[1])
+    del parsed_models
+
+    all_covariance_data, all_molprobity_data, all_reflections_data = _run_analyses(path_lists,
+                                                                                   atom_tables,
+                                                                                   run_covariance,
+                                                                                   run_molprobity,
+                                                                                   multiprocessing,
+                                                                                   executor,
+                                                                                   executor_type,
+                                                                                   max_workers,
+                                                                                   analysis_timeout,
+                                                                                   use_cache)
+
+    chain_id_sets = [ set(atom_table.chain_ids) for atom_table in atom_tables ]
+    common_chain_ids = set.intersection(*chain_id_sets)
+    lost_chain_ids = set.union(*chain_id_sets) - common_chain_ids
+    if len(lost_chain_ids) > 0:
+        warnings.warn(f'Some chains are not present or valid across all model versions ({sorted(lost_chain_ids)}). These chains will not be represented in the validation report.')
+
+    all_chain_tables = [ ]
+    while len(atom_tables) > 0:
+        atom_table = atom_tables.pop(0)
+        all_chain_tables.append({ chain_id : atom_table.chain_table(atom_table.chain_ids.index(chain_id)) for chain_id in common_chain_ids })
+        del atom_table
+
+    all_calculators = [ create_calculators(None if reflections_data is None else reflections_data[0], ramachandran_grids)
+                        for reflections_data in all_reflections_data ]
+
+    bad_chain_ids = set()
+    for chain_id in sorted(common_chain_ids):
+        metrics_models = [ ]
+        for model_id, chain_tables in enumerate(all_chain_tables):
+            metrics_model = MetricsModel(None,
+                                         all_covariance_data[model_id],
+                                         all_molprobity_data[model_id],
+                                         all_reflections_data[model_id],
+                                         columnar=columnar,
+                                         atom_table=chain_tables.pop(chain_id),
+                                         calculators=all_calculators[model_id])
+            metrics_models.append(metrics_model)
+        if 0 in [ metrics_model.chains[0].length for metrics_model in metrics_models ]:
+            bad_chain_ids.add(chain_id)
+            continue
+        chain_data = MetricsModelSeries(metrics_models).get_raw_data()[0]
+        del metrics_models
+        yield chain_data
+
+    if len(bad_chain_ids) > 0:
+        warnings.warn('At least one chain contains no amino acid residues. Ignoring chains: ' + ', '.join(sorted(bad_chain_ids)))
+    # As every common chain is then invalid, no chain data will have been produced
+    if any(len(chain_id_set - bad_chain_ids) == 0 for chain_id_set in chain_id_sets):
+        raise ValueError('One or more models had no valid chains')
@@ -0,0 +1,153 @@
+import clipper
+import numpy as np
+
+from iris_validation import utils
+
+
+# Compact, picklable per-atom arrays extracted from a MiniMol in a single pass
+class AtomTable():
+    def __init__(self, minimol=None):
+        self.chain_ids = [ ]
+        self.chain_offsets = None
+        self.residue_seq_nums = None
+        self.residue_types = None
+        self.residue_insertion_codes = None
+        self.residue_offsets = None
+        self.atom_ids = None
+        self.atom_names = None
+        self.elements = None
+        self.xyzs = None
+        self.u_isos = None
+        self.u_anisos = None
+        self.occupancies = None
+        self.residue_ids = None
+
+        if minimol is not None:
+            self._load_minimol(minimol)
+
+    def _load_minimol(self, minimol):
+        chain_offsets, residue_seq_nums, residue_types, residue_insertion_codes, residue_offsets = [ 0 ], [ ], [ ], [ ], [ 0 ]
+        atom_ids, atom_names, elements, xyzs, u_isos, u_anisos, occupancies = [ ], [ ], [ ], [ ], [ ], [ ], [ ]
+        for chain in minimol:
+            self.chain_ids.append(str(chain.id()).strip())
+            for residue in chain:
+                residue_seq_nums.append(int(residue.seqnum()))
+                residue_types.append(str(residue.type()).strip())
+                residue_insertion_codes.append(utils.insertion_code(residue))
+                for atom in residue:
+                    co = atom.coord_orth()
+                    u_aniso = atom.u_aniso_orth()
+                    atom_ids.append(str(atom.id()).strip())
+                    atom_names.append(str(atom.name()).strip())
+                    elements.append(str(atom.element()).strip())
+                    xyzs.append((co.x(), co.y(), co.z()))
+                    u_isos.append(atom.u_iso())
+                    if u_aniso.is_null():
+                        u_anisos.append((np.nan, ) * 6)
+                    else:
+                        u_anisos.append((u_aniso.mat00(), u_aniso.mat11(), u_aniso.mat22(),
+                                         u_aniso.mat01(), u_aniso.mat02(), u_aniso.mat12()))
+                    occupancies.append(atom.occupancy())
+                residue_offsets.append(len(atom_ids))
+            chain_offsets.append(len(residue_seq_nums))
+
+        self.chain_offsets = np.array(chain_offsets, dtype=np.int64)
+        self.residue_seq_nums = np.array(residue_seq_nums, dtype=np.int64)
+        self.residue_types = np.array(residue_types, dtype=str)
+        self.residue_insertion_codes = np.array(residue_insertion_codes, dtype=str)
+        self.residue_offsets = np.array(residue_offsets, dtype=np.int64)
+        self.atom_ids = np.array(atom_ids, dtype=str)
+        self.atom_names = np.array(atom_names, dtype=str)
+        self.elements = np.array(elements, dtype=str)
+        self.xyzs = np.array(xyzs, dtype=np.float64).reshape(-1, 3)
+        self.u_isos = np.array(u_isos, dtype=np.float64)
+        self.u_anisos = np.array(u_anisos, dtype=np.float64).reshape(-1, 6)
+        self.occupancies = np.array(occupancies, dtype=np.float64)
+        self.residue_ids = np.repeat(np.arange(len(residue_seq_nums)), np.diff(self.residue_offsets))
+
+    def seq_nums(self):
+        seq_nums = { }
+        for chain_index, chain_id in enumerate(self.chain_ids):
+            start, end = self.chain_offsets[chain_index], self.chain_offsets[chain_index+1]
+            seq_nums[chain_id] = self.residue_seq_nums[start:end].tolist()
+        return seq_nums
+
+    def residue_keys(self):
+        residue_keys = [ ]
+        for chain_index, chain_id in enumerate(self.chain_ids):
+            start, end = self.chain_offsets[chain_index], self.chain_offsets[chain_index+1]
+            residue_keys += [ (chain_id, seq_num) for seq_num in self.residue_seq_nums[start:end].tolist() ]
+        return residue_keys
+
+    def atomic_numbers(self):
+        return np.array([ utils.ATOMIC_NUMBERS[element] for element in self.elements.tolist() ], dtype=np.float64)
+
+    def mainchain_mask(self):
+        return np.isin(self.atom_names, list(utils.MC_ATOM_NAMES))
+
+    def residue_atom_indices(self, chain_index):
+        # Per-residue atom lookups for one chain, built from the arrays alone so that no clipper model is needed
+        b_factors = [ clipper.Util_u2b(u_iso) for u_iso in self.u_isos.tolist() ]
+        atom_ids, xyzs = self.atom_ids.tolist(), self.xyzs.tolist()
+        atom_indices = [ ]
+        for residue_index in range(self.chain_offsets[chain_index], self.chain_offsets[chain_index+1]):
+            start, end = self.residue_offsets[residue_index], self.residue_offsets[residue_index+1]
+            atom_indices.append(utils.ResidueAtomIndex(str(self.residue_types[residue_index]),
+                                                       atom_ids[start:end],
+                                                       [ tuple(xyz) for xyz in xyzs[start:end] ],
+                                                       b_factors[start:end],
+                                                       seq_num=int(self.residue_seq_nums[residue_index]),
+                                                       insertion_code=str(self.residue_insertion_codes[residue_index])))
+        return atom_indices
+
+    def chain_table(self, chain_index):
+        # Standalone copy of a single chain, so that the full table can be released
+        residue_start, residue_end = self.chain_offsets[chain_index], self.chain_offsets[chain_index+1]
+        atom_start, atom_end = self.residue_offsets[residue_start], self.residue_offsets[residue_end]
+        chain_table = AtomTable()
+        chain_table.chain_ids = [ self.chain_ids[chain_index] ]
+        chain_table.chain_offsets = np.array([ 0, residue_end - residue_start ], dtype=np.int64)
+        chain_table.residue_seq_nums = self.residue_seq_nums[residue_start:residue_end].copy()
+        chain_table.residue_types = self.residue_types[residue_start:residue_end].copy()
+        chain_table.residue_insertion_codes = self.residue_insertion_codes[residue_start:residue_end].copy()
+        chain_table.residue_offsets = self.residue_offsets[residue_start:residue_end+1] - atom_start
+        for attribute in ('atom_ids', 'atom_names', 'elements', 'xyzs', 'u_isos', 'u_anisos', 'occupancies'):
+            setattr(chain_table, attribute, getattr(self, attribute)[atom_start:atom_end].copy())
+        chain_table.residue_ids = self.residue_ids[atom_start:atom_end] - residue_start
+        return chain_table
+
+    def _to_atom(self, atom_index):
+        atom = clipper.Atom()
+        atom.set_element(str(self.elements[atom_index]))
+        atom.set_coord_orth(clipper.Coord_orth(*self.xyzs[atom_index]))
+        atom.set_occupancy(float(self.occupancies[atom_index]))
+        atom.set_u_iso(float(self.u_isos[atom_index]))
+        u_aniso = self.u_anisos[atom_index]
+        if np.isnan(u_aniso[0]):
+            atom.set_u_aniso_orth(clipper.U_aniso_orth.null())
+        else:
+            atom.set_u_aniso_orth(clipper.U_aniso_orth(*u_aniso))
+        return atom
+
+    def to_atom_list(self):
+        atom_list = clipper.Atom_list()
+        for atom_index in range(len(self.atom_ids)):
+            atom_list.push_back(self._to_atom(atom_index))
+        return atom_list
+
+    def to_minimol(self):
+        minimol = clipper.MiniMol()
+        for chain_index, chain_id in enumerate(self.chain_ids):
+            mmol_chain = clipper.MPolymer()
+            mmol_chain.set_id(chain_id)
+            for residue_index in range(self.chain_offsets[chain_index], self.chain_offsets[chain_index+1]):
+                mmol_residue = clipper.MMonomer()
+                mmol_residue.set_seqnum(int(self.residue_seq_nums[residue_index]), str(self.residue_insertion_codes[residue_index]))
+                mmol_residue.set_type(str(self.residue_types[residue_index]))
+                for atom_index in range(self.residue_offsets[residue_index], self.residue_offsets[residue_index+1]):
+                    mmol_atom = clipper.MAtom(self._to_atom(atom_index))
+                    mmol_atom.set_id(str(self.atom_ids[atom_index]))
+                    mmol_residue.insert(mmol_atom)
+                mmol_chain.insert(mmol_residue)
+            minimol.insert(mmol_chain)
+        return minimol
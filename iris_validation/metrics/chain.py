@@ -1,61 +1,152 @@
-from iris_validation.metrics.residue import MetricsResidue
+from copy import copy
+from math import isnan
+
+from iris_validation import utils
+from iris_validation.metrics.residue import MetricsResidue, CONTINUOUS_METRIC_ATTRIBUTES
+from iris_validation.metrics.columnar import pack_residues
 
 
 class MetricsChain():
-    def __init__(self, mmol_chain, parent_model=None, covariance_data=None, molprobity_data=None, density_scores=None):
+    def __init__(self, mmol_chain, parent_model=None, covariance_data=None, molprobity_data=None, density_scores=None, aa_only=False, chain_table=None):
+        # Given a single-chain AtomTable in place of mmol_chain, residues are scored from its arrays alone
         self.minimol_chain = mmol_chain
         self.parent_model = parent_model
         self.covariance_data = covariance_data
         self.molprobity_data = molprobity_data
         self.density_scores = density_scores
 
-        self._index = -1
         self.residues = [ ]
-        self.length = len(mmol_chain)
-        self.chain_id = str(mmol_chain.id().trim())
+        self._residues_by_id = None
+        self._residues_by_seq_num = None
+        # (avg_b_factor, is_water, num_atoms) for non-amino-acid residues skipped when aa_only is set
+        self.skipped_residue_b_factors = [ ]
+        # Hash of the chain's atoms and analysis data, set when it is scored for reuse by later models
+        self.content_key = None
+
+        # Residues are classified cheaply up front, so that with aa_only only amino acids get the full metric pipeline
+        if chain_table is None:
+            self.chain_id = str(mmol_chain.id().trim())
+            mmol_residues = list(mmol_chain)
+            atom_indices = [ utils.index_atoms(mmol_residue) for mmol_residue in mmol_residues ]
+        else:
+            self.chain_id = chain_table.chain_ids[0]
+            atom_indices = chain_table.residue_atom_indices(0)
+            mmol_residues = [ None for _ in atom_indices ]
+        self.length = len(atom_indices)
+        chain_torsions = list(zip(*utils.calculate_chain_torsions(atom_indices)))
+        seq_nums = [ atom_index.seq_num for atom_index in atom_indices ]
+        is_aas = [ utils.check_is_aa(None, atom_index=atom_index) for atom_index in atom_indices ]
 
-        for residue_index, mmol_residue in enumerate(mmol_chain):
-            previous_residue = mmol_chain[residue_index-1] if residue_index > 0 else None
-            next_residue = mmol_chain[residue_index+1] if residue_index < len(mmol_chain)-1 else None
-            seq_num = int(mmol_residue.seqnum())
+        for residue_index, mmol_residue in enumerate(mmol_residues):
+            atom_index = atom_indices[residue_index]
+            if aa_only and not is_aas[residue_index]:
+                avg_b_factor = utils.analyse_b_factors(None, False, None, atom_index)[1]
+                self.skipped_residue_b_factors.append((avg_b_factor, atom_index.code == 'HOH', len(atom_index.atom_ids)))
+                continue
+            previous_residue = mmol_residues[residue_index-1] if residue_index > 0 else None
+            next_residue = mmol_residues[residue_index+1] if residue_index < len(mmol_residues)-1 else None
+            seq_num = seq_nums[residue_index]
             residue_covariance_data = None if covariance_data is None else covariance_data[seq_num]
             residue_molprobity_data = None if molprobity_data is None else molprobity_data[seq_num]
             residue_density_scores = None if density_scores is None else density_scores[seq_num]
-            residue = MetricsResidue(mmol_residue, residue_index, previous_residue, next_residue, self, residue_covariance_data, residue_molprobity_data, residue_density_scores)
+            residue = MetricsResidue(mmol_residue, residue_index, previous_residue, next_residue, self, residue_covariance_data, residue_molprobity_data, residue_density_scores, atom_index, chain_torsions[residue_index])
+            residue.is_consecutive_aa = (0 < residue_index < len(mmol_residues)-1) and \
+                                        (is_aas[residue_index-1] and is_aas[residue_index] and is_aas[residue_index+1]) and \
+                                        (seq_nums[residue_index-1]+1 == seq_num == seq_nums[residue_index+1]-1)
             self.residues.append(residue)
+        self.length = len(self.residues)
 
-        for residue_index, residue in enumerate(self.residues):
-            if (0 < residue_index < len(self.residues)-1) and \
-               (self.residues[residue_index-1].is_aa and residue.is_aa and self.residues[residue_index+1].is_aa) and \
-               (self.residues[residue_index-1].sequence_number+1 == residue.sequence_number == self.residues[residue_index+1].sequence_number-1):
-                residue.is_consecutive_aa = True
+        self._calculate_ramachandran_scores()
+        self._calculate_rotamers()
+        for residue in self.residues:
+            residue.calculate_discrete_indicators()
+        self._calculate_percentiles()
+
+    def _calculate_ramachandran_scores(self):
+        ramachandran_calculator = self.parent_model.ramachandran_calculator
+        codes = [ residue.code for residue in self.residues ]
+        phis = [ residue.phi for residue in self.residues ]
+        psis = [ residue.psi for residue in self.residues ]
+        ramachandran_scores = ramachandran_calculator.get_scores(codes, phis, psis)
+        ramachandran_flags = zip(*[ flags.tolist() for flags in ramachandran_calculator.get_flags(ramachandran_scores) ])
+        for residue, ramachandran_score, flags in zip(self.residues, ramachandran_scores.tolist(), ramachandran_flags):
+            if isnan(ramachandran_score):
+                residue.set_ramachandran_data(None, (None, None, None))
             else:
-                residue.is_consecutive_aa = False
+                residue.set_ramachandran_data(ramachandran_score, flags)
+
+    def _calculate_rotamers(self):
+        rotamer_calculator = self.parent_model.rotamer_calculator
+        residues_by_code = { }
+        for residue in self.residues:
+            if residue.is_sidechain_complete:
+                residues_by_code.setdefault(residue.code, [ ]).append(residue)
+        for code, residues in residues_by_code.items():
+            chis = [ residue.chis for residue in residues ]
+            rotamer_scores = rotamer_calculator.get_cv_scores(code, chis)
+            rotamer_clf_ids = rotamer_calculator.get_classifications(code, chis)
+            rotamer_scores = [ None ] * len(residues) if rotamer_scores is None else rotamer_scores.tolist()
+            rotamer_clf_ids = [ None ] * len(residues) if rotamer_clf_ids is None else rotamer_clf_ids.tolist()
+            for residue, rotamer_score, rotamer_clf_id in zip(residues, rotamer_scores, rotamer_clf_ids):
+                residue.set_rotamer_data(rotamer_score, rotamer_clf_id)
+
+    def _calculate_percentiles(self):
+        percentile_calculator = self.parent_model.percentile_calculator
+        for metric_id, attribute in enumerate(CONTINUOUS_METRIC_ATTRIBUTES):
+            metric_values = [ getattr(residue, attribute) for residue in self.residues ]
+            percentiles = percentile_calculator.get_percentiles(metric_id, metric_values)
+            for residue, percentile in zip(self.residues, percentiles):
+                setattr(residue, attribute + '_percentile', percentile)
+
+    def detached_copy(self):
+        # Residue-free copy without clipper objects or a parent model, which can be pickled and reattached
+        chain = copy(self)
+        chain.minimol_chain = None
+        chain.parent_model = None
+        chain.set_residues([ ])
+        return chain
 
     def __iter__(self):
-        return self
+        return iter(self.residues)
+
+    def _build_residue_index(self):
+        self._residues_by_id = { }
+        self._residues_by_seq_num = { }
+        for residue in self.residues:
+            self._residues_by_id.setdefault((residue.sequence_number, residue.insertion_code), residue)
+            self._residues_by_seq_num.setdefault(residue.sequence_number, residue)
 
-    def __next__(self):
-        if self._index < self.length-1:
-            self._index += 1
-            return self.residues[self._index]
-        self._index = -1
-        raise StopIteration
+    def get_residue(self, sequence_number, insertion_code=None):
+        if self._residues_by_id is None:
+            self._build_residue_index()
+        if insertion_code is None:
+            return self._residues_by_seq_num[sequence_number]
+        return self._residues_by_id[(sequence_number, insertion_code)]
 
-    def get_residue(self, sequence_number):
-        return next(residue for residue in self.residues if residue.sequence_number == sequence_number)
+    def set_residues(self, residues):
+        self.residues = residues
+        self.length = len(residues)
+        self._residues_by_id = None
+        self._residues_by_seq_num = None
 
     def remove_residue(self, residue):
         if residue in self.residues:
-            self.residues.remove(residue)
-            self.length -= 1
+            self.remove_residues([ residue ])
         else:
             print('Error removing residue, no matching residue was found.')
 
+    def remove_residues(self, residues):
+        removed_ids = set(id(residue) for residue in residues)
+        self.set_residues([ residue for residue in self.residues if id(residue) not in removed_ids ])
+
     def remove_non_aa_residues(self):
-        non_aa_residues = [ residue for residue in self.residues if not residue.is_aa ]
-        for residue in non_aa_residues:
-            self.remove_residue(residue)
+        self.set_residues([ residue for residue in self.residues if residue.is_aa ])
+
+    def get_residue_data(self):
+        if self.parent_model is None or self.parent_model.residue_data is None:
+            return pack_residues(self.residues)
+        rows = [ residue.row for residue in self.residues ]
+        return self.parent_model.residue_data[rows]
 
     def b_factor_lists(self):
         all_bfs, aa_bfs, mc_bfs, sc_bfs, non_aa_bfs, water_bfs, ligand_bfs, ion_bfs = [ [ ] for _ in range(8) ]
@@ -70,8 +161,17 @@ class MetricsChain():
                 if residue.is_water:
                     water_bfs.append(residue.avg_b_factor)
                 # Followed to be consistent with the original CCP4 i2 validation tool:
-                elif len(residue.atoms) > 1:
+                elif residue.num_atoms > 1:
                     ligand_bfs.append(residue.avg_b_factor)
                 else:
                     ion_bfs.append(residue.avg_b_factor)
+        for avg_b_factor, is_water, num_atoms in self.skipped_residue_b_factors:
+            all_bfs.append(avg_b_factor)
+            non_aa_bfs.append(avg_b_factor)
+            if is_water:
+                water_bfs.append(avg_b_factor)
+            elif num_atoms > 1:
+                ligand_bfs.append(avg_b_factor)
+            else:
+                ion_bfs.append(avg_b_factor)
         return all_bfs, aa_bfs, mc_bfs, sc_bfs, non_aa_bfs, water_bfs, ligand_bfs, ion_bfs
@@ -0,0 +1,145 @@
+from math import isnan
+
+import numpy as np
+
+
+# Missing values are stored as NaN in float columns and -1 in small integer columns
+FLOAT_COLUMNS = ('max_b_factor',
+                 'avg_b_factor',
+                 'std_b_factor',
+                 'mc_b_factor',
+                 'sc_b_factor',
+                 'phi',
+                 'psi',
+                 'omega',
+                 'ramachandran_score',
+                 'rotamer_score',
+                 'covariance_score',
+                 'fit_score',
+                 'mainchain_fit_score',
+                 'sidechain_fit_score')
+
+FLAG_COLUMNS = ('is_consecutive_aa',
+                'backbone_atoms_are_correct',
+                'backbone_geometry_is_correct',
+                'ramachandran_favoured',
+                'ramachandran_allowed',
+                'ramachandran_outlier',
+                'rotamer_favoured',
+                'rotamer_allowed',
+                'rotamer_outlier')
+
+BOOL_COLUMNS = ('is_aa',
+                'is_water',
+                'is_sidechain_complete',
+                'has_molprobity_data')
+
+PERCENTILE_COLUMNS = ('avg_b_factor_percentile',
+                      'max_b_factor_percentile',
+                      'std_b_factor_percentile',
+                      'fit_score_percentile',
+                      'mainchain_fit_score_percentile',
+                      'sidechain_fit_score_percentile',
+                      'covariance_score_percentile')
+
+DISCRETE_INDICATOR_KEYS = ('clash',
+                           'c-beta',
+                           'nqh_flips',
+                           'omega',
+                           'ramachandran',
+                           'rotamer',
+                           'cmo')
+
+MAX_CHIS = 5
+
+RESIDUE_DTYPE = np.dtype([ ('sequence_number', np.int64),
+                           ('insertion_code', 'U4'),
+                           ('index_in_chain', np.int64),
+                           ('code', 'U5'),
+                           ('code_type', np.int8),
+                           ('num_atoms', np.int32),
+                           ('num_chis', np.int8),
+                           ('chis', np.float64, (MAX_CHIS, )) ] +
+                         [ (name, np.float64) for name in FLOAT_COLUMNS ] +
+                         [ (name, np.int8) for name in FLAG_COLUMNS ] +
+                         [ (name, np.bool_) for name in BOOL_COLUMNS ] +
+                         [ (name, np.int8) for name in PERCENTILE_COLUMNS ] +
+                         [ ('discrete_' + key.replace('-', '_'), np.int8) for key in DISCRETE_INDICATOR_KEYS ])
+
+
+def _to_flag(value):
+    return -1 if value is None else int(value)
+
+
+def _from_flag(value):
+    return None if value < 0 else value
+
+
+def pack_residues(residues):
+    residue_data = np.zeros(len(residues), dtype=RESIDUE_DTYPE)
+    for row, residue in enumerate(residues):
+        record = residue_data[row]
+        record['sequence_number'] = residue.sequence_number
+        record['insertion_code'] = residue.insertion_code
+        record['index_in_chain'] = -1 if residue.index_in_chain is None else residue.index_in_chain
+        record['code'] = residue.code
+        record['code_type'] = _to_flag(residue.code_type)
+        record['num_atoms'] = residue.num_atoms
+        record['num_chis'] = -1 if residue.chis is None else len(residue.chis)
+        record['chis'] = np.nan
+        if residue.chis is not None:
+            for chi_id, chi in enumerate(residue.chis[:MAX_CHIS]):
+                record['chis'][chi_id] = np.nan if chi is None else chi
+        for name in FLOAT_COLUMNS:
+            value = getattr(residue, name)
+            record[name] = np.nan if value is None else value
+        for name in FLAG_COLUMNS + PERCENTILE_COLUMNS:
+            record[name] = _to_flag(getattr(residue, name))
+        for name in BOOL_COLUMNS[:-1]:
+            record[name] = bool(getattr(residue, name))
+        record['has_molprobity_data'] = residue.molprobity_data is not None
+        for key in DISCRETE_INDICATOR_KEYS:
+            record['discrete_' + key.replace('-', '_')] = _to_flag(residue.discrete_indicators.get(key))
+    return residue_data
+
+
+# Lightweight stand-in for MetricsResidue, reading its values from one row of a model's residue array
+class MetricsResidueView():
+    __slots__ = ('residue_data', 'row', 'parent_chain')
+
+    def __init__(self, residue_data, row, parent_chain=None):
+        self.residue_data = residue_data
+        self.row = row
+        self.parent_chain = parent_chain
+
+    def __getattr__(self, name):
+        if name in RESIDUE_DTYPE.names:
+            value = self.residue_data[name][self.row]
+        elif name in ('ramachandran_flags', 'rotamer_flags'):
+            prefix = name[:-len('flags')]
+            return tuple(getattr(self, prefix + suffix) for suffix in ('favoured', 'allowed', 'outlier'))
+        elif name == 'discrete_indicators':
+            # The MolProbity-free indicators have no NQH flip category
+            keys = DISCRETE_INDICATOR_KEYS if self.has_molprobity_data else tuple(key for key in DISCRETE_INDICATOR_KEYS if key != 'nqh_flips')
+            return { key : _from_flag(int(self.residue_data['discrete_' + key.replace('-', '_')][self.row])) for key in keys }
+        elif name == 'cmo_string':
+            return self.discrete_indicators['cmo']
+        else:
+            raise AttributeError(f'\'{type(self).__name__}\' object has no attribute \'{name}\'')
+
+        if name in FLOAT_COLUMNS:
+            value = float(value)
+            return None if isnan(value) else value
+        if name in FLAG_COLUMNS:
+            return None if value < 0 else bool(value)
+        if name in PERCENTILE_COLUMNS:
+            return _from_flag(int(value))
+        if name in ('index_in_chain', 'code_type'):
+            return _from_flag(int(value))
+        if name == 'chis':
+            num_chis = int(self.residue_data['num_chis'][self.row])
+            if num_chis < 0:
+                return None
+            return tuple(None if isnan(chi) else chi for chi in value[:num_chis].tolist())
+        return value.item()
+
@@ -1,56 +1,193 @@
+import pickle
+import hashlib
+from concurrent.futures import Future
+from copy import copy
+
+import numpy as np
+
+from iris_validation.metrics.atoms import AtomTable
 from iris_validation.metrics.chain import MetricsChain
+from iris_validation.metrics.columnar import MetricsResidueView, pack_residues
 from iris_validation.metrics.rotamer import RotamerCalculator
+from iris_validation.metrics.ramachandran import RamachandranCalculator
 from iris_validation.metrics.percentiles import PercentileCalculator
+from iris_validation.metrics.results import get_code_version
+
+
+# Bumped whenever the layout of snapshot payloads changes
+SNAPSHOT_FORMAT_VERSION = 2
 
 
 class MetricsModel():
-    def __init__(self, mmol_model, covariance_data=None, molprobity_data=None, reflections_data=None):
+    def __init__(self, mmol_model, covariance_data=None, molprobity_data=None, reflections_data=None, columnar=False, executor=None, snapshot=None, reusable_chains=None, atom_table=None, ramachandran_grids=False, calculators=None):
+        # Chains scored in workers, reused or restored from a snapshot are held as column arrays, so these options need columnar.
+        # An atom_table already extracted from mmol_model is reused rather than rebuilt; given one with mmol_model set to None,
+        # chains are scored from its arrays alone. Calculators from create_calculators can be shared between models.
+        if not columnar and (executor is not None or snapshot is not None or reusable_chains is not None):
+            raise ValueError('Scoring chains in an executor, reusing chains or restoring a snapshot requires columnar=True')
+        if snapshot is not None:
+            if not check_snapshot(snapshot):
+                raise ValueError('The model snapshot was written by a different version of iris_validation')
+            if snapshot['ramachandran_grids'] != ramachandran_grids:
+                raise ValueError('The model snapshot was scored with a different Ramachandran scoring method')
+            covariance_data, molprobity_data, reflections_data = snapshot['covariance_data'], snapshot['molprobity_data'], snapshot['reflections_data']
         self.minimol_model = mmol_model
         self.covariance_data = covariance_data
         self.molprobity_data = molprobity_data
         self.reflections_data = reflections_data
+        self.atom_table = atom_table
+        self.columnar = columnar
+        self.residue_data = None
+        self.chain_offsets = None
 
-        self._index = -1
-        self.minimol_chains = list(mmol_model.model())
-        self.chain_count = len(self.minimol_chains)
+        self.minimol_chains = [ ] if mmol_model is None else list(mmol_model.model())
+        self.chain_count = len(atom_table.chain_ids) if mmol_model is None else len(self.minimol_chains)
 
         self.resolution, self.density_scores = None, None
         if reflections_data is not None:
             self.resolution, self.density_scores = reflections_data
-        self.percentile_calculator = PercentileCalculator(self.resolution)
-        self.rotamer_calculator = RotamerCalculator()
+        if calculators is None:
+            calculators = create_calculators(self.resolution, ramachandran_grids)
+        self.percentile_calculator, self.rotamer_calculator, self.ramachandran_calculator = calculators
+        self.ramachandran_grids = self.ramachandran_calculator.use_grids
 
         self.chains = [ ]
-        for mmol_chain in mmol_model:
-            chain_id = str(mmol_chain.id().trim())
-            chain_covariance_data = None if covariance_data is None else covariance_data[chain_id]
-            chain_molprobity_data = None if molprobity_data is None else molprobity_data[chain_id]
-            chain_density_scores = None if self.density_scores is None else self.density_scores[chain_id]
-            chain = MetricsChain(mmol_chain, self, chain_covariance_data, chain_molprobity_data, chain_density_scores)
-            chain.remove_non_aa_residues()
+        self._chains_by_id = None
+        if snapshot is not None:
+            self._attach_chains(snapshot['chains'], snapshot['residue_data'])
+            return
+        if executor is not None or reusable_chains is not None:
+            self._calculate_chains_incrementally(executor, reusable_chains)
+            return
+
+        residue_data_chunks = [ ]
+        for chain_index in range(self.chain_count):
+            if mmol_model is None:
+                chain_table = atom_table.chain_table(chain_index)
+                chain = MetricsChain(None, self, *self._get_chain_analysis_data(chain_table.chain_ids[0]), aa_only=True, chain_table=chain_table)
+            else:
+                mmol_chain = self.minimol_chains[chain_index]
+                chain_id = str(mmol_chain.id().trim())
+                chain = MetricsChain(mmol_chain, self, *self._get_chain_analysis_data(chain_id), aa_only=True)
+            if columnar:
+                # Release the per-residue objects as soon as each chain has been packed
+                residue_data_chunks.append(pack_residues(chain.residues))
+                chain.set_residues([ ])
+            self.chains.append(chain)
+
+        if columnar:
+            self._build_residue_views(residue_data_chunks)
+
+    def _get_chain_analysis_data(self, chain_id):
+        chain_covariance_data = None if self.covariance_data is None else self.covariance_data[chain_id]
+        chain_molprobity_data = None if self.molprobity_data is None else self.molprobity_data[chain_id]
+        chain_density_scores = None if self.density_scores is None else self.density_scores[chain_id]
+        return chain_covariance_data, chain_molprobity_data, chain_density_scores
+
+    def _calculate_chains_incrementally(self, executor=None, reusable_chains=None):
+        # Chains whose atoms and analysis data match a previously scored chain are reused as they are. The
+        # rest are scored in workers when an executor is given, each receiving one chain's atom arrays and
+        # only its own slice of the analysis data.
+        atom_table = self._get_atom_table()
+        chain_results = [ ]
+        for chain_index, (chain_id, mmol_chain) in enumerate(zip(atom_table.chain_ids, self.minimol_chains)):
+            chain_table = atom_table.chain_table(chain_index)
+            chain_covariance_data, chain_molprobity_data, chain_density_scores = self._get_chain_analysis_data(chain_id)
+            content_key = self._get_chain_content_key(chain_table)
+            if reusable_chains is not None and content_key in reusable_chains:
+                chain_results.append((content_key, reusable_chains[content_key]))
+            elif executor is not None:
+                future = executor.submit(_calculate_chain_data,
+                                         chain_table,
+                                         None if chain_covariance_data is None else { chain_id : chain_covariance_data },
+                                         None if chain_molprobity_data is None else { chain_id : chain_molprobity_data },
+                                         None if chain_density_scores is None else (self.resolution, { chain_id : chain_density_scores }),
+                                         self.ramachandran_grids)
+                chain_results.append((content_key, future))
+            else:
+                chain = MetricsChain(mmol_chain, self, chain_covariance_data, chain_molprobity_data, chain_density_scores, aa_only=True)
+                chain_results.append((content_key, (chain.detached_copy(), chain.get_residue_data())))
+
+        chains, residue_data_chunks = [ ], [ ]
+        for content_key, chain_result in chain_results:
+            chain, residue_data = chain_result.result() if isinstance(chain_result, Future) else chain_result
+            chain = copy(chain)
+            chain.content_key = content_key
+            chains.append(chain)
+            residue_data_chunks.append(residue_data)
+        self._attach_chains(chains, residue_data_chunks)
+
+    def _attach_chains(self, chains, residue_data_chunks):
+        minimol_chains_by_id = { str(mmol_chain.id().trim()) : mmol_chain for mmol_chain in self.minimol_chains }
+        for chain in chains:
+            chain = copy(chain)
+            chain.minimol_chain = minimol_chains_by_id.get(chain.chain_id)
+            chain.parent_model = self
             self.chains.append(chain)
+        self._build_residue_views(residue_data_chunks)
+
+    def _get_atom_table(self):
+        if self.atom_table is None:
+            self.atom_table = AtomTable(self.minimol_model)
+        return self.atom_table
+
+    def _get_chain_content_key(self, chain_table):
+        chain_analysis_data = (self.resolution, self.ramachandran_grids) + self._get_chain_analysis_data(chain_table.chain_ids[0])
+        return _chain_content_key(chain_table, chain_analysis_data)
+
+    def get_snapshot(self):
+        # Picklable record of the scored chains and analysis data, restored with MetricsModel(mmol_model, snapshot=...)
+        chains = [ chain.detached_copy() for chain in self.chains ]
+        if any(chain.content_key is None for chain in chains):
+            atom_table = self._get_atom_table()
+            content_keys = { }
+            for chain_index, chain_id in enumerate(atom_table.chain_ids):
+                content_keys.setdefault(chain_id, self._get_chain_content_key(atom_table.chain_table(chain_index)))
+            for chain in chains:
+                chain.content_key = content_keys.get(chain.chain_id)
+        return { 'format_version' : SNAPSHOT_FORMAT_VERSION,
+                 'code_version' : get_code_version(),
+                 'ramachandran_grids' : self.ramachandran_grids,
+                 'chains' : chains,
+                 'residue_data' : [ chain.get_residue_data() for chain in self.chains ],
+                 'covariance_data' : self.covariance_data,
+                 'molprobity_data' : self.molprobity_data,
+                 'reflections_data' : self.reflections_data }
+
+    def _build_residue_views(self, residue_data_chunks):
+        chain_lengths = [ len(chunk) for chunk in residue_data_chunks ]
+        self.chain_offsets = np.cumsum([ 0 ] + chain_lengths)
+        self.residue_data = np.concatenate(residue_data_chunks) if len(residue_data_chunks) > 0 else pack_residues([ ])
+        for chain, start, end in zip(self.chains, self.chain_offsets[:-1], self.chain_offsets[1:]):
+            chain.set_residues([ MetricsResidueView(self.residue_data, row, chain) for row in range(start, end) ])
 
     def __iter__(self):
-        return self
+        return iter(self.chains)
 
-    def __next__(self):
-        if self._index < len(self.chains)-1:
-            self._index += 1
-            return self.chains[self._index]
-        self._index = -1
-        raise StopIteration
+    def _build_chain_index(self):
+        self._chains_by_id = { }
+        for chain in self.chains:
+            self._chains_by_id.setdefault(chain.chain_id, chain)
 
     def get_chain(self, chain_id):
-        return next(chain for chain in self.chains if chain.chain_id == chain_id)
+        if self._chains_by_id is None:
+            self._build_chain_index()
+        return self._chains_by_id[chain_id]
 
     def remove_chain(self, chain_id):
-        matching_chains = [ chain for chain in self.chains if chain.chain_id == chain_id ]
-        if len(matching_chains) == 0:
+        if self._chains_by_id is None:
+            self._build_chain_index()
+        if chain_id not in self._chains_by_id:
             print('Error removing chain, no chains matching that ID were found.')
         else:
-            for chain in matching_chains:
-                self.chains.remove(chain)
-                self.chain_count -= 1
+            self.remove_chains([ chain_id ])
+
+    def remove_chains(self, chain_ids):
+        chain_ids = set(chain_ids)
+        remaining_chains = [ chain for chain in self.chains if chain.chain_id not in chain_ids ]
+        self.chain_count -= len(self.chains) - len(remaining_chains)
+        self.chains = remaining_chains
+        self._chains_by_id = None
 
     def b_factor_lists(self):
         all_bfs, aa_bfs, mc_bfs, sc_bfs, non_aa_bfs, water_bfs, ligand_bfs, ion_bfs = [ ], [ ], [ ], [ ], [ ], [ ], [ ], [ ]
@@ -60,3 +197,47 @@ class MetricsModel():
                                           (all_bfs_c, aa_bfs_c, mc_bfs_c, sc_bfs_c, non_aa_bfs_c, water_bfs_c, ligand_bfs_c, ion_bfs_c)):
                 model_li += chain_li
         return all_bfs, aa_bfs, mc_bfs, sc_bfs, non_aa_bfs, water_bfs, ligand_bfs, ion_bfs
+
+
+def create_calculators(resolution=None, ramachandran_grids=False):
+    return PercentileCalculator(resolution), RotamerCalculator(), RamachandranCalculator(use_grids=ramachandran_grids)
+
+
+def check_snapshot(snapshot):
+    # Snapshots are only valid for the payload layout and package code that wrote them
+    return isinstance(snapshot, dict) and \
+           snapshot.get('format_version') == SNAPSHOT_FORMAT_VERSION and \
+           snapshot.get('code_version') == get_code_version()
+
+
+def get_reusable_chains(snapshots):
+    # Scored chains from model snapshots, keyed by the hash of their atoms and analysis data
+    reusable_chains = { }
+    for snapshot in snapshots:
+        if not check_snapshot(snapshot):
+            continue
+        for chain, residue_data in zip(snapshot['chains'], snapshot['residue_data']):
+            if chain.content_key is not None:
+                reusable_chains[chain.content_key] = (chain, residue_data)
+    return reusable_chains
+
+
+def _chain_content_key(chain_table, chain_analysis_data):
+    # Residue offsets are relative to the chain, so the key does not depend on where the chain sits in its model
+    # The package code is hashed too, so chains scored by an earlier version are never reused
+    key_hash = hashlib.sha256()
+    key_hash.update(f'{SNAPSHOT_FORMAT_VERSION}:{get_code_version()}:{chain_table.chain_ids[0]}'.encode('utf8'))
+    for attribute in ('residue_seq_nums', 'residue_types', 'residue_insertion_codes', 'residue_offsets',
+                      'atom_ids', 'elements', 'xyzs', 'u_isos', 'u_anisos', 'occupancies'):
+        key_hash.update(getattr(chain_table, attribute).tobytes())
+    key_hash.update(pickle.dumps(chain_analysis_data, protocol=pickle.HIGHEST_PROTOCOL))
+    return key_hash.hexdigest()
+
+
+def _calculate_chain_data(chain_table, covariance_data=None, molprobity_data=None, reflections_data=None, ramachandran_grids=False):
+    # Worker-side scoring of a single chain, straight from its atom arrays. The chain is returned detached from
+    # its residues and model, with its residues packed into a column array for the parent to wrap in views.
+    metrics_model = MetricsModel(None, covariance_data, molprobity_data, reflections_data, columnar=True, atom_table=chain_table,
+                                 ramachandran_grids=ramachandran_grids)
+    chain = metrics_model.chains[0]
+    return chain.detached_copy(), chain.get_residue_data()
@@ -1,6 +1,9 @@
 import os
 
+import numpy as np
+
 from iris_validation._defs import CONTINUOUS_METRICS
+from iris_validation.metrics.reference import get_reference_data, load_cached_arrays
 
 
 DATA_DIR_PATH = os.path.join(os.path.dirname(__file__), 'data')
@@ -9,62 +12,83 @@ PERCENTILES_DATA_PATH = os.path.join(DATA_DIR_PATH, 'percentiles_data.csv')
 RESOLUTION_BIN_NAMES = ('<10', '10-20', '20-30', '30-40', '40-50', '50-60', '60-70', '70-80', '80-90', '>90', 'All')
 
 
+def _build_percentile_data():
+    percentile_rows = { }
+    with open(PERCENTILES_DATA_PATH, 'r', encoding='utf8') as infile:
+        for i, line in enumerate(infile.readlines()):
+            splitline = line.strip().split(',')
+            if i == 0:
+                metric_names = splitline[2:]
+            else:
+                bin_name = splitline[0]
+                percentile = int(splitline[1])
+                percentile_rows[(bin_name, percentile)] = [ float(x) for x in splitline[2:] ]
+    percentiles = sorted(set(percentile for _, percentile in percentile_rows))
+
+    # Thresholds are indexed by (metric, resolution bin, percentile)
+    thresholds = np.zeros((len(metric_names), len(RESOLUTION_BIN_NAMES), len(percentiles)), dtype=np.float64)
+    for bin_id, bin_name in enumerate(RESOLUTION_BIN_NAMES):
+        for percentile_id, percentile in enumerate(percentiles):
+            thresholds[:, bin_id, percentile_id] = percentile_rows[(bin_name, percentile)]
+
+    resolution_bins = [ ]
+    with open(RESOLUTION_BINS_PATH, 'r', encoding='utf8') as infile:
+        infile.readline() # Skip header line
+        for line in infile.readlines():
+            splitline = line.split(',')
+            percentile = int(splitline[0])
+            threshold = float(splitline[1])
+            resolution_bins.append((percentile, threshold))
+
+    data = (metric_names, percentiles, sorted(resolution_bins))
+    return data, { 'thresholds' : thresholds }
+
+
+def _load_percentile_data():
+    data, arrays = load_cached_arrays('percentiles', (PERCENTILES_DATA_PATH, RESOLUTION_BINS_PATH), _build_percentile_data)
+    metric_names, percentiles, resolution_bins = data
+    return metric_names, np.array(percentiles), arrays['thresholds'], { percentile : threshold for percentile, threshold in resolution_bins }
+
+
 class PercentileCalculator():
+    # A cheap view onto the shared percentile tables for a single resolution bin
     def __init__(self, resolution=None):
         self.resolution = resolution
-        self.percentile_data = None
+        self.metric_names = None
+        self.percentiles = None
+        self.thresholds = None
         self.resolution_bins = None
         self.bin_name = None
         self._load_data()
 
     def _load_data(self):
-        self.percentile_data = { }
-        with open(PERCENTILES_DATA_PATH, 'r', encoding='utf8') as infile:
-            for i, line in enumerate(infile.readlines()):
-                splitline = line.strip().split(',')
-                if i == 0:
-                    metric_names = splitline[2:]
-                    for metric_name in metric_names:
-                        self.percentile_data[metric_name] = { }
-                        for bin_name in RESOLUTION_BIN_NAMES:
-                            self.percentile_data[metric_name][bin_name] = { }
-                else:
-                    bin_name = splitline[0]
-                    percentile = int(splitline[1])
-                    metric_values = [ float(x) for x in splitline[2:] ]
-                    for metric_name, metric_value in zip(metric_names, metric_values):
-                        self.percentile_data[metric_name][bin_name][percentile] = metric_value
-
-        self.resolution_bins = { }
-        with open(RESOLUTION_BINS_PATH, 'r', encoding='utf8') as infile:
-            infile.readline() # Skip header line
-            for line in infile.readlines():
-                splitline = line.split(',')
-                percentile = int(splitline[0])
-                threshold = float(splitline[1])
-                self.resolution_bins[percentile] = threshold
-
-        if self.resolution is None:
-            self.bin_name = 'All'
-            return
-        bin_id = 9
-        for i, percentile in enumerate(sorted(self.resolution_bins.keys())):
-            percentile_resolution = self.resolution_bins[percentile]
-            if self.resolution < percentile_resolution:
-                bin_id = i
-                break
+        self.metric_names, self.percentiles, all_thresholds, self.resolution_bins = get_reference_data('percentiles', _load_percentile_data)
+
+        bin_id = RESOLUTION_BIN_NAMES.index('All')
+        if self.resolution is not None:
+            bin_id = 9
+            for i, percentile in enumerate(sorted(self.resolution_bins.keys())):
+                percentile_resolution = self.resolution_bins[percentile]
+                if self.resolution < percentile_resolution:
+                    bin_id = i
+                    break
         self.bin_name = RESOLUTION_BIN_NAMES[bin_id]
+        self.thresholds = all_thresholds[:, bin_id]
 
-    def get_percentile(self, metric_id, metric_value, normalise_polarity=True):
-        if None in (metric_id, metric_value):
-            return None
+    def get_percentiles(self, metric_id, metric_values, normalise_polarity=True):
+        # Thresholds are sorted, so the first percentile whose threshold exceeds each value is a binary search
         metric_name = CONTINUOUS_METRICS[metric_id]['long_name']
         metric_polarity = CONTINUOUS_METRICS[metric_id]['polarity']
-        determined_percentile = 100
-        for percentile, percentile_value in self.percentile_data[metric_name][self.bin_name].items():
-            if metric_value < percentile_value:
-                determined_percentile = percentile
-                break
+        metric_thresholds = self.thresholds[self.metric_names.index(metric_name)]
+        is_missing = [ value is None for value in metric_values ]
+        values = np.array([ np.nan if missing else value for value, missing in zip(metric_values, is_missing) ], dtype=np.float64)
+        percentile_ids = np.searchsorted(metric_thresholds, values, side='right')
+        percentiles = np.append(self.percentiles, 100)[percentile_ids]
         if normalise_polarity and metric_polarity == -1:
-            return 101 - determined_percentile
-        return determined_percentile
+            percentiles = 101 - percentiles
+        return [ None if missing else percentile for percentile, missing in zip(percentiles.tolist(), is_missing) ]
+
+    def get_percentile(self, metric_id, metric_value, normalise_polarity=True):
+        if None in (metric_id, metric_value):
+            return None
+        return self.get_percentiles(metric_id, (metric_value, ), normalise_polarity)[0]
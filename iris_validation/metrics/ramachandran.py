@@ -0,0 +1,129 @@
+import hashlib
+from functools import lru_cache
+
+import clipper
+import numpy as np
+
+from iris_validation import utils
+from iris_validation._defs import RAMACHANDRAN_THRESHOLDS
+from iris_validation.metrics.reference import discard_reference_data, get_cached_arrays, get_reference_data, store_cached_arrays
+
+
+RAMACHANDRAN_TABLE_NAMES = ('Gly2', 'Pro2', 'IleVal2', 'NoGPIVpreP2')
+GRID_SAMPLING = 360
+# A handful of table lookups, so that the cache key follows the table data rather than where clipper is installed
+PROBE_ANGLES = ((-1.2, 2.2), (-1.1, -0.7), (1.0, 0.5), (-2.6, 2.8), (0.0, 0.0), (2.5, -2.9))
+
+
+def _get_rama_functions():
+    # Shared per process with the utils lookups, so the clipper tables are only built once
+    return { table_name : utils._get_cached_rama_calculator(table_name) for table_name in RAMACHANDRAN_TABLE_NAMES }
+
+
+@lru_cache(maxsize=None)
+def _ramachandran_cache_key():
+    key_hash = hashlib.sha256()
+    key_hash.update(repr((getattr(clipper, '__version__', None), GRID_SAMPLING)).encode('utf8'))
+    for table_name, rama_function in _get_rama_functions().items():
+        probe_values = [ rama_function.probability(phi, psi) for phi, psi in PROBE_ANGLES ]
+        key_hash.update(repr((table_name, probe_values)).encode('utf8'))
+    return key_hash.hexdigest()[:16]
+
+
+def _build_ramachandran_grids():
+    # The clipper tables are sampled on a whole-degree grid, which bilinear interpolation reproduces
+    # to within the tables' own interpolation
+    angles = np.arange(GRID_SAMPLING) * (2*np.pi / GRID_SAMPLING)
+    grids = { }
+    for table_name, rama_function in _get_rama_functions().items():
+        grid = np.zeros((GRID_SAMPLING, GRID_SAMPLING), dtype=np.float64)
+        for phi_id, phi in enumerate(angles.tolist()):
+            for psi_id, psi in enumerate(angles.tolist()):
+                grid[phi_id, psi_id] = rama_function.probability(phi, psi)
+        grids[table_name] = grid
+    return list(RAMACHANDRAN_TABLE_NAMES), grids
+
+
+def _load_ramachandran_grids():
+    # Grids are built and stored on first use if no earlier run has cached them
+    cache_key = _ramachandran_cache_key()
+    cached_arrays = get_cached_arrays('ramachandran', cache_key)
+    if cached_arrays is not None:
+        return cached_arrays[1]
+    data, grids = _build_ramachandran_grids()
+    store_cached_arrays('ramachandran', cache_key, data, grids)
+    return grids
+
+
+def build_ramachandran_cache():
+    # Sampling the tables takes around half a million clipper calls, more than a single report would save, so
+    # grids are only used when requested with ramachandran_grids=True. This builds them ahead of a batch, so that
+    # each job can load them. Returns False if the on-disk cache is disabled.
+    cache_key = _ramachandran_cache_key()
+    if get_cached_arrays('ramachandran', cache_key) is not None:
+        return True
+    data, grids = _build_ramachandran_grids()
+    is_stored = store_cached_arrays('ramachandran', cache_key, data, grids)
+    discard_reference_data('ramachandran')
+    return is_stored
+
+
+class RamachandranCalculator():
+    # Scores come straight from clipper unless use_grids is set, in which case they are interpolated from grids
+    # sampled from the same tables. The two differ slightly, so results depend on the choice, never on the cache state.
+    def __init__(self, use_grids=False):
+        self.use_grids = use_grids
+        self.grids = None
+        self.rama_functions = None
+        self._load_data()
+
+    def _load_data(self):
+        self.rama_functions = _get_rama_functions()
+        if self.use_grids:
+            self.grids = get_reference_data('ramachandran', _load_ramachandran_grids)
+
+    def get_scores(self, codes, phis, psis):
+        # Probabilities for whole arrays of residues, with NaN wherever phi or psi is missing
+        phis = np.array([ np.nan if phi is None else phi for phi in phis ], dtype=np.float64)
+        psis = np.array([ np.nan if psi is None else psi for psi in psis ], dtype=np.float64)
+        table_names = np.array([ utils.get_rama_table_name(code) for code in codes ])
+        scores = np.full(len(phis), np.nan)
+        has_angles = ~(np.isnan(phis) | np.isnan(psis))
+        if self.grids is None:
+            scores[has_angles] = [ self.rama_functions[table_name].probability(phi, psi)
+                                   for table_name, phi, psi in zip(table_names[has_angles].tolist(), phis[has_angles].tolist(), psis[has_angles].tolist()) ]
+            return scores
+
+        grid_phis = np.mod(phis[has_angles] * (GRID_SAMPLING / (2*np.pi)), GRID_SAMPLING)
+        grid_psis = np.mod(psis[has_angles] * (GRID_SAMPLING / (2*np.pi)), GRID_SAMPLING)
+        phi_ids = np.floor(grid_phis).astype(np.int64) % GRID_SAMPLING
+        psi_ids = np.floor(grid_psis).astype(np.int64) % GRID_SAMPLING
+        phi_fractions = grid_phis - np.floor(grid_phis)
+        psi_fractions = grid_psis - np.floor(grid_psis)
+        next_phi_ids = (phi_ids + 1) % GRID_SAMPLING
+        next_psi_ids = (psi_ids + 1) % GRID_SAMPLING
+
+        selected_scores = np.zeros(len(grid_phis), dtype=np.float64)
+        selected_table_names = table_names[has_angles]
+        for table_name in RAMACHANDRAN_TABLE_NAMES:
+            mask = selected_table_names == table_name
+            if not mask.any():
+                continue
+            grid = self.grids[table_name]
+            i0, i1, j0, j1 = phi_ids[mask], next_phi_ids[mask], psi_ids[mask], next_psi_ids[mask]
+            fi, fj = phi_fractions[mask], psi_fractions[mask]
+            selected_scores[mask] = (grid[i0, j0] * (1-fi) * (1-fj) +
+                                     grid[i1, j0] * fi * (1-fj) +
+                                     grid[i0, j1] * (1-fi) * fj +
+                                     grid[i1, j1] * fi * fj)
+        scores[has_angles] = selected_scores
+        return scores
+
+    def get_flags(self, scores, thresholds=RAMACHANDRAN_THRESHOLDS):
+        # Favoured, allowed and outlier masks; all three are False wherever the score is missing
+        scores = np.asarray(scores, dtype=np.float64)
+        has_score = ~np.isnan(scores)
+        favoured = has_score & (scores >= thresholds[0])
+        allowed = has_score & (scores >= thresholds[1]) & (scores < thresholds[0])
+        outlier = has_score & (scores < thresholds[1])
+        return favoured, allowed, outlier
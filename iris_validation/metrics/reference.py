@@ -0,0 +1,116 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+import numpy as np
+
+
+CACHE_DIR_ENV_VAR = 'IRIS_VALIDATION_CACHE_DIR'
+
+_reference_data = { }
+_reference_data_lock = threading.Lock()
+
+
+def get_reference_data(name, loader):
+    # Loaded at most once per process, on first use; callers must treat the result as read-only
+    try:
+        return _reference_data[name]
+    except KeyError:
+        pass
+    with _reference_data_lock:
+        if name not in _reference_data:
+            _reference_data[name] = loader()
+    return _reference_data[name]
+
+
+def clear_reference_data():
+    with _reference_data_lock:
+        _reference_data.clear()
+
+
+def discard_reference_data(name):
+    with _reference_data_lock:
+        _reference_data.pop(name, None)
+
+
+def get_cache_dir():
+    # Setting the environment variable to an empty string disables the on-disk cache
+    cache_dir = os.environ.get(CACHE_DIR_ENV_VAR)
+    if cache_dir is None:
+        cache_root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_dir = os.path.join(cache_root, 'iris_validation')
+    return cache_dir or None
+
+
+def _hash_files(paths):
+    file_hash = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as infile:
+            file_hash.update(infile.read())
+    return file_hash.hexdigest()[:16]
+
+
+def _read_array_cache(cache_path):
+    with open(os.path.join(cache_path, 'metadata.json'), 'r', encoding='utf8') as infile:
+        metadata = json.load(infile)
+    arrays = { }
+    for array_id, array_name in enumerate(metadata['array_names']):
+        arrays[array_name] = np.load(os.path.join(cache_path, f'{array_id}.npy'), mmap_mode='r')
+    return metadata['data'], arrays
+
+
+def _write_array_cache(cache_path, data, arrays):
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        array_names = list(arrays.keys())
+        for array_id, array_name in enumerate(array_names):
+            np.save(os.path.join(temp_path, f'{array_id}.npy'), np.ascontiguousarray(arrays[array_name]))
+        with open(os.path.join(temp_path, 'metadata.json'), 'w', encoding='utf8') as outfile:
+            json.dump({ 'data' : data, 'array_names' : array_names }, outfile)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+
+
+def _get_array_cache_path(cache_dir, name, cache_key):
+    return os.path.join(cache_dir, f'{name}-{cache_key}')
+
+
+def get_cached_arrays(name, cache_key):
+    # Returns (data, arrays), or None if the entry has not been built or the on-disk cache is disabled
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    try:
+        return _read_array_cache(_get_array_cache_path(cache_dir, name, cache_key))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def store_cached_arrays(name, cache_key, data, arrays):
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return False
+    try:
+        _write_array_cache(_get_array_cache_path(cache_dir, name, cache_key), data, arrays)
+    except OSError:
+        return False
+    return True
+
+
+def load_cached_arrays(name, source_paths, builder):
+    # The builder returns JSON-serialisable data plus a dict of NumPy arrays, which are memory-mapped
+    # on later loads. Entries are keyed by a hash of the source files, so edited sources are rebuilt.
+    cache_key = _hash_files(source_paths)
+    cached_arrays = get_cached_arrays(name, cache_key)
+    if cached_arrays is not None:
+        return cached_arrays
+    data, arrays = builder()
+    store_cached_arrays(name, cache_key, data, arrays)
+    return data, arrays
@@ -1,16 +1,24 @@
 from math import log
 
 import clipper
+import numpy as np
+from scipy import ndimage
 from scipy.stats import norm
 
 from iris_validation import utils
+from iris_validation.metrics.atoms import AtomTable
+
+
+def can_export_maps():
+    return hasattr(clipper.Xmap_float, 'export_numpy')
 
 
 class ReflectionsHandler():
-    def __init__(self, f_reflections=None, xmap=None, minimol=None):
+    def __init__(self, f_reflections=None, xmap=None, minimol=None, atom_table=None):
         self.f_reflections = f_reflections
         self.xmap = xmap
         self.minimol = minimol
+        self.atom_table = atom_table
 
         self.hkl = clipper.HKL_info()
 
@@ -19,6 +27,11 @@ class ReflectionsHandler():
         self.cell = None
         self.resolution = None
 
+        self.map_grid = None
+        self.map_grid_exported = None
+        self.orth_to_frac = None
+        self._spline_coefficients = { }
+
         if f_reflections is None:
             if xmap is None:
                 raise ValueError('Either a reflections file path or an xmap object must be passed as an argument')
@@ -78,7 +91,7 @@ class ReflectionsHandler():
         #self.crystal = clipper.MTZcrystal()
         #self.f_phi = clipper.HKL_data_F_phi_float(self.hkl, self.crystal)
         self.f_phi = clipper.HKL_data_F_phi_float(self.hkl)
-        atoms = self.minimol.atom_list()
+        atoms = self.minimol.atom_list() if self.minimol is not None else self.atom_table.to_atom_list()
         sf_calc = clipper.SFcalc_obs_bulk_float if bulk_solvent else clipper.SFcalc_obs_base_float
         sf_calc(self.f_phi, self.f_sigf, atoms)
 
@@ -108,7 +121,95 @@ class ReflectionsHandler():
         xyz = (co.x(), co.y(), co.z())
         return self.get_density_at_point(xyz)
 
-    def calculate_all_density_scores(self):
+    def _export_map_grid(self):
+        # Export the full unit cell so that symmetry is handled by periodic wrapping alone. Returns False when this
+        # clipper build cannot export maps, as filling the grid point by point costs far more than sampling each atom.
+        grid = self.xmap.grid_sampling()
+        grid_shape = (grid.nu(), grid.nv(), grid.nw())
+        map_grid = np.zeros(grid_shape, dtype=np.float64)
+        try:
+            self.xmap.export_numpy(map_grid)
+        except (AttributeError, TypeError):
+            self.map_grid_exported = False
+            return False
+        if map_grid.shape != grid_shape or not self._check_exported_grid(map_grid):
+            self.map_grid_exported = False
+            return False
+        self.map_grid = np.ascontiguousarray(map_grid)
+        self.map_grid_exported = True
+
+        cell = self.xmap.cell()
+        orth_to_frac = np.zeros((3, 3), dtype=np.float64)
+        for axis in range(3):
+            basis_vector = [ 0.0, 0.0, 0.0 ]
+            basis_vector[axis] = 1.0
+            cf = clipper.Coord_orth(*basis_vector).coord_frac(cell)
+            orth_to_frac[:, axis] = (cf.u(), cf.v(), cf.w())
+        self.orth_to_frac = orth_to_frac
+        self._spline_coefficients = { }
+        return True
+
+    def _check_exported_grid(self, map_grid):
+        # The export is only used if it covers the whole unit cell with index 0 at the grid origin, which is
+        # checked against the map at the origin, the far corner and a few points along and between the axes
+        nu, nv, nw = map_grid.shape
+        check_points = ((0, 0, 0), (nu-1, 0, 0), (0, nv-1, 0), (0, 0, nw-1), (nu-1, nv-1, nw-1), (nu//2, nv//3, nw//5))
+        for point in check_points:
+            expected = self.xmap.get_data(clipper.Coord_grid(*point))
+            if not np.isclose(map_grid[point], expected, rtol=1e-6, atol=1e-12):
+                return False
+        return True
+
+    def get_density_at_points(self, xyzs, order=0):
+        xyzs = np.asarray(xyzs, dtype=np.float64).reshape(-1, 3)
+        if self.map_grid_exported is None:
+            self._export_map_grid()
+        if not self.map_grid_exported:
+            # Each atom is sampled at its nearest grid point, as in get_density_at_point
+            return np.array([ self.get_density_at_point(xyz) for xyz in xyzs.tolist() ], dtype=np.float64)
+        grid_coords = (xyzs @ self.orth_to_frac.T) * np.array(self.map_grid.shape, dtype=np.float64)
+        if order == 0:
+            # Rounded half up, as clipper rounds coordinates to the nearest grid point
+            grid_indices = np.floor(grid_coords + 0.5).astype(np.int64) % np.array(self.map_grid.shape)
+            return self.map_grid[tuple(grid_indices.T)]
+        if order == 1:
+            return ndimage.map_coordinates(self.map_grid, grid_coords.T, order=order, mode='grid-wrap')
+        if order not in self._spline_coefficients:
+            self._spline_coefficients[order] = ndimage.spline_filter(self.map_grid, order=order, mode='grid-wrap')
+        return ndimage.map_coordinates(self._spline_coefficients[order], grid_coords.T, order=order, mode='grid-wrap', prefilter=False)
+
+    def calculate_all_density_scores(self, batched=True, interpolation_order=0):
+        # Atoms are sampled at their nearest grid point unless a higher interpolation order is requested
+        if not batched:
+            return self._calculate_all_density_scores_serial()
+
+        if self.atom_table is None:
+            self.atom_table = AtomTable(self.minimol)
+        residue_keys = self.atom_table.residue_keys()
+        residue_ids = self.atom_table.residue_ids
+        is_mainchain = self.atom_table.mainchain_mask()
+        num_residues = len(residue_keys)
+        densities = self.get_density_at_points(self.atom_table.xyzs, order=interpolation_order)
+        density_norms = densities / self.atom_table.atomic_numbers()
+        # logcdf stays finite where cdf underflows to zero for atoms far out of density
+        atom_scores = -norm.logcdf((density_norms - self.map_mean) / self.map_std)
+
+        residue_means = [ ]
+        for atom_mask in (None, is_mainchain, ~is_mainchain):
+            ids = residue_ids if atom_mask is None else residue_ids[atom_mask]
+            scores = atom_scores if atom_mask is None else atom_scores[atom_mask]
+            counts = np.bincount(ids, minlength=num_residues)
+            sums = np.bincount(ids, weights=scores, minlength=num_residues)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                means = sums / counts
+            residue_means.append([ float(x) if count > 0 else None for x, count in zip(means, counts) ])
+
+        density_scores = { chain_id : { } for chain_id in self.atom_table.chain_ids }
+        for residue_id, (chain_id, seq_num) in enumerate(residue_keys):
+            density_scores[chain_id][seq_num] = tuple(means[residue_id] for means in residue_means)
+        return density_scores
+
+    def _calculate_all_density_scores_serial(self):
         density_scores = { }
         for chain in self.minimol:
             chain_id = str(chain.id()).strip()
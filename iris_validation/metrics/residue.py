@@ -1,13 +1,17 @@
-from math import isnan
-
-import clipper
-
 from iris_validation import utils
-from iris_validation._defs import RAMACHANDRAN_THRESHOLDS
 
 
+# Residue attributes for each continuous metric, indexed by metric ID
+CONTINUOUS_METRIC_ATTRIBUTES = ('avg_b_factor',
+                                'max_b_factor',
+                                'std_b_factor',
+                                'fit_score',
+                                'mainchain_fit_score',
+                                'sidechain_fit_score',
+                                'covariance_score')
+
 class MetricsResidue():
-    def __init__(self, mmol_residue, index_in_chain=None, previous_residue=None, next_residue=None, parent_chain=None, covariance_data=None, molprobity_data=None, density_scores=None):
+    def __init__(self, mmol_residue, index_in_chain=None, previous_residue=None, next_residue=None, parent_chain=None, covariance_data=None, molprobity_data=None, density_scores=None, atom_index=None, torsions=None):
         self.minimol_residue = mmol_residue
         self.initialised_with_context = index_in_chain is not None
         self.index_in_chain = index_in_chain
@@ -18,60 +22,83 @@ class MetricsResidue():
         self.molprobity_data = molprobity_data
         self.density_scores = density_scores
 
-        self.atoms = list(mmol_residue)
-        self.sequence_number = int(mmol_residue.seqnum())
-        self.code = mmol_residue.type().trim()
-        self.code_type = utils.code_type(mmol_residue)
-        self.backbone_atoms = utils.get_backbone_atoms(mmol_residue)
-        self.backbone_atoms_are_correct = None not in self.backbone_atoms
-        self.backbone_geometry_is_correct = utils.check_backbone_geometry(mmol_residue) if self.backbone_atoms_are_correct else None
-        self.is_aa = utils.check_is_aa(mmol_residue)
-        self.is_water = str(mmol_residue.type()).strip() == 'HOH'
+        if atom_index is None:
+            atom_index = utils.index_atoms(mmol_residue)
+        # Residues scored from atom table arrays have no MiniMol residue or clipper atoms
+        self.atoms = atom_index.atoms
+        self.num_atoms = len(atom_index.atom_ids)
+        self.sequence_number = atom_index.seq_num
+        self.insertion_code = atom_index.insertion_code
+        self.code = atom_index.code
+        self.code_type = utils.code_type(None, self.code)
+        self.backbone_atoms = None if self.atoms is None else utils.get_backbone_atoms(mmol_residue, atom_index)
+        self.backbone_atoms_are_correct = None not in atom_index.backbone_positions()
+        self.backbone_geometry_is_correct = utils.check_backbone_geometry(mmol_residue, atom_index) if self.backbone_atoms_are_correct else None
+        self.is_aa = utils.check_is_aa(mmol_residue, atom_index=atom_index)
+        self.is_water = self.code == 'HOH'
         self.is_consecutive_aa = None
 
         # B-factors
-        self.max_b_factor, self.avg_b_factor, self.std_b_factor, self.mc_b_factor, self.sc_b_factor = utils.analyse_b_factors(mmol_residue, self.is_aa, self.backbone_atoms)
-
-        # Backbone torsion angles
-        self.phi = clipper.MMonomer.protein_ramachandran_phi(self.previous_residue, mmol_residue) if self.previous_residue else None
-        self.psi = clipper.MMonomer.protein_ramachandran_psi(mmol_residue, self.next_residue) if self.next_residue else None
-        if self.phi is not None and isnan(self.phi):
-            self.phi = None
-        if self.psi is not None and isnan(self.psi):
-            self.psi = None
+        self.max_b_factor, self.avg_b_factor, self.std_b_factor, self.mc_b_factor, self.sc_b_factor = utils.analyse_b_factors(mmol_residue, self.is_aa, self.backbone_atoms, atom_index)
 
-        # Side chain torsion angles
-        self.chis = utils.calculate_chis(mmol_residue) if self.is_aa else None
+        # Torsion angles, normally calculated for the whole chain at once by the parent chain
+        if torsions is None:
+            neighbour_atom_indices = [ utils.index_atoms(self.previous_residue) if self.previous_residue else None,
+                                       atom_index,
+                                       utils.index_atoms(self.next_residue) if self.next_residue else None ]
+            torsions = [ chain_values[1] for chain_values in utils.calculate_chain_torsions(neighbour_atom_indices) ]
+        self.phi, self.psi, self.omega, chis = torsions
+        self.chis = chis if self.is_aa else None
         self.is_sidechain_complete = self.chis is not None and None not in self.chis
 
-        # Ramachandran
-        self.ramachandran_score = utils.calculate_ramachandran_score(mmol_residue, self.code, self.phi, self.psi)
+        # Ramachandran, scored for the whole chain at once by the parent chain
+        self.ramachandran_score = None
         self.ramachandran_flags = (None, None, None)
-        if self.ramachandran_score is not None:
-            if RAMACHANDRAN_THRESHOLDS[0] <= self.ramachandran_score:
-                self.ramachandran_flags = (True, False, False)
-            elif RAMACHANDRAN_THRESHOLDS[1] <= self.ramachandran_score < RAMACHANDRAN_THRESHOLDS[0]:
-                self.ramachandran_flags = (False, True, False)
-            elif self.ramachandran_score < RAMACHANDRAN_THRESHOLDS[1]:
-                self.ramachandran_flags = (False, False, True)
         self.ramachandran_favoured, self.ramachandran_allowed, self.ramachandran_outlier = self.ramachandran_flags
 
-        # Rotamer
-        rotamer_calculator = self.parent_chain.parent_model.rotamer_calculator
+        # Rotamer, scored for the whole chain at once by the parent chain
         self.rotamer_score = None
         self.rotamer_flags = (None, None, None)
-        if self.is_sidechain_complete:
-            self.rotamer_score = rotamer_calculator.get_cv_score(self.code, self.chis)
-            rotamer_clf_id = rotamer_calculator.get_classification(self.code, self.chis)
-            if rotamer_clf_id == 3:
-                self.rotamer_flags = (True, False, False)
-            elif rotamer_clf_id == 2:
-                self.rotamer_flags = (False, True, False)
-            elif rotamer_clf_id in (0, 1):
-                self.rotamer_flags = (False, False, True)
         self.rotamer_favoured, self.rotamer_allowed, self.rotamer_outlier = self.rotamer_flags
 
-        # MolProbity data
+        # Covariance data
+        self.covariance_score, self.cmo_string = None, None
+        if self.covariance_data is not None:
+            self.covariance_score, self.cmo_string = self.covariance_data
+
+        # Discrete indicators, set by the parent chain once the rotamers have been scored
+        self.discrete_indicators = None
+
+        # Density fit scores
+        self.fit_score, self.mainchain_fit_score, self.sidechain_fit_score = None, None, None
+        if self.density_scores is not None:
+            self.fit_score, self.mainchain_fit_score, self.sidechain_fit_score = self.density_scores
+
+        # Percentiles, filled in for the whole chain at once by the parent chain
+        self.avg_b_factor_percentile = None
+        self.max_b_factor_percentile = None
+        self.std_b_factor_percentile = None
+        self.fit_score_percentile = None
+        self.mainchain_fit_score_percentile = None
+        self.sidechain_fit_score_percentile = None
+        self.covariance_score_percentile = None
+
+    def set_ramachandran_data(self, ramachandran_score, ramachandran_flags):
+        self.ramachandran_score = ramachandran_score
+        self.ramachandran_flags = ramachandran_flags
+        self.ramachandran_favoured, self.ramachandran_allowed, self.ramachandran_outlier = self.ramachandran_flags
+
+    def set_rotamer_data(self, rotamer_score, rotamer_clf_id):
+        self.rotamer_score = rotamer_score
+        if rotamer_clf_id == 3:
+            self.rotamer_flags = (True, False, False)
+        elif rotamer_clf_id == 2:
+            self.rotamer_flags = (False, True, False)
+        elif rotamer_clf_id in (0, 1):
+            self.rotamer_flags = (False, False, True)
+        self.rotamer_favoured, self.rotamer_allowed, self.rotamer_outlier = self.rotamer_flags
+
+    def calculate_discrete_indicators(self):
         self.discrete_indicators = self.molprobity_data
         if self.molprobity_data is None:
             ramachandran_indicator = 0 if self.ramachandran_outlier else \
@@ -85,24 +112,4 @@ class MetricsResidue():
                                          'omega' : None,
                                          'ramachandran' : ramachandran_indicator,
                                          'rotamer' : rotamer_indicator }
-
-        # Covariance data
-        self.covariance_score, self.cmo_string = None, None
-        if self.covariance_data is not None:
-            self.covariance_score, self.cmo_string = self.covariance_data
         self.discrete_indicators['cmo'] = self.cmo_string
-
-        # Density fit scores
-        self.fit_score, self.mainchain_fit_score, self.sidechain_fit_score = None, None, None
-        if self.density_scores is not None:
-            self.fit_score, self.mainchain_fit_score, self.sidechain_fit_score = self.density_scores
-
-        # Percentiles
-        percentile_calculator = self.parent_chain.parent_model.percentile_calculator
-        self.avg_b_factor_percentile = percentile_calculator.get_percentile(0, self.avg_b_factor)
-        self.max_b_factor_percentile = percentile_calculator.get_percentile(1, self.max_b_factor)
-        self.std_b_factor_percentile = percentile_calculator.get_percentile(2, self.std_b_factor)
-        self.fit_score_percentile = percentile_calculator.get_percentile(3, self.fit_score)
-        self.mainchain_fit_score_percentile = percentile_calculator.get_percentile(4, self.mainchain_fit_score)
-        self.sidechain_fit_score_percentile = percentile_calculator.get_percentile(5, self.sidechain_fit_score)
-        self.covariance_score_percentile = percentile_calculator.get_percentile(6, self.covariance_score)
@@ -0,0 +1,126 @@
+import os
+import zlib
+import pickle
+import hashlib
+import tempfile
+from functools import lru_cache
+
+from iris_validation.metrics.reference import get_cache_dir
+
+
+# Analysis results and model snapshots are only cached when use_cache=True is passed. They are pickled into the
+# 'results' subdirectory of get_cache_dir(): $IRIS_VALIDATION_CACHE_DIR if set (an empty value disables caching),
+# otherwise $XDG_CACHE_HOME/iris_validation or ~/.cache/iris_validation. Cached payloads are unpickled when read,
+# so the directory must only be writable by trusted users. clear_results() empties it, as does deleting it.
+RESULT_CACHE_SUBDIR = 'results'
+RESULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+RESULT_FILE_SUFFIX = '.pkl.z'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+@lru_cache(maxsize=None)
+def get_code_version():
+    # Hash of every file in the package, code and reference data alike, so that any edit invalidates cached
+    # results. Installed builds are hashed too, as editable installs keep one version number across changes.
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    source_hash = hashlib.sha256()
+    for dir_path, dir_names, filenames in os.walk(package_dir):
+        dir_names[:] = sorted(dir_name for dir_name in dir_names if dir_name != '__pycache__')
+        for filename in sorted(filenames):
+            if filename.endswith(('.pyc', '.pyo')):
+                continue
+            path = os.path.join(dir_path, filename)
+            source_hash.update(os.path.relpath(path, package_dir).encode('utf8') + b'\0')
+            with open(path, 'rb') as infile:
+                source_hash.update(infile.read())
+    return source_hash.hexdigest()[:16]
+
+
+def result_cache_key(analysis_name, input_paths, parameters=()):
+    key_hash = hashlib.sha256()
+    key_hash.update(repr((analysis_name, get_code_version(), parameters)).encode('utf8'))
+    for path in input_paths:
+        key_hash.update(b'\0')
+        with open(path, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(HASH_CHUNK_SIZE), b''):
+                key_hash.update(chunk)
+    return key_hash.hexdigest()
+
+
+def _get_result_cache_dir():
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, RESULT_CACHE_SUBDIR)
+
+
+def read_payload(path):
+    with open(path, 'rb') as infile:
+        return pickle.loads(zlib.decompress(infile.read()))
+
+
+def write_payload(path, payload):
+    # Written to a temporary file first, so readers never see a partial payload
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(file_descriptor, 'wb') as outfile:
+            outfile.write(zlib.compress(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def load_result(cache_key):
+    # Returns (found, payload); a hit refreshes the entry's modification time, which eviction uses as its LRU clock
+    result_cache_dir = _get_result_cache_dir()
+    if result_cache_dir is None:
+        return False, None
+    result_path = os.path.join(result_cache_dir, cache_key + RESULT_FILE_SUFFIX)
+    try:
+        payload = read_payload(result_path)
+        os.utime(result_path)
+    except (OSError, EOFError, zlib.error, pickle.UnpicklingError):
+        return False, None
+    return True, payload
+
+
+def store_result(cache_key, payload, max_bytes=RESULT_CACHE_MAX_BYTES):
+    result_cache_dir = _get_result_cache_dir()
+    if result_cache_dir is None:
+        return
+    try:
+        os.makedirs(result_cache_dir, exist_ok=True)
+        write_payload(os.path.join(result_cache_dir, cache_key + RESULT_FILE_SUFFIX), payload)
+    except OSError:
+        return
+    evict_results(max_bytes)
+
+
+def evict_results(max_bytes=RESULT_CACHE_MAX_BYTES):
+    # Least recently used entries are removed until the cache fits within max_bytes
+    result_cache_dir = _get_result_cache_dir()
+    if result_cache_dir is None:
+        return
+    entries = [ ]
+    try:
+        with os.scandir(result_cache_dir) as scanner:
+            for entry in scanner:
+                if entry.name.endswith(RESULT_FILE_SUFFIX):
+                    entry_stat = entry.stat()
+                    entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+    except OSError:
+        return
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_bytes -= size
+
+
+def clear_results():
+    evict_results(max_bytes=0)
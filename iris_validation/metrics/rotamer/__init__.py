@@ -8,7 +8,10 @@ import gzip
 import pickle
 import itertools
 
+import numpy as np
+
 from iris_validation.utils import product
+from iris_validation.metrics.reference import get_reference_data, load_cached_arrays
 
 
 DATA_DIR_PATH = os.path.join(os.path.dirname(__file__), 'data')
@@ -33,78 +36,104 @@ def _unpack_bytes(in_bytes):
     return unpacked
 
 
+def _build_rotamer_data():
+    with gzip.open(LIBRARY_PATH, 'rb') as infile:
+        dim_offsets, dim_bin_ranges, dim_bin_widths, dim_num_options, compressed_byte_arrays = pickle.load(infile)
+    classifications = { }
+    for code, compressed in compressed_byte_arrays.items():
+        compressed = bytearray(compressed)
+        classifications[code] = _unpack_bytes(compressed)
+
+    central_values = { }
+    with open(CENTRAL_VALUES_PATH, 'r', encoding='utf8') as infile:
+        infile.readline() # Skip header line
+        for line in infile.readlines():
+            splitline = line.strip().split(',')
+            code = splitline[0]
+            rot_name = splitline[1]
+            chi_means = [ float(x) for x in splitline[2:6] if x != 'None' ]
+            chi_sdevs = [ float(x) for x in splitline[6:10] if x != 'None' ]
+            if code not in central_values:
+                central_values[code] = [ ]
+            central_values[code].append((rot_name, chi_means, chi_sdevs))
+
+    data = (dim_offsets, dim_bin_ranges, dim_bin_widths, dim_num_options, central_values)
+    return data, classifications
+
+
+def _load_rotamer_data():
+    data, classifications = load_cached_arrays('rotamers', (LIBRARY_PATH, CENTRAL_VALUES_PATH), _build_rotamer_data)
+    dim_offsets, dim_bin_ranges, dim_bin_widths, dim_num_options, central_values = data
+    library_data = (dim_offsets, dim_bin_ranges, dim_bin_widths, dim_num_options, classifications)
+
+    # (n_rotamers x n_chis) matrices of the central values for broadcasting against batches of residues
+    central_value_arrays = { }
+    for code, rotamers in central_values.items():
+        chi_means = np.array([ rotamer[1] for rotamer in rotamers ], dtype=np.float64)
+        chi_sdevs = np.array([ rotamer[2] for rotamer in rotamers ], dtype=np.float64)
+        central_value_arrays[code] = (chi_means, chi_sdevs)
+
+    return library_data, central_values, central_value_arrays
+
+
 class RotamerCalculator():
     def __init__(self):
         self.library_data = None
         self.central_values = None
+        self.central_value_arrays = None
         self._load_data()
 
     def _load_data(self):
-        with gzip.open(LIBRARY_PATH, 'rb') as infile:
-            dim_offsets, dim_bin_ranges, dim_bin_widths, dim_num_options, compressed_byte_arrays = pickle.load(infile)
-        classifications = { }
-        for code, compressed in compressed_byte_arrays.items():
-            compressed = bytearray(compressed)
-            classifications[code] = _unpack_bytes(compressed)
-        self.library_data = (dim_offsets, dim_bin_ranges, dim_bin_widths, dim_num_options, classifications)
-
-        self.central_values = { }
-        with open(CENTRAL_VALUES_PATH, 'r', encoding='utf8') as infile:
-            infile.readline() # Skip header line
-            for line in infile.readlines():
-                splitline = line.strip().split(',')
-                code = splitline[0]
-                rot_name = splitline[1]
-                chi_means = [ float(x) for x in splitline[2:6] if x != 'None' ]
-                chi_sdevs = [ float(x) for x in splitline[6:10] if x != 'None' ]
-                if code not in self.central_values:
-                    self.central_values[code] = [ ]
-                self.central_values[code].append((rot_name, chi_means, chi_sdevs))
+        self.library_data, self.central_values, self.central_value_arrays = get_reference_data('rotamers', _load_rotamer_data)
 
     def _cv_sqdiff_scores(self, code, chis):
-        rotamer_scores = { }
-        chis = [ x for x in chis if x is not None ]
-        for rot_name, chi_means, chi_sdevs in self.central_values[code]:
-            chis = chis[:len(chi_means)]
-            sqdiffs = [ ]
-            for i in range(len(chis)):
-                deltas = (chis[i]-chi_means[i], chis[i]-chi_means[i]+360)
-                best_delta = deltas[int(deltas[0]>deltas[1])]
-                z_score = best_delta / chi_sdevs[i]
-                sqdiff = z_score**2
-                sqdiffs.append(sqdiff)
-            score = (sum(sqdiffs) / len(sqdiffs))**0.5
-            rotamer_scores[rot_name] = score
+        chi_means, chi_sdevs = self.central_value_arrays[code]
+        num_chis = min(chis.shape[1], chi_means.shape[1])
+        # Only the unshifted delta is ever selected, as chi-mean+360 is always the larger of the two
+        deltas = chis[:, np.newaxis, :num_chis] - chi_means[np.newaxis, :, :num_chis]
+        z_scores = deltas / chi_sdevs[np.newaxis, :, :num_chis]
+        rotamer_scores = np.sqrt(np.sum(z_scores**2, axis=2) / num_chis)
         return rotamer_scores
 
+    def get_cv_scores(self, code, chis):
+        # chis is an (n_residues x n_chis) array of complete side chains of a single residue type
+        if code not in self.central_values.keys():
+            return
+        chis = np.asarray(chis, dtype=np.float64).reshape(len(chis), -1)
+        scores = self._cv_sqdiff_scores(code, chis)
+        best_scores = scores.min(axis=1)
+        return best_scores
+
     def get_cv_score(self, code, chis):
         if code not in self.central_values.keys() or None in chis:
             return
-        scores = self._cv_sqdiff_scores(code, chis)
-        best_score = min(scores.values())
+        best_score = float(self.get_cv_scores(code, [ chis ])[0])
         return best_score
 
-    def get_classification(self, code, chis):
+    def get_classifications(self, code, chis):
         dim_offsets, dim_bin_ranges, dim_bin_widths, dim_num_options, classifications = self.library_data
-        if  None in chis:
-            return
         if code not in dim_offsets.keys():
             return
-        closest_values = [ ]
-        chis = tuple([ x for x in chis if x is not None ][:len(dim_offsets[code])])
-        for dimension, chi in enumerate(chis):
-            dim_width = dim_bin_ranges[code][dimension][1] - dim_bin_ranges[code][dimension][0]
-            if chi <= dim_bin_ranges[code][dimension][0]:
-                chi += dim_width
-            if chi >= dim_bin_ranges[code][dimension][1]:
-                chi -= dim_width
-            multiple = round((chi - dim_offsets[code][dimension]) / dim_bin_widths[code][dimension])
-            closest_value = dim_offsets[code][dimension] + multiple * dim_bin_widths[code][dimension]
-            closest_values.append(closest_value)
-        closest_values = tuple(closest_values)
-        index = 0
-        for dimension, chi in enumerate(closest_values):
-            dim_offest = dim_offsets[code][dimension]
-            dim_bin_width = dim_bin_widths[code][dimension]
-            index += int((chi - dim_offest) / dim_bin_width * product(dim_num_options[code][dimension+1:]))
-        return classifications[code][index]
+        chis = np.asarray(chis, dtype=np.float64).reshape(len(chis), -1)
+        num_dims = min(chis.shape[1], len(dim_offsets[code]))
+        chis = chis[:, :num_dims]
+        offsets = np.array(dim_offsets[code][:num_dims], dtype=np.float64)
+        bin_ranges = np.array(dim_bin_ranges[code][:num_dims], dtype=np.float64).reshape(-1, 2)
+        bin_widths = np.array(dim_bin_widths[code][:num_dims], dtype=np.float64)
+        strides = np.array([ product(dim_num_options[code][dimension+1:]) for dimension in range(num_dims) ], dtype=np.float64)
+
+        dim_widths = bin_ranges[:, 1] - bin_ranges[:, 0]
+        chis = np.where(chis <= bin_ranges[:, 0], chis + dim_widths, chis)
+        chis = np.where(chis >= bin_ranges[:, 1], chis - dim_widths, chis)
+        multiples = np.round((chis - offsets) / bin_widths)
+        closest_values = offsets + multiples * bin_widths
+        indices = np.trunc((closest_values - offsets) / bin_widths * strides).astype(np.int64).sum(axis=1)
+        return np.asarray(classifications[code])[indices]
+
+    def get_classification(self, code, chis):
+        if None in chis:
+            return
+        clf_ids = self.get_classifications(code, [ chis ])
+        if clf_ids is None:
+            return
+        return int(clf_ids[0])
@@ -0,0 +1,157 @@
+import json
+import base64
+
+import numpy as np
+
+
+ENCODING_VERSION = 1
+
+# Typed arrays are little-endian so that browsers can view the decoded bytes directly. Missing integer
+# values are stored as -1 and missing floats as NaN; gap positions are only meaningful through the
+# residue_validities mask.
+ENCODED_ARRAY_DTYPES = { 'residue_seqnos' : '<i4',
+                         'residue_codes' : '<i2',
+                         'residue_validities' : '|u1',
+                         'discrete_values' : '|i1',
+                         'continuous_values' : '<f4',
+                         'percentile_values' : '|i1' }
+
+CHAIN_HEADER_KEYS = ('chain_id',
+                     'num_versions',
+                     'has_covariance',
+                     'has_molprobity',
+                     'has_reflections',
+                     'aligned_length')
+
+RAW_DATA_DECIMALS = 3
+
+
+def round_array(values, decimals):
+    # np.round scales before rounding, which can disagree with round() for values that print as exact
+    # halves; those few are re-rounded one by one so that results match the scalar rounding
+    rounded = np.round(values, decimals)
+    scaled = np.abs(values) * 10**decimals
+    with np.errstate(invalid='ignore'):
+        near_halves = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for index in zip(*np.nonzero(near_halves)):
+        rounded[index] = round(float(values[index]), decimals)
+    return rounded
+
+
+def _encode_array(array, dtype):
+    array = np.ascontiguousarray(array, dtype=dtype)
+    return { 'dtype' : np.dtype(dtype).name,
+             'shape' : list(array.shape),
+             'data' : base64.b64encode(array.tobytes()).decode('ascii') }
+
+
+def _decode_array(encoded_array):
+    dtype = np.dtype(encoded_array['dtype']).newbyteorder('<')
+    data = base64.b64decode(encoded_array['data'])
+    return np.frombuffer(data, dtype=dtype).reshape(encoded_array['shape'])
+
+
+def _to_int_array(values):
+    float_values = np.array(values, dtype=np.float64)
+    return np.where(np.isnan(float_values), -1, float_values)
+
+
+def chain_data_to_arrays(chain_data):
+    # Inverse of chain_arrays_to_data; column arrays from MetricsModelSeries.get_raw_arrays pass straight through
+    if isinstance(chain_data['residue_validities'], np.ndarray):
+        return chain_data
+    num_versions, aligned_length = chain_data['num_versions'], chain_data['aligned_length']
+    chain_arrays = { key : chain_data[key] for key in CHAIN_HEADER_KEYS }
+    chain_arrays['residue_seqnos'] = np.array([ [ 0 if seqno is None else seqno for seqno in version_seqnos ]
+                                                for version_seqnos in chain_data['residue_seqnos'] ], dtype=np.int64).reshape(num_versions, aligned_length)
+    chain_arrays['residue_codes'] = np.array([ [ '' if code is None else code for code in version_codes ]
+                                               for version_codes in chain_data['residue_codes'] ], dtype=str).reshape(num_versions, aligned_length)
+    chain_arrays['residue_validities'] = np.array(chain_data['residue_validities'], dtype=bool).reshape(num_versions, aligned_length)
+    chain_arrays['discrete_values'] = _to_int_array(chain_data['discrete_values']).reshape(-1, num_versions, aligned_length)
+    chain_arrays['continuous_values'] = np.array(chain_data['continuous_values'], dtype=np.float64).reshape(-1, num_versions, aligned_length)
+    chain_arrays['percentile_values'] = _to_int_array(chain_data['percentile_values']).reshape(-1, num_versions, aligned_length)
+    return chain_arrays
+
+
+def chain_arrays_to_data(chain_arrays):
+    # Nested lists and tuples, indexed [version][position] for residue fields and [metric][version][position]
+    # for values, with None for gaps and missing values
+    validities = chain_arrays['residue_validities']
+    chain_data = { key : chain_arrays[key] for key in CHAIN_HEADER_KEYS }
+    chain_data['residue_seqnos'] = _to_nested_lists(chain_arrays['residue_seqnos'], ~validities)
+    chain_data['residue_codes'] = _to_nested_lists(chain_arrays['residue_codes'], ~validities)
+    chain_data['residue_validities'] = validities.tolist()
+    for name in ('discrete_values', 'continuous_values', 'percentile_values'):
+        values = chain_arrays[name]
+        is_missing = np.isnan(values) if values.dtype.kind == 'f' else values < 0
+        chain_data[name] = [ tuple(map(tuple, metric_values)) for metric_values in _to_nested_lists(values, is_missing) ]
+    return chain_data
+
+
+def _to_nested_lists(values, is_missing):
+    # Python scalars with None wherever is_missing is set
+    nested_values = np.empty(values.shape, dtype=object)
+    nested_values[...] = values.tolist()
+    nested_values[is_missing] = None
+    return nested_values.tolist()
+
+
+def encode_chain_data(chain_data):
+    if 'arrays' in chain_data:
+        return chain_data
+    chain_arrays = chain_data_to_arrays(chain_data)
+    code_table = sorted(set(chain_arrays['residue_codes'][chain_arrays['residue_validities']].tolist()))
+    code_ids = np.searchsorted(np.array(code_table, dtype=chain_arrays['residue_codes'].dtype), chain_arrays['residue_codes'])
+    arrays = { 'residue_seqnos' : chain_arrays['residue_seqnos'],
+               'residue_codes' : np.where(chain_arrays['residue_validities'], code_ids, -1),
+               'residue_validities' : chain_arrays['residue_validities'],
+               'discrete_values' : chain_arrays['discrete_values'],
+               'continuous_values' : chain_arrays['continuous_values'],
+               'percentile_values' : chain_arrays['percentile_values'] }
+
+    encoded_chain_data = { key : chain_data[key] for key in CHAIN_HEADER_KEYS }
+    encoded_chain_data['encoding_version'] = ENCODING_VERSION
+    encoded_chain_data['code_table'] = code_table
+    encoded_chain_data['arrays'] = { name : _encode_array(array, ENCODED_ARRAY_DTYPES[name]) for name, array in arrays.items() }
+    return encoded_chain_data
+
+
+def decode_chain_arrays(encoded_chain_data):
+    if encoded_chain_data['encoding_version'] != ENCODING_VERSION:
+        raise ValueError(f'Unsupported raw data encoding version: {encoded_chain_data["encoding_version"]}')
+    arrays = { name : _decode_array(encoded_array) for name, encoded_array in encoded_chain_data['arrays'].items() }
+    code_table = np.array(encoded_chain_data['code_table'] + [ '' ], dtype=str)
+    chain_arrays = { key : encoded_chain_data[key] for key in CHAIN_HEADER_KEYS }
+    chain_arrays['residue_seqnos'] = arrays['residue_seqnos'].astype(np.int64)
+    # Gaps have code ID -1, which picks the empty string appended to the table
+    chain_arrays['residue_codes'] = code_table[arrays['residue_codes']]
+    chain_arrays['residue_validities'] = arrays['residue_validities'].astype(bool)
+    chain_arrays['discrete_values'] = arrays['discrete_values']
+    # Single-precision values are rounded back to the precision get_raw_data produces
+    chain_arrays['continuous_values'] = round_array(arrays['continuous_values'].astype(np.float64), RAW_DATA_DECIMALS)
+    chain_arrays['percentile_values'] = arrays['percentile_values']
+    return chain_arrays
+
+
+def decode_chain_data(encoded_chain_data):
+    if 'arrays' not in encoded_chain_data:
+        return encoded_chain_data
+    return chain_arrays_to_data(decode_chain_arrays(encoded_chain_data))
+
+
+def encode_raw_data(raw_data):
+    return [ encode_chain_data(chain_data) for chain_data in raw_data ]
+
+
+def decode_raw_data(encoded_raw_data):
+    return [ decode_chain_data(encoded_chain_data) for encoded_chain_data in encoded_raw_data ]
+
+
+def save_raw_data(raw_data, raw_data_path):
+    with open(raw_data_path, 'w', encoding='utf8') as outfile:
+        json.dump(encode_raw_data(raw_data), outfile, separators=(',', ':'))
+
+
+def load_raw_data(raw_data_path):
+    with open(raw_data_path, 'r', encoding='utf8') as infile:
+        return decode_raw_data(json.load(infile))
@@ -1,8 +1,45 @@
 import clipper
+import numpy as np
 
 from iris_validation import utils
+from iris_validation.metrics.columnar import PERCENTILE_COLUMNS, RESIDUE_DTYPE
 from iris_validation.metrics.model import MetricsModel
 from iris_validation.metrics.reflections import ReflectionsHandler
+from iris_validation.metrics.serialization import RAW_DATA_DECIMALS, chain_arrays_to_data, round_array
+
+
+# Columns of the packed residue arrays reported for each residue, in the order the report expects
+RAW_DISCRETE_COLUMNS = ('discrete_rotamer',
+                        'discrete_ramachandran',
+                        'discrete_clash',
+                        'discrete_cmo')
+
+RAW_CONTINUOUS_COLUMNS = ('avg_b_factor',
+                          'max_b_factor',
+                          'std_b_factor',
+                          'fit_score',
+                          'mainchain_fit_score',
+                          'sidechain_fit_score',
+                          'covariance_score')
+
+
+def _get_raw_columns(chain):
+    # Columnar models already hold every column; for residue objects only the reported ones are read
+    if chain.parent_model is not None and chain.parent_model.residue_data is not None:
+        return chain.get_residue_data()
+    residues = chain.residues
+    columns = { 'sequence_number' : np.array([ residue.sequence_number for residue in residues ], dtype=np.int64),
+                'code' : np.array([ residue.code for residue in residues ], dtype=RESIDUE_DTYPE['code']) }
+    for column in RAW_CONTINUOUS_COLUMNS:
+        columns[column] = np.array([ getattr(residue, column) for residue in residues ], dtype=np.float64)
+    for column in RAW_DISCRETE_COLUMNS + PERCENTILE_COLUMNS:
+        if column in RAW_DISCRETE_COLUMNS:
+            values = [ residue.discrete_indicators[column[len('discrete_'):]] for residue in residues ]
+        else:
+            values = [ getattr(residue, column) for residue in residues ]
+        values = np.array(values, dtype=np.float64)
+        columns[column] = np.where(np.isnan(values), -1, values).astype(np.int8)
+    return columns
 
 
 class MetricsModelSeries():
@@ -14,11 +51,9 @@ class MetricsModelSeries():
         for metrics_model in self.metrics_models:
             metrics_model.parent_series = self
 
-    def align_models(self):
+    def align_models(self, executor=None):
         if len(self.metrics_models) == 0:
             return
-        if len(self.metrics_models) > 2:
-            raise Exception('Iris currently only supports alignment for two model iterations')
 
         # Check for and remove chains with no amino acid residues
         bad_chain_ids = set()
@@ -29,8 +64,7 @@ class MetricsModelSeries():
         if len(bad_chain_ids) > 0:
             print('WARNING: at least one chain contains no amino acid residues. Ignoring chains: ' + ', '.join(sorted(bad_chain_ids)))
             for model in self.metrics_models:
-                for chain_id in bad_chain_ids:
-                    model.remove_chain(chain_id)
+                model.remove_chains(bad_chain_ids)
         if 0 in [ model.chain_count for model in self.metrics_models ]:
             raise Exception('One or more models had no valid chains')
 
@@ -42,30 +76,31 @@ class MetricsModelSeries():
             model_lost_chain_ids = chain_id_set - common_chain_ids
             lost_chain_ids.update(model_lost_chain_ids)
             if len(model_lost_chain_ids) > 0:
-                for chain_id in model_lost_chain_ids:
-                    model.remove_chain(chain_id)
+                model.remove_chains(model_lost_chain_ids)
         if len(lost_chain_ids) > 0:
             print(f'WARNING: Some chains are not present or valid across all model versions ({sorted(lost_chain_ids)}). These chains will not be represented in the validation report.')
 
         # Chain sets
         self.chain_sets = { }
         for chain_id in sorted(common_chain_ids):
-            self.chain_sets[chain_id] = [ ]
-            for model in self.metrics_models:
-                matching_chain = [ chain for chain in model if chain.chain_id == chain_id ][0]
-                self.chain_sets[chain_id].append(matching_chain)
+            self.chain_sets[chain_id] = [ model.get_chain(chain_id) for model in self.metrics_models ]
 
         # Align residues
         self.chain_alignments = { }
+        chain_sequences = { }
         for chain_id, chain_set in self.chain_sets.items():
-            sequences = [ utils.code_three_to_one([ residue.code for residue in chain ]) for chain in chain_set ]
-            if len(sequences) == 1:
-                self.chain_alignments[chain_id] = (sequences[0], )
-                continue
-            alignment_pair = utils.needleman_wunsch(sequences[-2], sequences[-1])
-            self.chain_alignments[chain_id] = alignment_pair
-
-    def get_raw_data(self):
+            chain_sequences[chain_id] = [ utils.code_three_to_one([ residue.code for residue in chain ]) for chain in chain_set ]
+        if executor is None:
+            for chain_id, sequences in chain_sequences.items():
+                self.chain_alignments[chain_id] = utils.progressive_alignment(sequences)
+        else:
+            futures = { chain_id : executor.submit(utils.progressive_alignment, sequences) for chain_id, sequences in chain_sequences.items() }
+            for chain_id, future in futures.items():
+                self.chain_alignments[chain_id] = future.result()
+
+    def get_raw_arrays(self):
+        # Per-chain column arrays, gathered from each version's packed residues through the alignment's gap
+        # mask. Versions and alignment positions are the last two axes; gaps hold -1, NaN or empty values.
         if self.chain_alignments is None:
             self.align_models()
 
@@ -74,85 +109,46 @@ class MetricsModelSeries():
         has_molprobity = self.metrics_models[0].molprobity_data is not None
         has_reflections = self.metrics_models[0].reflections_data is not None
 
-        raw_data = [ ]
+        raw_arrays = [ ]
         for chain_id, chain_set in self.chain_sets.items():
             alignment_strings = self.chain_alignments[chain_id]
             aligned_length = len(alignment_strings[0])
-            chain_data = { 'chain_id'           : chain_id,
-                           'num_versions'       : num_versions,
-                           'has_covariance'     : has_covariance,
-                           'has_molprobity'     : has_molprobity,
-                           'has_reflections'    : has_reflections,
-                           'aligned_length'     : aligned_length,
-                           'residue_seqnos'     : [ ],
-                           'residue_codes'      : [ ],
-                           'residue_validities' : [ ],
-                           'discrete_values'    : [ ],
-                           'continuous_values'  : [ ],
-                           'percentile_values'  : [ ] }
-
-            for alignment_string, chain in zip(alignment_strings, chain_set):
-                residue_seqnos = [ ]
-                residue_codes = [ ]
-                residue_validities = [ ]
-                discrete_values = [ ]
-                continuous_values = [ ]
-                percentile_values = [ ]
-
-                residue_id = -1
-                for alignment_char in alignment_string:
-                    if alignment_char == '-':
-                        residue_seqnos.append(None)
-                        residue_codes.append(None)
-                        residue_validities.append(False)
-                        discrete_values.append(tuple(None for _ in range(4)))
-                        continuous_values.append(tuple(None for _ in range(7)))
-                        percentile_values.append(tuple(None for _ in range(7)))
-                        continue
-
-                    residue_id += 1
-                    residue = chain.residues[residue_id]
-                    residue_seqnos.append(residue.sequence_number)
-                    residue_codes.append(residue.code)
-                    residue_validities.append(True)
-
-                    residue_discrete_values = (residue.discrete_indicators['rotamer'],
-                                               residue.discrete_indicators['ramachandran'],
-                                               residue.discrete_indicators['clash'],
-                                               residue.discrete_indicators['cmo'])
-                    residue_continuous_values = (residue.avg_b_factor,
-                                                 residue.max_b_factor,
-                                                 residue.std_b_factor,
-                                                 residue.fit_score,
-                                                 residue.mainchain_fit_score,
-                                                 residue.sidechain_fit_score,
-                                                 residue.covariance_score)
-                    residue_percentile_values = (residue.avg_b_factor_percentile,
-                                                 residue.max_b_factor_percentile,
-                                                 residue.std_b_factor_percentile,
-                                                 residue.fit_score_percentile,
-                                                 residue.mainchain_fit_score_percentile,
-                                                 residue.sidechain_fit_score_percentile,
-                                                 residue.covariance_score_percentile)
-
-                    residue_continuous_values = tuple(round(x, 3) if isinstance(x, float) else x for x in residue_continuous_values)
-                    discrete_values.append(residue_discrete_values)
-                    continuous_values.append(residue_continuous_values)
-                    percentile_values.append(residue_percentile_values)
-
-                discrete_values = list(zip(*discrete_values))
-                continuous_values = list(zip(*continuous_values))
-                percentile_values = list(zip(*percentile_values))
-                chain_data['residue_seqnos'].append(residue_seqnos)
-                chain_data['residue_codes'].append(residue_codes)
-                chain_data['residue_validities'].append(residue_validities)
-                chain_data['discrete_values'].append(discrete_values)
-                chain_data['continuous_values'].append(continuous_values)
-                chain_data['percentile_values'].append(percentile_values)
-
-            chain_data['discrete_values'] = list(zip(*chain_data['discrete_values']))
-            chain_data['continuous_values'] = list(zip(*chain_data['continuous_values']))
-            chain_data['percentile_values'] = list(zip(*chain_data['percentile_values']))
-            raw_data.append(chain_data)
-
-        return raw_data
+            residue_validities = np.array([ [ alignment_char != '-' for alignment_char in alignment_string ]
+                                            for alignment_string in alignment_strings ], dtype=bool).reshape(num_versions, aligned_length)
+            residue_ids = np.cumsum(residue_validities, axis=1) - 1
+
+            residue_seqnos = np.zeros((num_versions, aligned_length), dtype=np.int64)
+            residue_codes = np.full((num_versions, aligned_length), '', dtype=RESIDUE_DTYPE['code'])
+            discrete_values = np.full((len(RAW_DISCRETE_COLUMNS), num_versions, aligned_length), -1, dtype=np.int8)
+            continuous_values = np.full((len(RAW_CONTINUOUS_COLUMNS), num_versions, aligned_length), np.nan, dtype=np.float64)
+            percentile_values = np.full((len(PERCENTILE_COLUMNS), num_versions, aligned_length), -1, dtype=np.int8)
+            for version_id, chain in enumerate(chain_set):
+                is_valid = residue_validities[version_id]
+                rows = residue_ids[version_id][is_valid]
+                residue_columns = _get_raw_columns(chain)
+                residue_seqnos[version_id, is_valid] = residue_columns['sequence_number'][rows]
+                residue_codes[version_id, is_valid] = residue_columns['code'][rows]
+                for values, columns in ((discrete_values, RAW_DISCRETE_COLUMNS),
+                                        (continuous_values, RAW_CONTINUOUS_COLUMNS),
+                                        (percentile_values, PERCENTILE_COLUMNS)):
+                    for metric_id, column in enumerate(columns):
+                        values[metric_id, version_id, is_valid] = residue_columns[column][rows]
+
+            raw_arrays.append({ 'chain_id'           : chain_id,
+                                'num_versions'       : num_versions,
+                                'has_covariance'     : has_covariance,
+                                'has_molprobity'     : has_molprobity,
+                                'has_reflections'    : has_reflections,
+                                'aligned_length'     : aligned_length,
+                                'residue_seqnos'     : residue_seqnos,
+                                'residue_codes'      : residue_codes,
+                                'residue_validities' : residue_validities,
+                                'discrete_values'    : discrete_values,
+                                'continuous_values'  : round_array(continuous_values, RAW_DATA_DECIMALS),
+                                'percentile_values'  : percentile_values })
+
+        return raw_arrays
+
+    def get_raw_data(self):
+        # The nested lists and tuples consumed by the report, built from the column arrays
+        return [ chain_arrays_to_data(chain_arrays) for chain_arrays in self.get_raw_arrays() ]
@@ -1,6 +1,8 @@
-from math import acos, atan2, degrees
+from math import acos, atan2, degrees, isnan
+from functools import lru_cache
 
 import clipper
+import numpy as np
 
 
 THREE_LETTER_CODES = { 0 : [ 'ALA', 'GLY', 'VAL', 'LEU', 'ILE', 'PRO', 'PHE', 'TYR', 'TRP', 'SER',
@@ -72,6 +74,9 @@ ATOMIC_NUMBERS = { 'H': 1, 'HE': 2, 'LI': 3, 'BE': 4, 'B': 5, 'C': 6, 'N': 7, 'O
 
 MC_ATOM_NAMES = set([ 'N', 'CA' 'C', 'O', 'CB' ])
 
+NW_BAND_PADDING = 32
+NW_UNREACHED = -2**50
+
 
 # General calculations
 def mean(values):
@@ -160,6 +165,27 @@ def torsion(xyz1, xyz2, xyz3, xyz4, range_positive=False):
     return result
 
 
+def torsions(xyzs, in_degrees=True, range_positive=False):
+    # Vectorised torsion for an (n x 4 x 3) array of coordinates; rows with missing (NaN) coordinates give NaN
+    xyzs = np.asarray(xyzs, dtype=np.float64).reshape(-1, 4, 3)
+    b1 = xyzs[:, 1] - xyzs[:, 0]
+    b2 = xyzs[:, 2] - xyzs[:, 1]
+    b3 = xyzs[:, 3] - xyzs[:, 2]
+    n1 = np.cross(b1, b2)
+    n2 = np.cross(b2, b3)
+    m1 = np.cross(n1, n2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        unit_b2 = b2 / np.sqrt(np.sum(b2**2, axis=1))[:, np.newaxis]
+    y = np.sum(m1 * unit_b2, axis=1)
+    x = np.sum(n1 * n2, axis=1)
+    result = np.arctan2(y, x)
+    if in_degrees:
+        result = np.degrees(result)
+    if range_positive:
+        result = np.where(result < 0, result + (360 if in_degrees else 2*np.pi), result)
+    return result
+
+
 # General functions
 def code_three_to_one(three_letter_codes, strict=False, verbose=False):
     one_letter_codes = ''
@@ -202,7 +228,110 @@ def code_one_to_three(one_letter_codes, strict=False, verbose=False):
     return three_letter_codes
 
 
+def _nw_fill(seq1, seq2, match_award, mismatch_penalty, gap_penalty, band=None):
+    # Row-wise fill: within a row, score[i][j] = max_k(t[k] + gap*(j-k)), which is a running maximum
+    n = len(seq1)
+    m = len(seq2)
+    codes1 = np.array([ ord(char) for char in seq1 ], dtype=np.int64)
+    codes2 = [ ord(char) for char in seq2 ]
+    is_gap1 = codes1 == ord('-')
+
+    score = np.full((m+1, n+1), NW_UNREACHED, dtype=np.int64)
+    score[0, :] = gap_penalty * np.arange(n+1)
+    score[:, 0] = gap_penalty * np.arange(m+1)
+    offsets = gap_penalty * np.arange(n+1)
+
+    for i in range(1, m+1):
+        lo, hi = 1, n
+        if band is not None:
+            lo, hi = max(1, i + band[0]), min(n, i + band[1])
+            if lo > hi:
+                continue
+        previous = score[i-1]
+        mismatch_scores = np.where(is_gap1[lo-1:hi], gap_penalty, mismatch_penalty) if codes2[i-1] != ord('-') else gap_penalty
+        substitution = np.where(codes1[lo-1:hi] == codes2[i-1], match_award, mismatch_scores)
+        vertical_best = np.maximum(previous[lo-1:hi] + substitution, previous[lo:hi+1] + gap_penalty)
+        candidates = np.concatenate(([ score[i, lo-1] ], vertical_best)) - offsets[lo-1:hi+1]
+        score[i, lo:hi+1] = (np.maximum.accumulate(candidates) + offsets[lo-1:hi+1])[1:]
+    return score
+
+
+def _nw_traceback(score, seq1, seq2, match_award, mismatch_penalty, gap_penalty, is_exact=None):
+    alignment1, alignment2 = [ ], [ ]
+    i, j = len(seq2), len(seq1)
+    while i > 0 and j > 0:
+        if is_exact is not None and not all(is_exact(*cell) for cell in ((i, j), (i-1, j-1), (i, j-1), (i-1, j))):
+            return None
+        score_current = int(score[i, j])
+        score_diagonal = int(score[i-1, j-1])
+        score_up = int(score[i, j-1])
+        score_left = int(score[i-1, j])
+
+        if score_current == score_diagonal + (match_award if seq1[j-1] == seq2[i-1] else gap_penalty if '-' in (seq1[j-1], seq2[i-1]) else mismatch_penalty):
+            alignment1.append(seq1[j-1])
+            alignment2.append(seq2[i-1])
+            i -= 1
+            j -= 1
+        elif score_current == score_up + gap_penalty:
+            alignment1.append(seq1[j-1])
+            alignment2.append('-')
+            j -= 1
+        elif score_current == score_left + gap_penalty:
+            alignment1.append('-')
+            alignment2.append(seq2[i-1])
+            i -= 1
+
+    while j > 0:
+        alignment1.append(seq1[j-1])
+        alignment2.append('-')
+        j -= 1
+    while i > 0:
+        alignment1.append('-')
+        alignment2.append(seq2[i-1])
+        i -= 1
+
+    return ''.join(reversed(alignment1)), ''.join(reversed(alignment2))
+
+
+def _nw_banded(seq1, seq2, match_award, mismatch_penalty, gap_penalty):
+    n = len(seq1)
+    m = len(seq2)
+    band = (min(0, n-m) - NW_BAND_PADDING, max(0, n-m) + NW_BAND_PADDING)
+    max_step = max(match_award, mismatch_penalty, gap_penalty)
+    score = _nw_fill(seq1, seq2, match_award, mismatch_penalty, gap_penalty, band)
+
+    def is_exact(i, j):
+        # A band score is exact if no path leaving the band could beat it. Such a path needs at least
+        # g_min gaps to reach an off-band diagonal and return, and every other step scores at most max_step.
+        if i == 0 or j == 0:
+            return True
+        offset = j - i
+        g_min = min((band[1]+1) + (band[1]+1 - offset), (1-band[0]) + (offset - band[0] + 1))
+        return 2 * int(score[i, j]) >= (i + j - g_min) * max_step + 2 * g_min * gap_penalty
+
+    return _nw_traceback(score, seq1, seq2, match_award, mismatch_penalty, gap_penalty, is_exact)
+
+
 def needleman_wunsch(seq1, seq2, match_award=1, mismatch_penalty=-1, gap_penalty=-1):
+    # Identical sequences align without gaps, unless the scoring favours gaps or mismatches over matches
+    if seq1 == seq2 and gap_penalty <= 0 and match_award >= max(mismatch_penalty, gap_penalty):
+        return seq1, seq2
+    if not all(float(x).is_integer() for x in (match_award, mismatch_penalty, gap_penalty)):
+        return _needleman_wunsch_python(seq1, seq2, match_award, mismatch_penalty, gap_penalty)
+    match_award, mismatch_penalty, gap_penalty = int(match_award), int(mismatch_penalty), int(gap_penalty)
+
+    # Successive model versions are usually near-identical, so try a band around the diagonal first
+    band_width = abs(len(seq1) - len(seq2)) + 2 * NW_BAND_PADDING + 1
+    if band_width < min(len(seq1), len(seq2)) and gap_penalty <= max(match_award, mismatch_penalty):
+        alignment = _nw_banded(seq1, seq2, match_award, mismatch_penalty, gap_penalty)
+        if alignment is not None:
+            return alignment
+
+    score = _nw_fill(seq1, seq2, match_award, mismatch_penalty, gap_penalty)
+    return _nw_traceback(score, seq1, seq2, match_award, mismatch_penalty, gap_penalty)
+
+
+def _needleman_wunsch_python(seq1, seq2, match_award=1, mismatch_penalty=-1, gap_penalty=-1):
     n = len(seq1)
     m = len(seq2)
 
@@ -255,82 +384,153 @@ def needleman_wunsch(seq1, seq2, match_award=1, mismatch_penalty=-1, gap_penalty
     return alignment1, alignment2
 
 
+def merge_alignment(alignment, anchor_pair, new_pair):
+    # Fold a pairwise alignment of the last row's sequence against a new one into a multiple alignment
+    rows = [ [ ] for _ in range(len(alignment) + 1) ]
+    anchor_row = alignment[-1]
+    i, j = 0, 0
+    while i < len(anchor_row) or j < len(anchor_pair):
+        if i < len(anchor_row) and (anchor_row[i] == '-' or j == len(anchor_pair)):
+            for row, aligned_row in zip(rows, alignment):
+                row.append(aligned_row[i])
+            rows[-1].append('-')
+            i += 1
+        elif j < len(anchor_pair) and (anchor_pair[j] == '-' or i == len(anchor_row)):
+            for row in rows[:-1]:
+                row.append('-')
+            rows[-1].append(new_pair[j])
+            j += 1
+        else:
+            for row, aligned_row in zip(rows, alignment):
+                row.append(aligned_row[i])
+            rows[-1].append(new_pair[j])
+            i += 1
+            j += 1
+    return tuple(''.join(row) for row in rows)
+
+
+def progressive_alignment(sequences, match_award=1, mismatch_penalty=-1, gap_penalty=-1):
+    # Each sequence is aligned against its predecessor only, so cost grows linearly with the number of sequences
+    if len(sequences) == 0:
+        return ()
+    alignment = (sequences[0], )
+    for previous_sequence, sequence in zip(sequences[:-1], sequences[1:]):
+        anchor_pair, new_pair = needleman_wunsch(previous_sequence, sequence, match_award, mismatch_penalty, gap_penalty)
+        alignment = merge_alignment(alignment, anchor_pair, new_pair)
+    return alignment
+
+
 # (MiniMol) residue functions
-def code_type(mmol_residue):
+# Atom lookups for a single residue, built in one pass over its atoms. Names are indexed without spaces,
+# and only atoms with no alternate conformation or the first ('A') conformation are included. Indices built
+# from atom table arrays have no clipper atoms.
+class ResidueAtomIndex():
+    def __init__(self, code, atom_ids, xyzs, b_factors, atoms=None, seq_num=None, insertion_code=None):
+        self.code = code
+        self.seq_num = seq_num
+        self.insertion_code = insertion_code
+        self.atom_ids = atom_ids
+        self.xyzs = xyzs
+        self.b_factors = b_factors
+        self.atoms = atoms
+        self.positions = { }
+        self.first_positions = { }
+        for position, atom_id in enumerate(atom_ids):
+            atom_name, _, altloc = atom_id.replace(' ', '').partition(':')
+            if atom_name not in self.first_positions:
+                self.first_positions[atom_name] = position
+            if altloc not in ('', 'A'):
+                continue
+            if atom_name not in self.positions:
+                self.positions[atom_name] = [ ]
+            self.positions[atom_name].append(position)
+
+    def find_all(self, atom_name):
+        return self.positions.get(atom_name, [ ])
+
+    def find(self, atom_name, any_altloc=False):
+        if any_altloc:
+            return self.first_positions.get(atom_name)
+        positions = self.positions.get(atom_name)
+        return positions[0] if positions else None
+
+    def backbone_positions(self):
+        return self.find('N'), self.find('CA'), self.find('C')
+
+
+def index_atoms(mmol_residue):
+    atoms = list(mmol_residue)
+    atom_ids, xyzs, b_factors = [ ], [ ], [ ]
+    for atom in atoms:
+        co = atom.coord_orth()
+        atom_ids.append(str(atom.id()).strip())
+        xyzs.append((co.x(), co.y(), co.z()))
+        b_factors.append(clipper.Util_u2b(atom.u_iso()))
+    return ResidueAtomIndex(str(mmol_residue.type()).strip(), atom_ids, xyzs, b_factors, atoms, int(mmol_residue.seqnum()), insertion_code(mmol_residue))
+
+
+def insertion_code(mmol_residue):
+    residue_id = str(mmol_residue.id()).strip()
+    if ':' in residue_id:
+        return residue_id.split(':', 1)[1].strip()
+    return residue_id.lstrip('-0123456789').strip()
+
+
+def code_type(mmol_residue, code=None):
+    if code is None:
+        code = mmol_residue.type().trim()
     try:
-        return next(category for category, group in THREE_LETTER_CODES.items() if mmol_residue.type().trim() in group)
+        return next(category for category, group in THREE_LETTER_CODES.items() if code in group)
     except StopIteration:
         return None
 
 
-def get_backbone_atoms(mmol_residue):
-    try:
-        n = next(atom for atom in mmol_residue if atom.id().trim().replace(' ', '') == 'N' or atom.id().trim().replace(' ', '') == 'N:A')
-    except StopIteration:
-        n = None
-    try:
-        ca = next(atom for atom in mmol_residue if atom.id().trim().replace(' ', '') == 'CA' or atom.id().trim().replace(' ', '') == 'CA:A')
-    except StopIteration:
-        ca = None
-    try:
-        c = next(atom for atom in mmol_residue if atom.id().trim().replace(' ', '') == 'C' or atom.id().trim().replace(' ', '') == 'C:A')
-    except StopIteration:
-        c = None
-    return n, ca, c
-
-
-def check_backbone_geometry(mmol_residue):
-    n, ca, c = get_backbone_atoms(mmol_residue)
-    n_co = n.coord_orth()
-    ca_co = ca.coord_orth()
-    c_co = c.coord_orth()
-    xyz_n = (n_co.x(), n_co.y(), n_co.z())
-    xyz_ca = (ca_co.x(), ca_co.y(), ca_co.z())
-    xyz_c = (c_co.x(), c_co.y(), c_co.z())
+def get_backbone_atoms(mmol_residue, atom_index=None):
+    if atom_index is None:
+        atom_index = index_atoms(mmol_residue)
+    return tuple(None if position is None else atom_index.atoms[position] for position in atom_index.backbone_positions())
+
+
+def check_backbone_geometry(mmol_residue, atom_index=None):
+    if atom_index is None:
+        atom_index = index_atoms(mmol_residue)
+    xyz_n, xyz_ca, xyz_c = [ atom_index.xyzs[position] for position in atom_index.backbone_positions() ]
     dist_n_ca = distance(xyz_n, xyz_ca)
     dist_ca_c = distance(xyz_ca, xyz_c)
     return dist_n_ca < 1.8 and dist_ca_c < 1.8
 
 
-def calculate_chis(mmol_residue):
+def calculate_chis(mmol_residue, atom_index=None):
+    if atom_index is None:
+        atom_index = index_atoms(mmol_residue)
     chis = [ ]
     for i in range(5):
-        chi_atoms = [ ]
-        has_chi = any(mmol_residue.type().trim() in residues for residues in list(CHI_ATOMS[i].values()))
+        has_chi = any(atom_index.code in residues for residues in list(CHI_ATOMS[i].values()))
         if not has_chi:
             return chis
-        required_atom_names = next(atoms for atoms, residues in CHI_ATOMS[i].items() if mmol_residue.type().trim() in residues)
-        missing_atom_names = [ ]
-        for required_atom_name in required_atom_names:
-            found = False
-            for atom in mmol_residue:
-                atom_name = atom.id().trim().replace(' ', '')
-                if atom_name in (required_atom_name, required_atom_name + ':A'):
-                    chi_atoms.append(atom)
-                    found = True
-            if not found:
-                missing_atom_names.append(required_atom_name)
-        if len(chi_atoms) < 4:
+        required_atom_names = next(atoms for atoms, residues in CHI_ATOMS[i].items() if atom_index.code in residues)
+        chi_positions = [ position for required_atom_name in required_atom_names for position in atom_index.find_all(required_atom_name) ]
+        if len(chi_positions) < 4:
             chis.append(None)
             continue
-        xyzs = [ (atom.coord_orth().x(), atom.coord_orth().y(), atom.coord_orth().z()) for atom in chi_atoms ]
+        xyzs = [ atom_index.xyzs[position] for position in chi_positions ]
         chis.append(torsion(xyzs[0], xyzs[1], xyzs[2], xyzs[3]))
     return tuple(chis)
 
 
-def analyse_b_factors(mmol_residue, is_aa=None, backbone_atoms=None):
+def analyse_b_factors(mmol_residue, is_aa=None, backbone_atoms=None, atom_index=None):
+    if atom_index is None:
+        atom_index = index_atoms(mmol_residue)
     if is_aa is None:
-        is_aa = check_is_aa(mmol_residue)
-    if backbone_atoms is None:
-        backbone_atoms = get_backbone_atoms(mmol_residue)
+        is_aa = check_is_aa(mmol_residue, atom_index=atom_index)
+    if is_aa:
+        if backbone_atoms is None:
+            backbone_atom_ids = set(atom_index.atom_ids[position] for position in atom_index.backbone_positions())
+        else:
+            backbone_atom_ids = set([ str(atom.id()).strip() for atom in backbone_atoms ])
+    residue_b_factors, mc_b_factors, sc_b_factors = atom_index.b_factors, [ ], [ ]
     if is_aa:
-        backbone_atom_ids = set([ str(atom.id()).strip() for atom in backbone_atoms ])
-    residue_b_factors, mc_b_factors, sc_b_factors = [ ], [ ], [ ]
-    for atom in mmol_residue:
-        atom_id = str(atom.id()).strip()
-        bf = clipper.Util_u2b(atom.u_iso())
-        residue_b_factors.append(bf)
-        if is_aa:
+        for atom_id, bf in zip(atom_index.atom_ids, residue_b_factors):
             if atom_id in backbone_atom_ids:
                 mc_b_factors.append(bf)
             else:
@@ -343,26 +543,92 @@ def analyse_b_factors(mmol_residue, is_aa=None, backbone_atoms=None):
     return b_max, b_avg, b_stdev, mc_b_avg, sc_b_avg
 
 
-def check_is_aa(mmol_residue, strict=False):
+def check_is_aa(mmol_residue, strict=False, atom_index=None):
+    if atom_index is None:
+        atom_index = index_atoms(mmol_residue)
     allowed_types = (0,) if strict else (0, 1)
-    if code_type(mmol_residue) in allowed_types and \
-       None not in get_backbone_atoms(mmol_residue) and \
-       check_backbone_geometry(mmol_residue):
+    if code_type(None, atom_index.code) in allowed_types and \
+       None not in atom_index.backbone_positions() and \
+       check_backbone_geometry(None, atom_index):
         return True
     return False
 
 
-def get_rama_calculator(mmol_residue, code=None):
-    if code is None:
-        code = mmol_residue.type().trim()
+# (MiniMol) chain functions
+def calculate_chain_torsions(atom_indices):
+    # Backbone torsions (in radians, as from clipper) and side chain torsions (in degrees) for each residue
+    # of a chain in one pass. Entries of atom_indices may be None for residues with no atom information.
+    num_residues = len(atom_indices)
+    backbone_xyzs = np.full((num_residues, 3, 3), np.nan)
+    chi_xyzs, chi_slots = [ ], [ ]
+    all_chis = [ ]
+    for residue_index, atom_index in enumerate(atom_indices):
+        if atom_index is None:
+            all_chis.append([ ])
+            continue
+        # Backbone atoms are matched regardless of alternate conformation, like clipper's MM::ANY lookups
+        for atom_id, atom_name in enumerate(('N', 'CA', 'C')):
+            position = atom_index.find(atom_name, any_altloc=True)
+            if position is not None:
+                backbone_xyzs[residue_index, atom_id] = atom_index.xyzs[position]
+        chis = [ ]
+        for i in range(5):
+            required_atom_names = next((atoms for atoms, residues in CHI_ATOMS[i].items() if atom_index.code in residues), None)
+            if required_atom_names is None:
+                break
+            chi_positions = [ position for required_atom_name in required_atom_names for position in atom_index.find_all(required_atom_name) ]
+            if len(chi_positions) < 4:
+                chis.append(None)
+                continue
+            chi_xyzs.append([ atom_index.xyzs[position] for position in chi_positions[:4] ])
+            chi_slots.append((residue_index, len(chis)))
+            chis.append(None)
+        all_chis.append(chis)
+
+    # Phi: C(i-1), N(i), CA(i), C(i); psi: N(i), CA(i), C(i), N(i+1); omega: CA(i-1), C(i-1), N(i), CA(i)
+    backbone_torsion_xyzs = np.full((3, num_residues, 4, 3), np.nan)
+    if num_residues > 0:
+        backbone_torsion_xyzs[0, 1:, 0] = backbone_xyzs[:-1, 2]
+        backbone_torsion_xyzs[0, 1:, 1:] = backbone_xyzs[1:]
+        backbone_torsion_xyzs[1, :-1, :3] = backbone_xyzs[:-1]
+        backbone_torsion_xyzs[1, :-1, 3] = backbone_xyzs[1:, 0]
+        backbone_torsion_xyzs[2, 1:, :2] = backbone_xyzs[:-1, 1:]
+        backbone_torsion_xyzs[2, 1:, 2:] = backbone_xyzs[1:, :2]
+    backbone_torsions = torsions(backbone_torsion_xyzs, in_degrees=False).reshape(3, num_residues)
+    backbone_torsions = [ [ None if isnan(angle) else angle for angle in angles ] for angles in backbone_torsions.tolist() ]
+    phis, psis, omegas = backbone_torsions
+
+    if len(chi_xyzs) > 0:
+        for (residue_index, chi_id), chi in zip(chi_slots, torsions(chi_xyzs).tolist()):
+            all_chis[residue_index][chi_id] = chi
+
+    return phis, psis, omegas, all_chis
+
+
+def get_rama_table_name(code):
     if code == 'GLY':
-        return clipper.Ramachandran(clipper.Ramachandran.Gly2)
+        return 'Gly2'
     elif code == 'PRO':
-        return clipper.Ramachandran(clipper.Ramachandran.Pro2)
+        return 'Pro2'
     elif code in ('ILE', 'VAL'):
-        return clipper.Ramachandran(clipper.Ramachandran.IleVal2)
+        return 'IleVal2'
     else:
-        return clipper.Ramachandran(clipper.Ramachandran.NoGPIVpreP2)
+        return 'NoGPIVpreP2'
+
+
+@lru_cache(maxsize=None)
+def _get_cached_rama_calculator(table_name):
+    return clipper.Ramachandran(getattr(clipper.Ramachandran, table_name))
+
+
+def get_rama_calculator(mmol_residue, code=None, cached=True):
+    # Cached calculators are shared, so they must not be modified; pass cached=False to get one that can be
+    if code is None:
+        code = mmol_residue.type().trim()
+    table_name = get_rama_table_name(code)
+    if cached:
+        return _get_cached_rama_calculator(table_name)
+    return clipper.Ramachandran(getattr(clipper.Ramachandran, table_name))
 
 
 def get_ramachandran_allowed(mmol_residue, code=None, phi=None, psi=None, thresholds=None):
@@ -370,7 +636,7 @@ def get_ramachandran_allowed(mmol_residue, code=None, phi=None, psi=None, thresh
         return None
     if code is None:
         code = mmol_residue.type().trim()
-    rama_function = get_rama_calculator(None, code)
+    rama_function = get_rama_calculator(None, code, cached=thresholds is None)
     if thresholds is not None:
         rama_function.set_thresholds(*thresholds)
     return rama_function.allowed(phi, psi)
@@ -381,7 +647,7 @@ def get_ramachandran_favoured(mmol_residue, code=None, phi=None, psi=None, thres
         return None
     if code is None:
         code = mmol_residue.type().trim()
-    rama_function = get_rama_calculator(None, code)
+    rama_function = get_rama_calculator(None, code, cached=thresholds is None)
     if thresholds is not None:
         rama_function.set_thresholds(*thresholds)
     return rama_function.favoured(phi, psi)